@@ -8,11 +8,35 @@ Created on Jan 5, 2013
 Author: Juuso Räsänen (email: info@trimap.fi)
 '''
 
-import pyexiv2
+import os
 import sys
 import re
+import datetime
+import ConfigParser
 from fractions import Fraction
 
+import fastexif
+import perfstats
+
+# Imported when the first file is read with it (see importPyexiv2): it is slow to load and not needed for the queries
+pyexiv2 = None
+_pyexiv2Tried = False
+
+def importPyexiv2():
+    """ Import pyexiv2 on the first call and return it, or None if it is not installed (only the 'fast' reader can be
+        used then). """
+    global pyexiv2, _pyexiv2Tried
+    if not _pyexiv2Tried:
+        _pyexiv2Tried = True
+        try:
+            import pyexiv2
+        except ImportError:
+            pyexiv2 = None
+    return pyexiv2
+
+# Supported readers (metadata extraction backends)
+READERS = ['exiv2', 'fast']
+
 # Define the supported SimpleDataBase keys and their mapping to Exiv2/Metadata fields.
 KEYS = dict()
 TYPES = dict()
@@ -32,16 +56,141 @@ KEYS['iso'] = ['Exif.Photo.ISOSpeedRatings', 'Exif.Nikon3.ISOSpeed']
 TYPES['iso'] = type(float())
 KEYS['rating'] = ['Xmp.xmp.Rating']
 TYPES['rating'] = type(int())
+# GPS position in decimal degrees (negative for S and W) and altitude in meters (negative below sea level), see gpsValue
+KEYS['gpslat'] = ['Xmp.exif.GPSLatitude', 'Exif.GPSInfo.GPSLatitude']
+TYPES['gpslat'] = type(float())
+KEYS['gpslon'] = ['Xmp.exif.GPSLongitude', 'Exif.GPSInfo.GPSLongitude']
+TYPES['gpslon'] = type(float())
+KEYS['gpsalt'] = ['Xmp.exif.GPSAltitude', 'Exif.GPSInfo.GPSAltitude']
+TYPES['gpsalt'] = type(float())
+
+# Exiv2 keys of the date and time tags, stored as 'YYYY:MM:DD HH:MM:SS' in the raw tags
+DATETIME_KEYS = set(['Exif.Image.DateTime', 'Exif.Photo.DateTimeOriginal', 'Exif.Photo.DateTimeDigitized'])
+# Exiv2 keys of the GPS tags and the keys of their references (hemisphere, above or below sea level)
+GPS_REF_KEYS = {'Exif.GPSInfo.GPSLatitude': 'Exif.GPSInfo.GPSLatitudeRef', 'Exif.GPSInfo.GPSLongitude': 'Exif.GPSInfo.GPSLongitudeRef',
+                'Exif.GPSInfo.GPSAltitude': 'Exif.GPSInfo.GPSAltitudeRef', 'Xmp.exif.GPSLatitude': None, 'Xmp.exif.GPSLongitude': None,
+                'Xmp.exif.GPSAltitude': 'Xmp.exif.GPSAltitudeRef'}
+GPS_LIMITS = {'Latitude': 90, 'Longitude': 180}
+MAX_RAW_STRING = 1024  # Longer strings (e.g. binary data shown as text) are left out of the raw tags stored in the database
+# Tags whose value is an element of a list other than the first (pyexiv2 reads the Nikon ISO as [0, ISO]), 0 meaning unknown
+TAG_ELEMENTS = {'Exif.Nikon3.ISOSpeed': 1}
+
+# Additional metadata fields can be declared in the configuration file, e.g.
+#   [fields]
+#   lens = str: Exif.Photo.LensModel, Xmp.aux.Lens
+# They are stored in database columns of the same name (see photodb -backfill).
+CONFIG_FILE = os.environ.get('PHOTOFIND_CONFIG', '~/.photofind.cfg')
+CONFIG_KEYS = []  # Names of the fields declared in the configuration file, in their order
+CONFIG_TYPES = {'str': type(str()), 'float': type(float()), 'int': type(int())}
+RESERVED_NAMES = ['filepath', 'filesize', 'modtime', 'origepoch', 'fingerprint', 'dir_id', 'name', 'raw', 'phash']
+
+def loadConfig(fname=CONFIG_FILE):
+    """ Add the fields declared in the [fields] section of given configuration file (if it exists) to KEYS, TYPES and
+        CONFIG_KEYS. Each field is 'name = type: Exiv2 key[, Exiv2 key ...]', type being str, float or int. """
+    fname = os.path.expanduser(fname)
+    config = ConfigParser.RawConfigParser()
+    try:
+        if not config.read(fname) or not config.has_section('fields'):
+            return
+    except ConfigParser.Error, msg:
+        sys.stderr.write('Warning: Ignoring the configuration file %s: %s\n' % (fname, msg))
+        return
+
+    for name, value in config.items('fields'):
+        datatype, _, exifkeys = value.partition(':')
+        exifkeys = [key.strip() for key in exifkeys.split(',') if key.strip()]
+        if not re.match('^[a-z][a-z0-9_]*$', name) or name in KEYS or name in RESERVED_NAMES:
+            sys.stderr.write('Warning: Ignoring field "%s" in %s: invalid or reserved name\n' % (name, fname))
+        elif datatype.strip() not in CONFIG_TYPES or not exifkeys:
+            sys.stderr.write('Warning: Ignoring field "%s" in %s: expected "type: Exiv2 key[, ...]" (type str, float or int)\n' % (name, fname))
+        else:
+            KEYS[name] = exifkeys
+            TYPES[name] = CONFIG_TYPES[datatype.strip()]
+            CONFIG_KEYS.append(name)
+
+loadConfig()
+
+
+def rawValue(val):
+    """ Convert a value read by pyexiv2 or fastexif to a JSON-compatible value for the raw tags: rationals to floats,
+        dates to EXIF date strings, strings to unicode, lists to lists (a single value as such). Returns None for
+        the values that are left out. """
+    if val is None or isinstance(val, (bool, int, long, float, unicode)):
+        pass
+    elif isinstance(val, str):
+        try:
+            val = val.decode('utf-8')
+        except UnicodeDecodeError:
+            val = val.decode('latin-1')
+    elif isinstance(val, (list, tuple)):
+        val = [v for v in (rawValue(v) for v in val) if v is not None]
+        return val if len(val) > 1 else (val[0] if val else None)
+    elif isinstance(val, dict):
+        # XMP language alternatives
+        return rawValue(val.get('x-default', val.values()[0] if val else None))
+    elif isinstance(val, datetime.datetime):
+        return unicode(val.strftime('%Y:%m:%d %H:%M:%S')) if val.year >= 1900 else None
+    elif isinstance(val, datetime.date):
+        return unicode(val.strftime('%Y:%m:%d')) if val.year >= 1900 else None
+    elif hasattr(val, 'numerator') and hasattr(val, 'denominator'):
+        # Fraction and pyexiv2.Rational
+        return float(val.numerator) / val.denominator if val.denominator else None
+    else:
+        val = unicode(str(val), 'utf-8', 'replace')
+    return val
+
+def tagValue(raw, exifkey):
+    """ Return the value of given tag in raw tags (see rawValue), the first value for the tags with many (or the one of
+        TAG_ELEMENTS), or None. """
+    val = raw.get(exifkey)
+    if exifkey in TAG_ELEMENTS:
+        if isinstance(val, list):
+            val = val[TAG_ELEMENTS[exifkey]] if len(val) > TAG_ELEMENTS[exifkey] else None
+        return val or None
+    if isinstance(val, list):
+        return val[0] if val else None
+    return val
+
+def gpsValue(raw, exifkey):
+    """ Return the value of given GPS tag (see GPS_REF_KEYS) in raw tags as signed decimal degrees or meters, or None.
+        The Exif coordinates are degrees, minutes and seconds with the hemisphere in the reference tag, the XMP ones
+        strings like '60,10.25N' or '60,10,15N'. """
+    val = raw.get(exifkey)
+    ref = raw.get(GPS_REF_KEYS[exifkey])
+    if isinstance(val, unicode):
+        match = re.match(r'^(\d+(?:\.\d+)?),(\d+(?:\.\d+)?)(?:,(\d+(?:\.\d+)?))?([NSEW])$', val.strip())
+        if not match:
+            return None
+        val = [float(part) for part in match.groups()[:3] if part != None]
+        ref = match.group(4)
+    elif isinstance(val, (int, long, float)):
+        val = [val]
+    elif not isinstance(val, list) or not all(isinstance(part, (int, long, float)) for part in val):
+        return None
+
+    # Degrees, minutes and seconds (or meters for the altitude)
+    val = sum(float(part) / 60 ** i for i, part in enumerate(val[:3]))
+    if ref in ('S', 'W', 1, '1'):
+        val = -val
+    limit = GPS_LIMITS.get(exifkey.split('GPS')[-1])
+    if limit != None and abs(val) > limit:
+        return None
+    return val
+
 
 class ImageMetadata:
     """ Class for metadata of a single file, i.e. a data-base-entry. """
 
     disable_stderr = True
+    reader = 'exiv2'  # Default reader, one of READERS. The 'fast' reader falls back to pyexiv2 for unsupported files.
  
     def __init__(self, fname, readNow=False):
         self.fname = fname
         self.data = dict()
+        self.raw = None  # All the tags read from the file (Exiv2 key -> rawValue), if read
+        self.phash = None  # Perceptual hash of the image (see perceptualhash), if computed
         self.exiv2md = None
+        self.fastfields = None  # Values read by the fast reader (Exiv2 key -> value)
         if readNow:
             self.read()
 
@@ -74,49 +223,129 @@ class ImageMetadata:
     
     def clear(self):
         self.data.clear()
-        pass
+        self.raw = None
+        self.phash = None
     
     # origtime=None, aperture=None, iso=None, exposure=None, flength=None, rating=None, comment=None
     def fromVals(self, valsDict):
+        """ Set the metadata values from given dict (see toVals). """
         self.clear()
         for key in valsDict:
             val = valsDict[key]
             if (KEYS.has_key(key)):
                 if (val != None):
                     self.data[key] = TYPES[key](val)
+            elif key in ('raw', 'phash'):
+                setattr(self, key, val)
             else:
                 sys.stderr.write('Warn: Ingoring unsupported metadata key "%s". \n' % key)
-                
+
+    def toVals(self):
+        """ Return the metadata values (and the raw tags and the perceptual hash if set) as a plain dict for fromVals. """
+        vals = dict(self.data)
+        for key in ('raw', 'phash'):
+            if getattr(self, key) != None:
+                vals[key] = getattr(self, key)
+        return vals
 
     def read(self):
         """ Read the real up-to-date metadata values from the file. """
         self.clear()
 
-        try:
-            self.exiv2md = pyexiv2.ImageMetadata(unicode(self.fname, encoding=sys.getfilesystemencoding()))
-        except UnicodeDecodeError, msg:
-            sys.stderr.write('Error (%s): %s\n' % (self.fname, msg))
+        if not (ImageMetadata.reader == 'fast' and self.readFast()) and not self.readExiv2():
             return
 
-        try:
-            self.exiv2md.read()
+        with perfstats.phase('read.fields'):
+            self.fromRaw(self.readRawTags())
 
-        except IOError, msg:
-            sys.stderr.write('Error reading metadata: %s\n' % msg)
-            return
-        
-        for key in KEYS:
+    def fromRaw(self, raw, keys=None):
+        """ Set the raw tags and the values of given metadata fields (default all KEYS) from them. A later Exiv2 key of
+            a field overrides the earlier ones. """
+        self.raw = raw
+        for key in (keys or KEYS):
             for exifkey in KEYS[key]:
-                val = self.getExivField(exifkey)
+                val = gpsValue(raw, exifkey) if exifkey in GPS_REF_KEYS else tagValue(raw, exifkey)
                 if (val != None):
+                    if isinstance(val, unicode):
+                        val = val.encode('utf-8')
+                    if exifkey in DATETIME_KEYS:
+                        # Stored like the datetime objects of pyexiv2 ('YYYY-MM-DD HH:MM:SS')
+                        try:
+                            val = datetime.datetime.strptime(val, '%Y:%m:%d %H:%M:%S')
+                        except ValueError:
+                            pass
                     try:
                         self.data[key] = TYPES[key](val)
-                        continue
                     except ValueError:
                         # This might happen e.g. is the read image file was corrupted.
-                        pass
+                        perfstats.count('read.decode_errors')
                     except TypeError:
-                        pass
+                        perfstats.count('read.decode_errors')
+
+    def readRawTags(self):
+        """ Return all the tags read by readFast() or readExiv2() as dict of Exiv2 key -> rawValue. """
+        raw = dict()
+        if (self.fastfields != None):
+            tags = self.fastfields.iteritems()
+        elif self.exiv2md:
+            tags = self._exiv2Tags()
+        else:
+            return raw
+        for exifkey, val in tags:
+            val = rawValue(val)
+            if val != None:
+                raw[exifkey] = val
+        return raw
+
+    def _exiv2Tags(self):
+        for exifkey in self.exiv2md.exif_keys + self.exiv2md.xmp_keys:
+            if exifkey == 'Exif.Photo.MakerNote':
+                continue
+            try:
+                yield exifkey, self.exiv2md[exifkey].value
+            except Exception:
+                # Tags pyexiv2 fails to convert
+                perfstats.count('read.decode_errors')
+
+    def readFast(self):
+        """ Read the metadata with the fast header-only reader. Return false if the file is not supported. """
+        self.exiv2md = None
+        try:
+            with perfstats.phase('read.fast'):
+                self.fastfields = fastexif.read(self.fname)
+        except fastexif.UnsupportedFormat:
+            perfstats.count('read.fast_unsupported')
+            return False
+        except (IOError, OSError), msg:
+            sys.stderr.write('Error reading metadata: %s\n' % msg)
+            perfstats.count('read.errors')
+            self.fastfields = dict()
+        return True
+
+    def readExiv2(self):
+        """ Read the metadata with pyexiv2. Return false on failure. """
+        if importPyexiv2() == None:
+            if ImageMetadata.reader == 'fast':
+                return False  # Not supported by the fast reader either
+            raise ImportError('pyexiv2 is not installed (required unless the fast reader is used)')
+
+        self.fastfields = None
+        try:
+            self.exiv2md = pyexiv2.ImageMetadata(unicode(self.fname, encoding=sys.getfilesystemencoding()))
+        except UnicodeDecodeError, msg:
+            sys.stderr.write('Error (%s): %s\n' % (self.fname, msg))
+            perfstats.count('read.errors')
+            return False
+
+        try:
+            with perfstats.phase('read.exiv2'):
+                self.exiv2md.read()
+
+        except IOError, msg:
+            sys.stderr.write('Error reading metadata: %s\n' % msg)
+            perfstats.count('read.errors')
+            return False
+        return True
 
     def __getitem__(self, k):
         try:
@@ -169,6 +398,9 @@ class ImageMetadata:
         return str(self.__getitem__('origtime'))
             
     def getExivField(self, exivKey):
+        if (self.fastfields != None):
+            return self.fastfields.get(exivKey)
+
         if (not self.exiv2md):
             sys.stderr.write('Error (%s): Metadata values should be read before accessing them.\n' % self.fname)
             #raise Exception('Metadata values must be read before accessing them.')
@@ -5,8 +5,23 @@
 """
  Author: Juuso Räsänen 2013 (email: info@trimap.fi)
 
+ Filter syntax (e.g. for photofind -iso):
+   +x, +=x, -x, -=x, x   greater, greater-or-equal, less, less-or-equal, equal
+   a..b                  range (inclusive), either end can be left out
+   x,y,...               any of the alternatives (OR)
+   !...                  negation, "!" alone matches files without the value
+   (empty)               files with the value
+
+ Besides the metadata fields (ImageMetadata.KEYS) any tag stored in the raw tags can be
+ filtered by its Exiv2 key (e.g. Exif.Photo.LensModel). The values of such filters are
+ numbers if they parse as numbers, otherwise strings.
+
+ The photos can also be filtered by their GPS position with the areas of the geo module
+ (see ExifFilter.add_area).
+
 """
 
+import operator
 import fractions
 
 import ImageMetadata
@@ -21,61 +36,167 @@ class Filter:
     GE=6 # Greater-or-equal
     #EX=7 # Exists (?) --> Use GT && self.refval = None instead.
 
+    SQL_OPERATORS = {EQ: '=', NE: '!=', LT: '<', LE: '<=', GT: '>', GE: '>='}
+    OPERATORS = {EQ: operator.eq, NE: operator.ne, LT: operator.lt, LE: operator.le, GT: operator.gt, GE: operator.ge}
+
+    # Rough guesses of the fraction of files passing a single condition, for ordering the terms
+    SELECTIVITY = {EQ: 0.1, NE: 0.9, LT: 0.5, LE: 0.5, GT: 0.5, GE: 0.5}
+
     def __init__(self, filter_string, datatype):
         self.datatype = datatype
-        self.filtertype = Filter.GT
+        self.negate = False
+        self.alternatives = []  # Lists of (filtertype, refval) conditions, all must pass in one of them. Empty list = exists.
+        self.filtertype = Filter.GT  # Type and value of the first condition (for single condition filters)
         self.refval = None
         self.userdata = None
         self.parse_filter(filter_string)
-        
+        self.test = self.compile()
+
     def apply(self, data):
         """ Apply this filter on given data. Return true if pass, false otherwise. """
+        return self.test(data)
+
+    def compile(self):
+        """ Return this filter as a function value -> bool, the reference values converted already. """
+        if self.alternatives == [[]]:
+            # (Not) exists
+            if self.negate:
+                return lambda val: val is None
+            return lambda val: val is not None
+
+        negate = self.negate
+        if len(self.alternatives) == 1 and len(self.alternatives[0]) == 1:
+            # The most common case, a single comparison
+            op = Filter.OPERATORS[self.filtertype]
+            refval = self.refval
+            if negate:
+                return lambda val: val is not None and not op(val, refval)
+            return lambda val: val is not None and op(val, refval)
+
+        alternatives = [[(Filter.OPERATORS[ftype], refval) for ftype, refval in conditions] for conditions in self.alternatives]
+
+        def test(val):
+            if val is None:
+                return False
+            for conditions in alternatives:
+                for op, refval in conditions:
+                    if not op(val, refval):
+                        break
+                else:
+                    return not negate
+            return negate
+        return test
+
+    def selectivity(self):
+        """ Return the estimated fraction of the files passing this filter. """
+        passing = 0.0
+        for conditions in self.alternatives:
+            p = 0.9  # Exists
+            for ftype, refval in conditions:
+                p = min(p, Filter.SELECTIVITY[ftype])
+            if len(conditions) > 1:
+                p *= 0.6  # Ranges
+            passing += p
+        passing = min(passing, 1.0)
+        if self.negate:
+            return 1.0 - passing
+        return passing
 
-        if (self.refval == None):
-            return data != None
-
-        if (type(data) == type(None)):
-            return False
-
-        refval = self.refval
-        curval = self.parse_value(data)
-        #print "'%s' '%s'" % (refval, curval)
-        if (self.filtertype == Filter.GT):
-            return curval > refval
-        if (self.filtertype == Filter.LT):
-            return curval < refval
-        if (self.filtertype == Filter.EQ):
-            return curval == refval
-        if (self.filtertype == Filter.GE):
-            return curval >= refval
-        if (self.filtertype == Filter.LE):
-            return curval <= refval
+    def to_sql(self, column):
+        """ Return this filter as SQL condition for given column and its parameters: (condition, params). """
+        if self.alternatives == [[]]:
+            return '%s IS %sNULL' % (column, '' if self.negate else 'NOT '), ()
+
+        params = []
+        if all(conditions and conditions[0][0] == Filter.EQ for conditions in self.alternatives) and len(self.alternatives) > 1:
+            # Alternative values, SQLite can use the index for IN
+            condition = '%s IN (%s)' % (column, ','.join('?' * len(self.alternatives)))
+            params = [conditions[0][1] for conditions in self.alternatives]
+        else:
+            parts = []
+            for conditions in self.alternatives:
+                if not conditions:
+                    parts.append('%s IS NOT NULL' % column)
+                elif [ftype for ftype, refval in conditions] == [Filter.GE, Filter.LE]:
+                    parts.append('%s BETWEEN ? AND ?' % column)
+                    params.extend(refval for ftype, refval in conditions)
+                else:
+                    parts.append(' AND '.join('%s %s ?' % (column, Filter.SQL_OPERATORS[ftype]) for ftype, refval in conditions))
+                    params.extend(refval for ftype, refval in conditions)
+            if len(parts) == 1:
+                condition = parts[0]
+            else:
+                condition = ' OR '.join('(%s)' % part for part in parts)
+
+        if self.negate:
+            condition = 'NOT (%s)' % condition
+        return condition, tuple(params)
+
+    def to_mask(self, values):
+        """ Return this filter as NumPy boolean mask over given column array, missing values being NaN (numbers)
+            or empty (strings). """
+        if values.dtype.kind == 'f':
+            present = values == values
+        else:
+            present = values != ''
+        if self.alternatives == [[]]:
+            return ~present if self.negate else present
+
+        mask = None
+        for conditions in self.alternatives:
+            passed = present
+            for ftype, refval in conditions:
+                passed = passed & Filter.OPERATORS[ftype](values, refval)
+            mask = passed if mask is None else mask | passed
+
+        if self.negate:
+            return present & ~mask
+        return mask
 
     def parse_filter(self, filter_string):
+        if filter_string.startswith('!'):
+            self.negate = True
+            filter_string = filter_string[1:]
+
+        self.alternatives = [self.parse_alternative(alternative.strip()) for alternative in filter_string.split(',')]
+        if self.alternatives[0]:
+            self.filtertype, self.refval = self.alternatives[0][0]
+
+    def parse_alternative(self, filter_string):
+        """ Return the conditions of a single alternative as list of (filtertype, refval). """
         nc = 0
         if (len(filter_string) == 0):
             # "Exists-filter"
-            self.filtertype = Filter.GT
-            self.refval = None
-            return
+            return []
+        elif '..' in filter_string:
+            low, high = filter_string.split('..', 1)
+            conditions = []
+            if low:
+                conditions.append((Filter.GE, self.parse_value(low)))
+            if high:
+                high = self.parse_value(high)
+                if self.datatype == type(str()):
+                    high += '~'  # Inclusive for prefixes, e.g. origtime 2013..2014 includes all of 2014
+                conditions.append((Filter.LE, high))
+            return conditions
         elif filter_string[0] == '+':
             if (len(filter_string) > 1 and filter_string[1] == '='):
-                self.filtertype = Filter.GE
+                filtertype = Filter.GE
                 nc = 2
             else:
-                self.filtertype = Filter.GT
+                filtertype = Filter.GT
                 nc = 1
         elif filter_string[0] == '-':
             if (len(filter_string) > 1 and filter_string[1] == '='):
-                self.filtertype = Filter.LE
+                filtertype = Filter.LE
                 nc = 2
             else:
-                self.filtertype = Filter.LT
+                filtertype = Filter.LT
                 nc = 1
         else:
-            self.filtertype = Filter.EQ
+            filtertype = Filter.EQ
 
-        self.refval = self.parse_value(filter_string[nc:])
+        return [(filtertype, self.parse_value(filter_string[nc:]))]
 
     def parse_value(self, val):
         """ Parse value of defined datatype from given string. """
@@ -87,36 +208,160 @@ class Filter:
             # Support also setting float values as rational numbers
             if (type(val) == type(str())):
                 return float(fractions.Fraction(val))
-        
+
         # This is the default case
         return self.datatype(val)
 
 
+def is_raw_key(field_string):
+    """ Return true if given field is an Exiv2 key of the raw tags instead of a metadata field. """
+    return field_string not in ImageMetadata.TYPES and '.' in field_string
+
+def raw_tag_sql(key, table=None):
+    """ Return SQL expression for the value of given tag in the raw tags of the files table row (see photodb.rawTag). """
+    rowid = table + '.rowid' if table else 'rowid'
+    return "rawtag((SELECT data FROM rawmeta WHERE file_id = %s), '%s')" % (rowid, key.replace("'", "''"))
+
+def area_sql(area, table=None):
+    """ Return SQL condition for the files table rows within given geo area and its parameters: (condition, params).
+        The rows within the bounding boxes of the area are found with the gpsindex R-tree, the exact test is done on those. """
+    prefix = table + '.' if table else ''
+    boxes = area.boxes()
+    index = ' OR '.join('(maxlat >= ? AND minlat <= ? AND maxlon >= ? AND minlon <= ?)' for box in boxes)
+    exact, params = area.to_sql(prefix + 'gpslat', prefix + 'gpslon')
+    return '%srowid IN (SELECT id FROM gpsindex WHERE %s) AND %s' % (prefix, index, exact), sum(boxes, ()) + params
+
+
+class Predicate:
+    """ Compiled ExifFilter: callable metadata -> bool. The filters are tested in the order of their selectivity
+        (the ones rejecting most files first) and the testing stops at the first failing filter. The order is
+        re-estimated from the observed rejection rates every REORDER_INTERVAL calls. """
+
+    REORDER_INTERVAL = 1000
+
+    def __init__(self, filters, areas=()):
+        # Terms: [test, field, number of rejected files in this interval]
+        self.terms = [[f.test, f.userdata, 0] for f in sorted(filters, key=lambda f: f.selectivity())]
+        self.areas = list(areas)
+        self.calls = 0
+        self.raw_keys = set(f.userdata for f in filters if is_raw_key(f.userdata))
+
+    def __call__(self, metadata):
+        get = getattr(metadata, 'data', metadata).get
+        if self.raw_keys:
+            get = self.raw_getter(get, getattr(metadata, 'raw', None) or {})
+        for area in self.areas:
+            if not area.contains(get('gpslat'), get('gpslon')):
+                return False
+        self.calls += 1
+        if self.calls == Predicate.REORDER_INTERVAL:
+            self.reorder()
+
+        for term in self.terms:
+            if not term[0](get(term[1])):
+                term[2] += 1
+                return False
+        return True
+
+    def raw_getter(self, get, raw):
+        """ Return get function for both the metadata fields (given get) and the raw tags. """
+        raw_keys = self.raw_keys
+
+        def get_value(field):
+            if field in raw_keys:
+                return ImageMetadata.tagValue(raw, field)
+            return get(field)
+        return get_value
+
+    def reorder(self):
+        """ Sort the terms by their rejection rate in the last interval. """
+        reached = self.calls
+        rates = dict()
+        for term in self.terms:
+            rates[id(term)] = term[2] / float(reached) if reached else 0.0
+            reached -= term[2]
+            term[2] = 0
+        self.terms.sort(key=lambda term: -rates[id(term)])
+        self.calls = 0
+
+
 class ExifFilter:
     def __init__(self):
         self.filters = []
+        self.areas = []  # geo areas (geo.Circle, geo.Box) the GPS position must be within
+        self.predicate = None
 
     def add_filter(self, field_string, filter_string):
 
         if (filter_string == None):
             return
 
-        datatype = ImageMetadata.TYPES[field_string]
-
-        f = Filter(filter_string, datatype)
+        if is_raw_key(field_string):
+            # The type of the tag is not known, numbers are compared as numbers
+            try:
+                f = Filter(filter_string, float)
+            except ValueError:
+                f = Filter(filter_string, str)
+        else:
+            f = Filter(filter_string, ImageMetadata.TYPES[field_string])
         f.userdata = field_string    # Store the metadata field in the userdata
 
         self.filters.append(f)
+        self.predicate = None
+
+    def add_area(self, area):
+        """ Add a filter passing the files whose GPS position is within given geo area (geo.Circle or geo.Box). """
+        self.areas.append(area)
+        self.predicate = None
 
     def numFilters(self):
-        return len(self.filters)
+        return len(self.filters) + len(self.areas)
+
+    def fields(self):
+        """ Return the metadata fields (and Exiv2 keys) of the filters. """
+        return [f.userdata for f in self.filters] + (['gpslat', 'gpslon'] if self.areas else [])
+
+    def compile(self):
+        """ Return the filters compiled to a Predicate. """
+        if self.predicate == None:
+            self.predicate = Predicate(self.filters, self.areas)
+        return self.predicate
 
     def apply(self, metadata):
-        """ Apply this filter on given data. Return true if pass, false otherwise. """
-        ret = True
+        """ Apply this filter on given data (ImageMetadata or dict). Return true if pass, false otherwise. """
+        return (self.predicate or self.compile())(metadata)
+
+    def to_sql(self, table=None):
+        """ Return all the filters as SQL WHERE-condition and its parameters: (condition, params).
+            The metadata fields are used as column names, qualified with given table name if any (the filters of the
+            raw tags look up the rawmeta row of the files table row, the areas the gpsindex rows). """
+        conditions = []
+        params = []
+        for area in self.areas:
+            condition, aparams = area_sql(area, table)
+            conditions.append(condition)
+            params.extend(aparams)
         for f in self.filters:
-            val = metadata[f.userdata]
-            ret &= f.apply(val)
+            column = f.userdata
+            if is_raw_key(column):
+                column = raw_tag_sql(column, table)
+            elif table:
+                column = table + '.' + column
+            condition, fparams = f.to_sql(column)
+            if len(f.alternatives) > 1 or f.negate:
+                condition = '(%s)' % condition
+            conditions.append(condition)
+            params.extend(fparams)
 
-        return ret
+        if not conditions:
+            return '1', ()
+        return ' AND '.join(conditions), tuple(params)
 
+    def to_mask(self, columns):
+        """ Return all the filters as NumPy boolean mask, columns being a dict of the metadata field -> array.
+            Returns None if there are no filters. """
+        mask = None
+        for f in sorted(self.filters, key=lambda f: f.selectivity()):
+            fmask = f.to_mask(columns[f.userdata])
+            mask = fmask if mask is None else mask & fmask
+        return mask
@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2017 Juuso Räsänen <info@trimap.fi>
+
+"""
+ Fast header-only reader for the metadata fields used by ImageMetadata.
+
+ Reads only the headers of JPEG (APP1 Exif and XMP segments), TIFF based raw files
+ (NEF, CR2, ARW, TIF) and PNG (eXIf, XMP and "Raw profile type exif" chunks) files and
+ decodes the tags of the IFD0, Exif and GPS IFDs and the simple XMP properties with their
+ Exiv2 keys (unknown tags as e.g. Exif.Photo.0xa460). Everything else, including the image
+ data and the big binary tags, is skipped. Raises UnsupportedFormat for files it can't
+ handle, in which case the caller should fall back to pyexiv2.
+
+ readThumbnail() returns the embedded JPEG thumbnail (or preview) of JPEG and TIFF based
+ raw files, e.g. for computing a perceptual hash without decoding the whole image.
+
+ Usage: fastexif.py [-compare] PATH [PATH ...]  (benchmark against pyexiv2)
+
+"""
+
+import os
+import re
+import sys
+import mmap
+import zlib
+import struct
+import datetime
+import binascii
+from fractions import Fraction
+
+import perfstats
+
+
+class UnsupportedFormat(Exception):
+    pass
+
+
+# TIFF tags (of IFD0, Exif IFD and GPS IFD) and their Exiv2 tag names
+IFD0_TAGS = {0x0100: 'ImageWidth', 0x0101: 'ImageLength', 0x0102: 'BitsPerSample', 0x0103: 'Compression',
+             0x0106: 'PhotometricInterpretation', 0x010E: 'ImageDescription', 0x010F: 'Make', 0x0110: 'Model',
+             0x0112: 'Orientation', 0x0115: 'SamplesPerPixel', 0x011A: 'XResolution', 0x011B: 'YResolution',
+             0x0128: 'ResolutionUnit', 0x0131: 'Software', 0x0132: 'DateTime', 0x013B: 'Artist',
+             0x0213: 'YCbCrPositioning', 0x4746: 'Rating', 0x4749: 'RatingPercent', 0x8298: 'Copyright'}
+EXIF_TAGS = {0x829A: 'ExposureTime', 0x829D: 'FNumber', 0x8822: 'ExposureProgram', 0x8827: 'ISOSpeedRatings',
+             0x8830: 'SensitivityType', 0x9000: 'ExifVersion', 0x9003: 'DateTimeOriginal', 0x9004: 'DateTimeDigitized',
+             0x9010: 'OffsetTime', 0x9011: 'OffsetTimeOriginal', 0x9201: 'ShutterSpeedValue', 0x9202: 'ApertureValue',
+             0x9203: 'BrightnessValue', 0x9204: 'ExposureBiasValue', 0x9205: 'MaxApertureValue', 0x9206: 'SubjectDistance',
+             0x9207: 'MeteringMode', 0x9208: 'LightSource', 0x9209: 'Flash', 0x920A: 'FocalLength', 0x9286: 'UserComment',
+             0x9290: 'SubSecTime', 0x9291: 'SubSecTimeOriginal', 0x9292: 'SubSecTimeDigitized', 0xA000: 'FlashpixVersion',
+             0xA001: 'ColorSpace', 0xA002: 'PixelXDimension', 0xA003: 'PixelYDimension', 0xA217: 'SensingMethod',
+             0xA401: 'CustomRendered', 0xA402: 'ExposureMode', 0xA403: 'WhiteBalance', 0xA404: 'DigitalZoomRatio',
+             0xA405: 'FocalLengthIn35mmFilm', 0xA406: 'SceneCaptureType', 0xA407: 'GainControl', 0xA408: 'Contrast',
+             0xA409: 'Saturation', 0xA40A: 'Sharpness', 0xA40C: 'SubjectDistanceRange', 0xA420: 'ImageUniqueID',
+             0xA430: 'CameraOwnerName', 0xA431: 'BodySerialNumber', 0xA432: 'LensSpecification', 0xA433: 'LensMake',
+             0xA434: 'LensModel', 0xA435: 'LensSerialNumber'}
+GPS_TAGS = {0x0000: 'GPSVersionID', 0x0001: 'GPSLatitudeRef', 0x0002: 'GPSLatitude', 0x0003: 'GPSLongitudeRef',
+            0x0004: 'GPSLongitude', 0x0005: 'GPSAltitudeRef', 0x0006: 'GPSAltitude', 0x0007: 'GPSTimeStamp',
+            0x0008: 'GPSSatellites', 0x0009: 'GPSStatus', 0x000A: 'GPSMeasureMode', 0x000B: 'GPSDOP',
+            0x000C: 'GPSSpeedRef', 0x000D: 'GPSSpeed', 0x0010: 'GPSImgDirectionRef', 0x0011: 'GPSImgDirection',
+            0x0012: 'GPSMapDatum', 0x001D: 'GPSDateStamp'}
+TAG_EXIF_IFD = 0x8769
+TAG_GPS_IFD = 0x8825
+TAG_XMP = 0x02BC
+TAG_MAKERNOTE = 0x927C
+TAG_NIKON3_ISOSPEED = 0x0002
+TAG_SUBIFDS = 0x014A
+TAG_JPEG_OFFSET = 0x0201
+TAG_JPEG_LENGTH = 0x0202
+DATETIME_TAGS = set([0x0132, 0x9003, 0x9004])
+
+# Pointers, image data and big binary tags are not decoded
+SKIPPED_TAGS = set([TAG_EXIF_IFD, TAG_GPS_IFD, TAG_XMP, TAG_MAKERNOTE, 0x0111, 0x0117, TAG_SUBIFDS, TAG_JPEG_OFFSET, TAG_JPEG_LENGTH,
+                    0x8773, 0x9C9B, 0x9C9C, 0x9C9D, 0x9C9E, 0x9C9F, 0xA005, 0xC4A5])
+MAX_VALUES = 32  # Tags with more values than this are skipped (e.g. tone curves)
+
+# TIFF field types: (struct format, size)
+TIFF_TYPES = {1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8), 6: ('b', 1), 7: ('s', 1),
+              8: ('h', 2), 9: ('i', 4), 10: ('ii', 8), 11: ('f', 4), 12: ('d', 8), 13: ('I', 4)}
+
+JPEG_EXIF_ID = 'Exif\0\0'
+JPEG_XMP_ID = 'http://ns.adobe.com/xap/1.0/\0'
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+# Simple XMP properties as attributes (prefix:Name="value") or elements (<prefix:Name>value</prefix:Name>)
+XMP_ATTRIBUTE_RE = re.compile(r'\s(\w+):(\w+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+XMP_ELEMENT_RE = re.compile(r'<(\w+):(\w+)(?:\s[^>]*)?>([^<]*)</\1:\2>')
+XMP_SKIPPED_PREFIXES = set(['x', 'rdf', 'xmlns', 'xml'])
+XMP_NUMBER_RE = re.compile(r'^-?\d+(?:\.\d+|/\d+)?$')
+
+MAX_HEADER_SIZE = 16 * 1024 * 1024  # Stop looking for metadata after this many bytes
+
+
+def read(fname):
+    """ Return the metadata of given file as dict of Exiv2 key -> value (like ImageMetadata.getExivField). """
+    with open(fname, 'rb') as f:
+        magic = f.read(8)
+        try:
+            if magic[:2] == '\xff\xd8':
+                fields = _readJpeg(f)
+            elif magic[:4] in ('II*\0', 'MM\0*'):
+                fields = _readTiffFile(f)
+            elif magic == PNG_SIGNATURE:
+                fields = _readPng(f)
+            else:
+                raise UnsupportedFormat('Unsupported file format: %s' % fname)
+        except (UnsupportedFormat, EnvironmentError):
+            raise
+        except Exception, msg:
+            # A structure the decoders don't expect (e.g. a tag of an unusual type), let pyexiv2 read the file
+            perfstats.count('read.decode_errors')
+            raise UnsupportedFormat('Unsupported metadata in %s: %s' % (fname, msg))
+        # Bytes read with file reads (the pages of memory mapped TIFFs are not counted)
+        perfstats.count('read.bytes', f.tell())
+    return fields
+
+
+def readThumbnail(fname):
+    """ Return the embedded JPEG thumbnail of given JPEG or TIFF based raw file (the one of IFD1, or the smallest JPEG
+        preview of the SubIFDs) as a string, or None if there is none or the file format is not supported. """
+    with open(fname, 'rb') as f:
+        magic = f.read(8)
+        if magic[:2] == '\xff\xd8':
+            for data in _jpegApp1Segments(f):
+                if data.startswith(JPEG_EXIF_ID):
+                    return _tiffThumbnail(data, len(JPEG_EXIF_ID))
+        elif magic[:4] in ('II*\0', 'MM\0*'):
+            data = mmap.mmap(f.fileno(), os.fstat(f.fileno()).st_size, access=mmap.ACCESS_READ)
+            try:
+                return _tiffThumbnail(data, 0)
+            finally:
+                data.close()
+    return None
+
+
+def _readJpeg(f):
+    fields = dict()
+    for data in _jpegApp1Segments(f):
+        if data.startswith(JPEG_EXIF_ID):
+            _parseTiff(data, len(JPEG_EXIF_ID), fields)
+        elif data.startswith(JPEG_XMP_ID):
+            _parseXmp(data[len(JPEG_XMP_ID):], fields)
+    return fields
+
+
+def _jpegApp1Segments(f):
+    """ Yield the payloads of the APP1 segments (Exif, XMP) of a JPEG file, skipping the other segments. """
+    f.seek(2)
+    while f.tell() < MAX_HEADER_SIZE:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != '\xff':
+            break
+        if marker[1] in ('\xd8', '\x01') or '\xd0' <= marker[1] <= '\xd7':
+            continue  # Markers without payload
+        if marker[1] in ('\xda', '\xd9'):
+            break  # Start of scan or end of image --> no more metadata
+
+        length, = struct.unpack('>H', f.read(2))
+        if marker[1] != '\xe1':
+            f.seek(length - 2, os.SEEK_CUR)
+            continue
+
+        yield f.read(length - 2)
+
+
+def _readTiffFile(f):
+    fields = dict()
+    size = os.fstat(f.fileno()).st_size
+    # Memory mapped, so that only the pages holding the IFDs are actually read
+    data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    try:
+        _parseTiff(data, 0, fields)
+    finally:
+        data.close()
+    return fields
+
+
+def _readPng(f):
+    fields = dict()
+    while f.tell() < MAX_HEADER_SIZE:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        length, ctype = struct.unpack('>I4s', header)
+        if ctype in ('IDAT', 'IEND'):
+            break
+        if ctype not in ('eXIf', 'iTXt', 'tEXt', 'zTXt'):
+            f.seek(length + 4, os.SEEK_CUR)
+            continue
+
+        data = f.read(length)
+        f.seek(4, os.SEEK_CUR)  # CRC
+        if ctype == 'eXIf':
+            _parseTiff(data, 0, fields)
+            continue
+
+        keyword, _, text = data.partition('\0')
+        if ctype == 'iTXt':
+            # compression flag, compression method, language tag\0, translated keyword\0, text
+            compressed = text[:1] == '\x01'
+            text = text[2:].split('\0', 2)[-1]
+            if compressed:
+                text = zlib.decompress(text)
+        elif ctype == 'zTXt':
+            text = zlib.decompress(text[1:])
+
+        if keyword == 'XML:com.adobe.xmp':
+            _parseXmp(text, fields)
+        elif keyword in ('Raw profile type exif', 'Raw profile type APP1'):
+            # ImageMagick style: "\nexif\n   <length>\n<hex dump>"
+            hexdata = ''.join(text.strip().split('\n')[2:]).replace(' ', '')
+            try:
+                exif = binascii.unhexlify(hexdata)
+            except (TypeError, binascii.Error):
+                continue
+            offset = len(JPEG_EXIF_ID) if exif.startswith(JPEG_EXIF_ID) else 0
+            _parseTiff(exif, offset, fields)
+    return fields
+
+
+def _parseXmp(xmp, fields):
+    """ Decode the simple XMP properties as Xmp.<prefix>.<Name> keys. Numbers (also rationals like 28/10) are
+        converted, other values are kept as strings. """
+    properties = [(m.group(1), m.group(2), m.group(3) if m.group(3) != None else m.group(4)) for m in XMP_ATTRIBUTE_RE.finditer(xmp)]
+    properties.extend(m.groups() for m in XMP_ELEMENT_RE.finditer(xmp))
+    for prefix, name, val in properties:
+        if prefix in XMP_SKIPPED_PREFIXES:
+            continue
+        val = val.strip()
+        if XMP_NUMBER_RE.match(val):
+            if '/' in val:
+                num, den = val.split('/')
+                if int(den) and '.' not in num:
+                    val = Fraction(int(num), int(den))
+            elif '.' in val:
+                val = float(val)
+            else:
+                val = int(val)
+        fields['Xmp.%s.%s' % (prefix, name)] = val
+
+
+def _parseTiff(data, base, fields):
+    """ Decode the supported tags from TIFF structure starting at data[base:] into fields. """
+    if data[base:base + 2] == 'II':
+        endian = '<'
+    elif data[base:base + 2] == 'MM':
+        endian = '>'
+    else:
+        return
+    try:
+        ifd0, = struct.unpack_from(endian + 'I', data, base + 4)
+        tags = _readIfd(data, base, endian, ifd0)
+        _setFields(tags, IFD0_TAGS, 'Exif.Image', fields)
+
+        if TAG_XMP in tags:
+            xmp = tags[TAG_XMP]
+            if isinstance(xmp, list):
+                xmp = ''.join(map(chr, xmp))  # Type BYTE (e.g. DNG), not UNDEFINED
+            _parseXmp(xmp, fields)
+
+        if TAG_EXIF_IFD in tags:
+            exiftags = _readIfd(data, base, endian, tags[TAG_EXIF_IFD][0])
+            _setFields(exiftags, EXIF_TAGS, 'Exif.Photo', fields)
+            if TAG_MAKERNOTE in exiftags:
+                _parseNikonMakernote(exiftags[TAG_MAKERNOTE], fields)
+
+        if TAG_GPS_IFD in tags:
+            _setFields(_readIfd(data, base, endian, tags[TAG_GPS_IFD][0]), GPS_TAGS, 'Exif.GPSInfo', fields)
+    except (struct.error, ValueError, IndexError):
+        # Truncated or corrupted, keep what was found so far
+        perfstats.count('read.decode_errors')
+
+
+def _tiffThumbnail(data, base):
+    """ Return the JPEG thumbnail of TIFF structure starting at data[base:], or None. """
+    endian = {'II': '<', 'MM': '>'}.get(data[base:base + 2])
+    if not endian:
+        return None
+    try:
+        ifd0, = struct.unpack_from(endian + 'I', data, base + 4)
+        tags = _readIfd(data, base, endian, ifd0)
+        ifd1 = _nextIfd(data, base, endian, ifd0)
+        # (length, offset) of the JPEG of IFD1 and of the SubIFDs (the previews of raw files)
+        thumbnail = _jpegLocation(_readIfd(data, base, endian, ifd1)) if ifd1 else None
+        if not thumbnail:
+            previews = [_jpegLocation(_readIfd(data, base, endian, offset)) for offset in tags.get(TAG_SUBIFDS, [])]
+            thumbnail = min([preview for preview in previews if preview] or [None])
+    except (struct.error, ValueError, IndexError):
+        return None
+
+    if not thumbnail:
+        return None
+    length, offset = thumbnail
+    jpeg = data[base + offset:base + offset + length]
+    if not jpeg.startswith('\xff\xd8'):
+        return None
+    return jpeg
+
+def _jpegLocation(tags):
+    if tags.get(TAG_JPEG_OFFSET) and tags.get(TAG_JPEG_LENGTH) and tags[TAG_JPEG_LENGTH][0] > 0:
+        return tags[TAG_JPEG_LENGTH][0], tags[TAG_JPEG_OFFSET][0]
+    return None
+
+
+def _parseNikonMakernote(makernote, fields):
+    # Nikon type 3 makernote: "Nikon\0" + version, and a TIFF structure of its own at offset 10
+    if not makernote.startswith('Nikon\0\x02'):
+        return
+    base = 10
+    endian = '<' if makernote[base:base + 2] == 'II' else '>'
+    ifd, = struct.unpack_from(endian + 'I', makernote, base + 4)
+    iso = _readIfd(makernote, base, endian, ifd).get(TAG_NIKON3_ISOSPEED)
+    if iso and len(iso) == 2 and iso[1]:
+        fields['Exif.Nikon3.ISOSpeed'] = iso[1]
+
+
+def _readIfd(data, base, endian, offset):
+    """ Return the tags of an IFD as dict of tag -> value. Values are strings (ASCII and
+        UNDEFINED types) or lists of numbers (Fractions for rationals). """
+    tags = dict()
+    pos = base + offset
+    count, = struct.unpack_from(endian + 'H', data, pos)
+    pos += 2
+    for i in xrange(count):
+        tag, ftype, n, valueOffset = struct.unpack_from(endian + 'HHI4s', data, pos + 12 * i)
+        if ftype not in TIFF_TYPES:
+            continue
+        fmt, size = TIFF_TYPES[ftype]
+        if size * n <= 4:
+            raw = valueOffset[:size * n]
+        else:
+            start = base + struct.unpack(endian + 'I', valueOffset)[0]
+            raw = data[start:start + size * n]
+            if len(raw) < size * n:
+                continue
+
+        if fmt == 's':
+            tags[tag] = raw
+        else:
+            vals = struct.unpack(endian + fmt * n, raw)
+            if len(fmt) == 2:
+                vals = [Fraction(vals[j], vals[j + 1]) for j in xrange(0, len(vals), 2) if vals[j + 1] != 0]
+            tags[tag] = list(vals)
+    return tags
+
+
+def _nextIfd(data, base, endian, offset):
+    """ Return the offset of the IFD following the one at given offset (0 if none). """
+    count, = struct.unpack_from(endian + 'H', data, base + offset)
+    return struct.unpack_from(endian + 'I', data, base + offset + 2 + 12 * count)[0]
+
+
+def _setFields(tags, names, group, fields):
+    """ Set the decoded tags to fields with keys <group>.<name>. Strings are stripped, binary strings are converted
+        to lists of bytes, a single value is set as such and multiple values as a list. """
+    for tag, val in tags.iteritems():
+        if tag in SKIPPED_TAGS:
+            continue
+        if isinstance(val, str):
+            if tag == 0x9286 and val[:8] in ('ASCII\0\0\0', 'UNICODE\0', '\0' * 8):
+                val = val[8:]  # UserComment: character code and the comment
+            val = val.split('\0', 1)[0].strip()
+            if tag in DATETIME_TAGS:
+                # pyexiv2 returns the dates as datetime objects
+                try:
+                    val = datetime.datetime.strptime(val, '%Y:%m:%d %H:%M:%S')
+                except ValueError:
+                    pass
+            elif val and not _isPrintable(val):
+                if len(val) > MAX_VALUES:
+                    continue
+                val = [ord(ch) for ch in val]
+        elif len(val) == 1:
+            val = val[0]
+        elif not val or len(val) > MAX_VALUES:
+            continue
+        fields['%s.%s' % (group, names.get(tag) or '0x%04x' % tag)] = val
+
+def _isPrintable(val):
+    try:
+        val.decode('utf-8')
+    except UnicodeDecodeError:
+        return False
+    return not any(ch < ' ' for ch in val)
+
+
+def main():
+    import time
+    import ImageMetadata
+
+    args = sys.argv[1:]
+    compare = '-compare' in args
+    paths = [arg for arg in args if arg != '-compare']
+    if not paths:
+        sys.stderr.write('Usage: %s [-compare] PATH [PATH ...]\n' % sys.argv[0])
+        return 1
+
+    import photodb
+    files = list(photodb.PhotoDB.pathsToImageFiles(paths))
+    results = dict()
+    for reader in (['fast', 'exiv2'] if compare else ['fast']):
+        ImageMetadata.ImageMetadata.reader = reader
+        t0 = time.time()
+        results[reader] = [ImageMetadata.ImageMetadata(fname, True).data for fname in files]
+        elapsed = time.time() - t0
+        print '%-6s %d files in %.3f s (%.0f files/s)' % (reader, len(files), elapsed, len(files) / max(elapsed, 1e-9))
+
+    if compare:
+        numDiffering = 0
+        for fname, fast, exiv2 in zip(files, results['fast'], results['exiv2']):
+            if fast != exiv2:
+                numDiffering += 1
+                print '%s\n  fast:  %s\n  exiv2: %s' % (fname, fast, exiv2)
+        print '%d of %d files differ.' % (numDiffering, len(files))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
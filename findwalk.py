@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2017 Juuso Räsänen <info@trimap.fi>
+
+"""
+ In-process replacement for the find-utility used by photofind.
+
+ Walks the directory tree with scandir and yields the matching files while the walk is
+ still running. Supports the most common find tests (-name, -iname, -size, -mtime, -mmin,
+ -newer, -maxdepth, -mindepth). Other find options raise UnsupportedOption, in which case
+ the caller should fall back to the real find-utility.
+
+"""
+
+import os
+import re
+import sys
+import stat
+import time
+import fnmatch
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+class UnsupportedOption(Exception):
+    pass
+
+
+class _Entry:
+    """ Minimal os.DirEntry look-alike for Pythons without scandir. """
+
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+        self._stat = None
+
+    def stat(self, follow_symlinks=True):
+        if self._stat == None:
+            self._stat = os.lstat(self.path)
+        if follow_symlinks and stat.S_ISLNK(self._stat.st_mode):
+            return os.stat(self.path)
+        return self._stat
+
+    def is_dir(self, follow_symlinks=True):
+        if follow_symlinks and self.is_symlink():
+            return os.path.isdir(self.path)
+        return stat.S_ISDIR(self.stat().st_mode)
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self.stat().st_mode)
+
+
+def listdir(path):
+    """ Return the entries of given directory as (os.)DirEntry-like objects. """
+    if scandir:
+        return scandir(path)
+    return [_Entry(path, name) for name in os.listdir(path)]
+
+
+SIZE_UNITS = {'b': 512, 'c': 1, 'w': 2, 'k': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+def _compare(sign, val, ref):
+    """ Compare like find does for numeric arguments: +n (more than), -n (less than), n (exactly). """
+    if sign == '+':
+        return val > ref
+    if sign == '-':
+        return val < ref
+    return val == ref
+
+
+class Walker:
+    """ Directory walker implementing a subset of the find-utility tests. All tests must pass (AND). """
+
+    def __init__(self, find_args=(), extensions=None):
+        self.tests = []  # Callables (name, st) -> bool
+        self.maxdepth = None
+        self.mindepth = 0
+        self.now = time.time()
+
+        if extensions:
+            self.add_extension_test(extensions)
+        self.parse_args(find_args)
+
+    def add_extension_test(self, extensions):
+        """ Equivalent of \\( -iname "*.ext1" -or -iname "*.ext2" ... \\) """
+        suffixes = tuple('.' + ext.lower() for ext in extensions)
+        self.tests.append(lambda name, st: name.lower().endswith(suffixes))
+
+    def parse_args(self, args):
+        args = list(args)
+        while args:
+            opt = args.pop(0)
+            if opt in ('-name', '-iname', '-size', '-mtime', '-mmin', '-newer', '-maxdepth', '-mindepth'):
+                if not args:
+                    raise UnsupportedOption('Missing argument to %s' % opt)
+                arg = args.pop(0)
+            else:
+                raise UnsupportedOption(opt)
+
+            if opt == '-name':
+                self.tests.append(lambda name, st, pattern=arg: fnmatch.fnmatchcase(name, pattern))
+            elif opt == '-iname':
+                self.tests.append(lambda name, st, pattern=arg.lower(): fnmatch.fnmatchcase(name.lower(), pattern))
+            elif opt == '-size':
+                m = re.match(r'^([+-]?)(\d+)([bcwkMG]?)$', arg)
+                if not m:
+                    raise UnsupportedOption('%s %s' % (opt, arg))
+                unit = SIZE_UNITS[m.group(3) or 'b']
+                # find rounds the size up to the next full unit
+                self.tests.append(lambda name, st, sign=m.group(1), n=int(m.group(2)), unit=unit: _compare(sign, (st.st_size + unit - 1) // unit, n))
+            elif opt in ('-mtime', '-mmin'):
+                m = re.match(r'^([+-]?)(\d+)$', arg)
+                if not m:
+                    raise UnsupportedOption('%s %s' % (opt, arg))
+                period = 86400 if opt == '-mtime' else 60
+                self.tests.append(lambda name, st, sign=m.group(1), n=int(m.group(2)), period=period: _compare(sign, int((self.now - st.st_mtime) // period), n))
+            elif opt == '-newer':
+                try:
+                    refmtime = os.stat(arg).st_mtime
+                except OSError:
+                    # Let find report the problem
+                    raise UnsupportedOption('%s %s' % (opt, arg))
+                self.tests.append(lambda name, st, refmtime=refmtime: st.st_mtime > refmtime)
+            else:
+                if not arg.isdigit():
+                    raise UnsupportedOption('%s %s' % (opt, arg))
+                if opt == '-maxdepth':
+                    self.maxdepth = int(arg)
+                else:
+                    self.mindepth = int(arg)
+
+    def matches(self, name, st, depth):
+        if depth < self.mindepth:
+            return False
+        for test in self.tests:
+            if not test(name, st):
+                return False
+        return True
+
+    def walk(self, path):
+        """ Yield (path, st) for the matching files under given path (in the same order as find),
+            where st is the os.lstat result of the file. """
+        try:
+            st = os.lstat(path)
+        except OSError, msg:
+            sys.stderr.write('Error: %s\n' % msg)
+            return
+
+        if self.matches(os.path.basename(path.rstrip('/')) or path, st, 0):
+            yield path, st
+        if not stat.S_ISDIR(st.st_mode) or self.maxdepth == 0:
+            return
+
+        # Depth-first, each directory is listed right after it was found (like find does)
+        stack = [(self._list(path), 1)]
+        while stack:
+            entries, depth = stack[-1]
+            entry = next(entries, None)
+            if entry == None:
+                stack.pop()
+                continue
+
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError, msg:
+                sys.stderr.write('Error: %s\n' % msg)
+                continue
+
+            if self.matches(entry.name, st, depth):
+                yield entry.path, st
+            if stat.S_ISDIR(st.st_mode) and (self.maxdepth == None or depth < self.maxdepth):
+                stack.append((self._list(entry.path), depth + 1))
+
+    @staticmethod
+    def _list(path):
+        try:
+            return iter(listdir(path))
+        except OSError, msg:
+            sys.stderr.write('Error: %s\n' % msg)
+            return iter(())
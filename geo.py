@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2017 Juuso Räsänen <info@trimap.fi>
+
+"""
+ Geographic areas for finding the photos by their GPS position (photofind -near and -bbox).
+
+ The positions are stored in decimal degrees in the gpslat and gpslon columns of the files
+ table and indexed in the gpsindex R-tree (see photodb migration 8). An area is queried in
+ two steps: the R-tree finds the photos inside the bounding boxes of the area and only those
+ are tested exactly (by the great-circle distance for a Circle). The boxes are split at the
+ 180th meridian, as the longitudes of the index go from -180 to 180.
+
+"""
+
+import math
+import re
+
+EARTH_RADIUS = 6371.0088  # Mean radius of the Earth in km
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """ Return the great-circle distance of two points in km (haversine formula), None if any coordinate is None.
+        Also the SQL function geodistance(lat1, lon1, lat2, lon2) (see photodb.PhotoDB.load). """
+    if lat1 is None or lon1 is None or lat2 is None or lon2 is None:
+        return None
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+def splitLongitudes(west, east):
+    """ Return the longitude range from west to east (east of west, either may be beyond +-180) as list of ranges
+        (west, east) within -180...180: one range, or two if it crosses the 180th meridian. """
+    if east - west >= 360:
+        return [(-180.0, 180.0)]
+    if west < -180:
+        west += 360
+    if east > 180:
+        east -= 360
+    if west <= east:
+        return [(west, east)]
+    return [(west, 180.0), (-180.0, east)]
+
+def parseNumbers(string, count):
+    """ Parse given number of comma separated numbers. Raises ValueError. """
+    numbers = [float(part) for part in string.split(',')]
+    if len(numbers) != count:
+        raise ValueError('expected %d comma separated numbers' % count)
+    return numbers
+
+def parseNear(string):
+    """ Parse 'LAT,LON,RADIUS' (radius in km, or with a unit: 500m, 2km) to a Circle. Raises ValueError. """
+    parts = string.split(',')
+    match = re.match(r'^\s*([0-9.eE+-]+)\s*(km|m)?\s*$', parts[-1])
+    if len(parts) != 3 or not match:
+        raise ValueError('expected LAT,LON,RADIUS')
+    lat, lon = parts[:2]
+    radius = float(match.group(1)) / (1000 if match.group(2) == 'm' else 1)
+    return Circle(float(lat), float(lon), radius)
+
+def parseBbox(string):
+    """ Parse 'SOUTH,WEST,NORTH,EAST' to a Box. Raises ValueError. """
+    return Box(*parseNumbers(string, 4))
+
+def _checkLatLon(lat, lon):
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError('latitude must be within -90...90 and longitude within -180...180')
+
+
+class Circle:
+    """ The points within given distance (km) of a point. """
+
+    def __init__(self, lat, lon, radius):
+        _checkLatLon(lat, lon)
+        if radius < 0:
+            raise ValueError('radius must not be negative')
+        self.lat = lat
+        self.lon = lon
+        self.radius = radius
+
+    def boxes(self):
+        """ Return the bounding boxes of this circle as list of (south, north, west, east). """
+        angle = self.radius / EARTH_RADIUS  # Angular radius
+        south = math.degrees(math.radians(self.lat) - angle)
+        north = math.degrees(math.radians(self.lat) + angle)
+        if south <= -90 or north >= 90:
+            # A pole is within the circle: all the longitudes
+            return [(max(south, -90.0), min(north, 90.0), -180.0, 180.0)]
+        # The meridians touching the circle (on a sphere)
+        dlon = math.degrees(math.asin(min(1.0, math.sin(angle) / math.cos(math.radians(self.lat)))))
+        return [(south, north, west, east) for west, east in splitLongitudes(self.lon - dlon, self.lon + dlon)]
+
+    def contains(self, lat, lon):
+        dist = distance(self.lat, self.lon, lat, lon)
+        return dist is not None and dist <= self.radius
+
+    def to_sql(self, latColumn, lonColumn):
+        """ Return the exact test as SQL condition and its parameters: (condition, params). """
+        return 'geodistance(%s, %s, ?, ?) <= ?' % (latColumn, lonColumn), (self.lat, self.lon, self.radius)
+
+
+class Box:
+    """ The points within a latitude and longitude range. The box crosses the 180th meridian if west > east. """
+
+    def __init__(self, south, west, north, east):
+        _checkLatLon(south, west)
+        _checkLatLon(north, east)
+        if south > north:
+            raise ValueError('the south edge must not be north of the north edge')
+        self.south = south
+        self.west = west
+        self.north = north
+        self.east = east
+
+    def boxes(self):
+        """ Return the box as list of (south, north, west, east), split in two if it crosses the 180th meridian. """
+        east = self.east if self.west <= self.east else self.east + 360
+        return [(self.south, self.north, west, east) for west, east in splitLongitudes(self.west, east)]
+
+    def contains(self, lat, lon):
+        if lat is None or lon is None or not self.south <= lat <= self.north:
+            return False
+        return any(west <= lon <= east for south, north, west, east in self.boxes())
+
+    def to_sql(self, latColumn, lonColumn):
+        """ Return the exact test as SQL condition and its parameters: (condition, params). """
+        boxes = self.boxes()
+        condition = '%s BETWEEN ? AND ? AND (%s)' % (latColumn, ' OR '.join('%s BETWEEN ? AND ?' % lonColumn for box in boxes))
+        return condition, (self.south, self.north) + tuple(lon for box in boxes for lon in box[2:])
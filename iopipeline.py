@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2017 Juuso Räsänen <info@trimap.fi>
+
+"""
+ Bounded thread pipeline for overlapping blocking file system calls (stat, listdir, small
+ reads) on high-latency file systems like NFS or SMB, where each call is a round trip.
+
+ orderedMap() runs a function over the items of an iterable in a pool of threads and yields
+ the results in the order of the items. At most maxPending calls are in flight at once and
+ the items are consumed only as fast as the results are used (back-pressure), so a slow
+ consumer like the database writer never lets the queue grow without bound. Prefetcher
+ starts calls ahead of time for keys that will be asked for later.
+
+ Without a pool (threads <= 1) the functions are called in the caller's thread, in order.
+
+ Usage:
+     pool = iopipeline.newPool(16)
+     for fname, st in iopipeline.orderedMap(statFile, fnames, pool):
+         ...
+     iopipeline.closePool(pool)
+
+"""
+
+import collections
+from multiprocessing.pool import ThreadPool
+
+
+def newPool(threads):
+    """ Return a thread pool of given size for orderedMap() and Prefetcher, or None if threads <= 1. """
+    if threads <= 1:
+        return None
+    pool = ThreadPool(threads)
+    pool.maxPending = 4 * threads
+    return pool
+
+def closePool(pool):
+    if pool:
+        pool.terminate()
+        pool.join()
+
+
+def orderedMap(func, items, pool=None, maxPending=None):
+    """ Yield func(item) for the items in their order, calling func in the pool (if any) for up to maxPending
+        items (default 4 x the number of threads) ahead. An exception raised by func is raised here when its
+        result is reached. """
+    if pool == None:
+        for item in items:
+            yield func(item)
+        return
+
+    maxPending = maxPending or pool.maxPending
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= maxPending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+class Prefetcher:
+    """ Calls func(key, *args) in the pool before the result is needed: prefetch() starts the call (if there
+        is room, at most maxPending calls are in flight) and get() returns the result, calling func now if
+        it was not started. Without a pool the calls are made in get(). """
+
+    def __init__(self, func, pool=None, maxPending=None):
+        self.func = func
+        self.pool = pool
+        self.maxPending = maxPending or (pool.maxPending if pool else 0)
+        self.pending = dict()  # key -> AsyncResult
+
+    def prefetch(self, key, *args):
+        if self.pool == None or key in self.pending or len(self.pending) >= self.maxPending:
+            return
+        self.pending[key] = self.pool.apply_async(self.func, (key,) + args)
+
+    def get(self, key, *args):
+        res = self.pending.pop(key, None)
+        if res == None:
+            return self.func(key, *args)
+        return res.get()
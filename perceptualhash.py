@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2017 Juuso Räsänen <info@trimap.fi>
+
+"""
+ Perceptual hashes of the photos for finding near-duplicates and bursts.
+
+ The hash is a 64-bit difference hash (dHash) of the image shrunk to 9x8 gray pixels: each
+ bit tells whether a pixel is brighter than its right neighbour, so resizing, recompression
+ and small edits flip only a few bits. The Hamming distance of two hashes (0-64) measures
+ how different the photos look; near-duplicates are typically within 8. The embedded EXIF
+ thumbnail is hashed where available (see fastexif.readThumbnail), so that the big raw files
+ don't need to be decoded, and black borders (letterboxed thumbnails) are cropped first.
+
+ Similar hashes are found with a multi-index: the hash is split to four 16-bit chunks, and
+ two hashes within distance d have at least one chunk within d // 4 bits of each other
+ (pigeonhole), so only the hashes with such chunks need to be compared. The database has
+ an index on each chunk (see photodb.PhotoDB.similarFiles), clusters() does the same in
+ memory for grouping the near-duplicates of many files.
+
+ The hashes are stored as signed 64-bit integers (SQLite integers). Requires PIL (Pillow)
+ for decoding the images, optional for the rest of photofind.
+
+"""
+
+import io
+import collections
+from itertools import combinations
+
+import fastexif
+
+# Imported on the first use (see importImage), only the updates and photofind -similar decode images
+Image = None
+_imageTried = False
+
+HASH_SIZE = 8  # Hash of HASH_SIZE x HASH_SIZE bits
+CHUNKS = 4
+CHUNK_BITS = 64 // CHUNKS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+BORDER_LEVEL = 16  # Rows and columns darker than this at the edges are cropped
+MAX_LOOKUPS = 5000  # Max chunk values looked up per chunk, beyond this all the hashes are compared
+SIMILAR_MAXDIST = 8  # Default max distance for photofind -similar
+DUPES_MAXDIST = 4  # Default max distance for photodb -dupes
+
+
+def importImage():
+    """ Import PIL.Image on the first call and return it, or None if PIL is not installed. """
+    global Image, _imageTried
+    if not _imageTried:
+        _imageTried = True
+        try:
+            from PIL import Image
+        except ImportError:
+            Image = None
+    return Image
+
+def imageHash(fname):
+    """ Return the perceptual hash of given image file (of its embedded thumbnail if it has one), or None if the file
+        can't be decoded (or PIL is not installed). """
+    if importImage() == None:
+        return None
+    try:
+        thumbnail = fastexif.readThumbnail(fname)
+        img = Image.open(io.BytesIO(thumbnail) if thumbnail else fname)
+        if img.format == 'JPEG':
+            # Decode at 1/2 ... 1/8 scale, which is much faster for big images
+            img.draft('L', (4 * HASH_SIZE, 4 * HASH_SIZE))
+        return dhash(img)
+    except (IOError, OSError, ValueError, SyntaxError):
+        return None
+
+def dhash(img):
+    """ Return the difference hash of given PIL image. """
+    img = img.convert('L')
+    bbox = img.point(lambda level: 255 if level >= BORDER_LEVEL else 0).getbbox()
+    if bbox and bbox != (0, 0) + img.size:
+        img = img.crop(bbox)
+    pixels = list(img.resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR).getdata())
+    h = 0
+    for row in xrange(HASH_SIZE):
+        for col in xrange(HASH_SIZE):
+            offset = row * (HASH_SIZE + 1) + col
+            h = (h << 1) | (pixels[offset] < pixels[offset + 1])
+    return toSigned(h)
+
+def toSigned(h):
+    return h - (1 << 64) if h >= (1 << 63) else h
+
+def distance(a, b):
+    """ Return the Hamming distance of two hashes. """
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count('1')
+
+def chunk(h, i):
+    """ Return the i'th 16-bit chunk of a hash (like the SQL expression (h >> 16 * i) & 65535). """
+    return (h >> (CHUNK_BITS * i)) & CHUNK_MASK
+
+def chunkVariants(value, maxBits):
+    """ Return the chunk values within maxBits bits of given chunk value (including itself). """
+    variants = [value]
+    for numBits in xrange(1, maxBits + 1):
+        for bits in combinations(xrange(CHUNK_BITS), numBits):
+            variant = value
+            for bit in bits:
+                variant ^= 1 << bit
+            variants.append(variant)
+    return variants
+
+def numVariants(maxBits):
+    """ Return the number of chunk values within maxBits bits of a chunk value. """
+    count, term = 1, 1
+    for k in xrange(1, maxBits + 1):
+        term = term * (CHUNK_BITS - k + 1) // k
+        count += term
+    return count
+
+
+def clusters(items, maxdist):
+    """ Group (key, hash) items to clusters of near-duplicates: items within maxdist of each other (directly or
+        through other items) are in the same cluster. Returns the clusters of two or more items as lists of
+        keys, the biggest first. """
+    items = list(items)
+    byHash = collections.defaultdict(list)
+    for key, h in items:
+        byHash[h].append(key)
+    hashes = byHash.keys()
+
+    # Union-find over the distinct hashes
+    parent = dict((h, h) for h in hashes)
+
+    def root(h):
+        while parent[h] != h:
+            parent[h] = parent[parent[h]]
+            h = parent[h]
+        return h
+
+    maxBits = maxdist // CHUNKS
+    if numVariants(maxBits) > MAX_LOOKUPS:
+        pairs = combinations(hashes, 2)
+    else:
+        pairs = _candidatePairs(hashes, maxBits)
+    for a, b in pairs:
+        if distance(a, b) <= maxdist:
+            ra, rb = root(a), root(b)
+            if ra != rb:
+                parent[ra] = rb
+
+    groups = collections.defaultdict(list)
+    for h in hashes:
+        groups[root(h)].extend(byHash[h])
+    return sorted((sorted(keys) for keys in groups.itervalues() if len(keys) > 1), key=lambda keys: (-len(keys), keys))
+
+def _candidatePairs(hashes, maxBits):
+    """ Yield the pairs of hashes having a chunk within maxBits of each other (each pair at most once per chunk). """
+    for i in xrange(CHUNKS):
+        buckets = collections.defaultdict(list)
+        for h in hashes:
+            buckets[chunk(h, i)].append(h)
+        for value, bucket in buckets.iteritems():
+            for a, b in combinations(bucket, 2):
+                yield a, b
+            for variant in chunkVariants(value, maxBits)[1:]:
+                if variant > value and variant in buckets:
+                    for a in bucket:
+                        for b in buckets[variant]:
+                            yield a, b
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2017 Juuso Räsänen <info@trimap.fi>
+
+"""
+ Per-phase timing and counters for finding out where the time of a run goes.
+
+ Disabled by default: phase() then returns a shared no-op context manager and count()
+ returns immediately, so the instrumentation points cost about one function call each.
+ The data collected in worker processes is passed to the parent with take() and merge().
+
+ Usage:
+     perfstats.enable()
+     with perfstats.phase('db.query'):
+         ...
+     perfstats.count('cache.hit', n)
+     files = perfstats.timedIter('walk', files)  # Time spent producing the items
+     perfstats.report()  # Summary to stderr
+
+"""
+
+import os
+import sys
+import json
+import time
+import collections
+
+enabled = False
+
+_phases = dict()  # name -> [calls, wall time, cpu time]
+_counters = collections.Counter()
+_start = None  # (wall, cpu) when enabled
+
+
+def _cpu():
+    t = os.times()
+    return t[0] + t[1]
+
+
+class _Phase:
+    __slots__ = ('name', 'wall', 'cpu')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.cpu = _cpu()
+
+    def __exit__(self, *exc):
+        _add(self.name, 1, time.time() - self.wall, _cpu() - self.cpu)
+
+
+class _NoPhase:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+_NO_PHASE = _NoPhase()
+
+
+def enable():
+    global enabled, _start
+    enabled = True
+    _start = (time.time(), _cpu())
+
+
+def phase(name):
+    """ Return a context manager timing its block as given phase. """
+    if not enabled:
+        return _NO_PHASE
+    return _Phase(name)
+
+
+def count(name, n=1):
+    """ Increment given counter. """
+    if enabled:
+        _counters[name] += n
+
+
+def timedIter(name, iterable):
+    """ Return an iterator over given iterable, timing the production of each item as given phase. """
+    if not enabled:
+        return iterable
+    return _timedIter(name, iter(iterable))
+
+def _timedIter(name, it):
+    while True:
+        wall = time.time()
+        cpu = _cpu()
+        try:
+            item = next(it)
+        except StopIteration:
+            _add(name, 0, time.time() - wall, _cpu() - cpu)
+            return
+        _add(name, 1, time.time() - wall, _cpu() - cpu)
+        yield item
+
+
+def _add(name, calls, wall, cpu):
+    vals = _phases.get(name)
+    if vals == None:
+        vals = _phases[name] = [0, 0.0, 0.0]
+    vals[0] += calls
+    vals[1] += wall
+    vals[2] += cpu
+
+
+def take():
+    """ Return the data collected so far (picklable) and reset it. For passing the data of worker processes to the parent. """
+    data = (dict(_phases), dict(_counters))
+    _phases.clear()
+    _counters.clear()
+    return data
+
+def merge(data):
+    """ Add the data returned by take() (in another process) to the data of this process. """
+    phases, counters = data
+    for name, (calls, wall, cpu) in phases.iteritems():
+        _add(name, calls, wall, cpu)
+    _counters.update(counters)
+
+
+def toDict():
+    """ Return the collected data as a dict (for JSON). The phase times of worker processes are included in the phases
+        but not in the total, so the phases may add up to more than the total. """
+    ret = dict(phases=dict((name, dict(calls=calls, wall=wall, cpu=cpu)) for name, (calls, wall, cpu) in _phases.iteritems()),
+               counters=dict(_counters))
+    if _start:
+        ret['total'] = dict(wall=time.time() - _start[0], cpu=_cpu() - _start[1])
+    return ret
+
+def report(out=None):
+    """ Print a summary of the collected data (to stderr by default). """
+    out = out or sys.stderr
+    data = toDict()
+    out.write('\n%-24s %10s %10s %10s\n' % ('Phase', 'Calls', 'Wall s', 'CPU s'))
+    for name, vals in sorted(data['phases'].iteritems(), key=lambda item: -item[1]['wall']):
+        out.write('%-24s %10d %10.3f %10.3f\n' % (name, vals['calls'], vals['wall'], vals['cpu']))
+    if 'total' in data:
+        out.write('%-24s %10s %10.3f %10.3f\n' % ('Total', '', data['total']['wall'], data['total']['cpu']))
+    if data['counters']:
+        out.write('\n%-24s %10s\n' % ('Counter', 'Value'))
+        for name, val in sorted(data['counters'].iteritems()):
+            out.write('%-24s %10d\n' % (name, val))
+
+def writeJson(fname):
+    with open(fname, 'w') as f:
+        json.dump(toDict(), f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def startProfile():
+    """ Start profiling this run with cProfile. Returns the profiler for stopProfile(). """
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def stopProfile(profiler, fname):
+    """ Stop the profiler and write its data to given file (view it with: python -m pstats FILE). """
+    profiler.disable()
+    profiler.dump_stats(fname)
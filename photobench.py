@@ -0,0 +1,420 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2017 Juuso Räsänen <info@trimap.fi>
+
+"""
+photobench Benchmarks for photodb and photofind.
+
+ Generates a reproducible synthetic photo tree (small JPEG, PNG and TIFF/NEF files with
+ varied EXIF values) and times the typical operations on it. The results are written as
+ JSON, so that they can be compared between commits.
+
+ Usage: photobench.py -generate DIR [-n FILES] [-seed SEED]
+        photobench.py -run DIR [-out RESULTS.json]
+        photobench.py -filters [-n RECORDS]  (per-record cost of the metadata filters)
+        photobench.py -latency MS DIR [-threads 1,4,16]  (photodb -update/-check on a slow file system)
+        photobench.py -compare OLD.json NEW.json
+
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import random
+import shutil
+import argparse
+import platform
+import __builtin__
+import tempfile
+import subprocess
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Typical photofind filter queries (arguments after the path)
+QUERIES = [['-iso=+800'],
+           ['-iso=+1600', '-fl=+=200'],
+           ['-rating=5'],
+           ['-ot=+2015', '-f=-4'],
+           ['-fl=+=100', '-iname', 'IMG_00*'],
+           ['-near=60.17,24.94,20'],
+           ['-bbox=40,-80,45,-70', '-iso=+400']]
+
+# Centers of the GPS positions of the synthetic photos (Helsinki, Paris, New York, Sydney)
+PLACES = [(60.17, 24.94), (48.86, 2.35), (40.71, -74.01), (-33.87, 151.21)]
+
+# Filter sets for the -filters microbenchmark: (metadata field, filter string) pairs
+FILTER_SETS = [[('iso', '+800')],
+               [('iso', '+800'), ('flength', '+=200'), ('aperture', '-4'), ('rating', '5')],
+               [('rating', '5'), ('origtime', '+2012'), ('exposure', '-=1/100')],
+               [('iso', '400..1600'), ('flength', '-=35,+=200')],
+               [('iso', '!100,200'), ('rating', '!')]]
+
+
+#########################################################
+# Synthetic image files
+#########################################################
+
+def tiffData(endian, ifd0, exif, makernote=None, gps=None):
+    """ Return TIFF structure with given IFD0, Exif IFD and GPS IFD (optional) entries: lists of (tag, type, values).
+        Supported types: 1 (BYTE), 2 (ASCII, value is a string), 3 (SHORT), 4 (LONG), 5 (RATIONAL, (num, den) pairs). """
+    def ifd(entries, start):
+        size = 2 + 12 * len(entries) + 4
+        out = struct.pack(endian + 'H', len(entries))
+        data = ''
+        for tag, ftype, vals in sorted(entries):
+            if ftype in (2, 7):
+                raw = vals + ('\0' if ftype == 2 else '')
+                count = len(raw)
+            elif ftype == 5:
+                raw = ''.join(struct.pack(endian + 'II', num, den) for num, den in vals)
+                count = len(vals)
+            else:
+                raw = ''.join(struct.pack(endian + {1: 'B', 3: 'H', 4: 'I'}[ftype], val) for val in vals)
+                count = len(vals)
+
+            if len(raw) <= 4:
+                out += struct.pack(endian + 'HHI', tag, ftype, count) + raw.ljust(4, '\0')
+            else:
+                out += struct.pack(endian + 'HHII', tag, ftype, count, start + size + len(data))
+                data += raw + '\0' * (len(raw) % 2)
+        return out + struct.pack(endian + 'I', 0) + data
+
+    header = ('II*\0' if endian == '<' else 'MM\0*') + struct.pack(endian + 'I', 8)
+    ifd0 = ifd0 + [(0x8769, 4, [0])] + ([(0x8825, 4, [0])] if gps else [])
+    exifOffset = 8 + len(ifd(ifd0, 8))
+    if makernote:
+        exif = exif + [(0x927C, 7, makernote)]
+    gpsOffset = exifOffset + len(ifd(exif, exifOffset))
+    ifd0 = [(tag, ftype, {0x8769: [exifOffset], 0x8825: [gpsOffset]}.get(tag, vals)) for tag, ftype, vals in ifd0]
+    return header + ifd(ifd0, 8) + ifd(exif, exifOffset) + (ifd(gps, gpsOffset) if gps else '')
+
+def gpsEntries(lat, lon, alt):
+    """ Return the GPS IFD entries of given position (decimal degrees and meters). """
+    def dms(degrees):
+        degrees = abs(degrees)
+        minutes = (degrees - int(degrees)) * 60
+        return [(int(degrees), 1), (int(minutes), 1), (int(round((minutes - int(minutes)) * 6000)), 100)]
+    return [(0x0001, 2, 'N' if lat >= 0 else 'S'), (0x0002, 5, dms(lat)),
+            (0x0003, 2, 'E' if lon >= 0 else 'W'), (0x0004, 5, dms(lon)),
+            (0x0005, 1, [0 if alt >= 0 else 1]), (0x0006, 5, [(int(abs(alt) * 10), 10)])]
+
+def nikonMakernote(iso):
+    tiff = 'II*\0' + struct.pack('<IHHHIHHI', 8, 1, 0x0002, 3, 2, 0, iso, 0)
+    return 'Nikon\0\x02\x10\0\0' + tiff
+
+def xmpPacket(rating):
+    return ('<?xpacket begin="" id="W5M0MpCehiHzreSzNTczkc9d"?><x:xmpmeta xmlns:x="adobe:ns:meta/">'
+            '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"><rdf:Description rdf:about="" '
+            'xmlns:xmp="http://ns.adobe.com/xap/1.0/" xmp:Rating="%d"/></rdf:RDF></x:xmpmeta><?xpacket end="w"?>' % rating)
+
+def jpegData(tiff, xmp=None):
+    out = '\xff\xd8'
+    segments = ['Exif\0\0' + tiff]
+    if xmp:
+        segments.append('http://ns.adobe.com/xap/1.0/\0' + xmp)
+    for seg in segments:
+        out += '\xff\xe1' + struct.pack('>H', len(seg) + 2) + seg
+    # Minimal scan (not a decodable image, the metadata readers don't care)
+    return out + '\xff\xda\x00\x02\xff\xd9'
+
+def pngData(tiff, xmp=None):
+    def chunk(ctype, data):
+        return struct.pack('>I', len(data)) + ctype + data + struct.pack('>I', zlib.crc32(ctype + data) & 0xffffffff)
+    out = '\x89PNG\r\n\x1a\n' + chunk('IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 0, 0, 0, 0)) + chunk('eXIf', tiff)
+    if xmp:
+        out += chunk('iTXt', 'XML:com.adobe.xmp\0\0\0\0\0' + xmp)
+    return out + chunk('IDAT', zlib.compress('\0\0')) + chunk('IEND', '')
+
+def randomImage(rnd, ext, year):
+    """ Return the contents of a synthetic image file with random EXIF values. """
+    iso = rnd.choice([100, 200, 400, 800, 1600, 3200, 6400])
+    date = '%04d:%02d:%02d %02d:%02d:%02d' % (year, rnd.randint(1, 12), rnd.randint(1, 28), rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59))
+    flength = rnd.choice([12, 18, 24, 35, 50, 85, 105, 135, 200, 300, 400])
+    ifd0 = [(0x010E, 2, 'Synthetic photo %d' % rnd.randint(0, 10 ** 6))]
+    exif = [(0x829A, 5, [(1, rnd.choice([4000, 1000, 250, 125, 60, 15, 1]))]),
+            (0x829D, 5, [(rnd.choice([14, 18, 28, 40, 56, 80, 110, 160]), 10)]),
+            (0x9003, 2, date),
+            (0x920A, 5, [(flength * 10, 10)]),
+            (0xA405, 3, [int(flength * 1.5)])]
+
+    makernote = None
+    if ext == 'nef':
+        makernote = nikonMakernote(iso)
+    else:
+        exif.append((0x8827, 3, [iso]))
+    xmp = xmpPacket(rnd.randint(0, 5)) if rnd.random() < 0.7 else None
+    gps = None
+    if rnd.random() < 0.6:
+        lat, lon = rnd.choice(PLACES)
+        gps = gpsEntries(lat + rnd.gauss(0, 0.3), lon + rnd.gauss(0, 0.5), rnd.uniform(-10, 500))
+
+    tiff = tiffData(rnd.choice('<>'), ifd0, exif, makernote, gps)
+    if ext == 'jpg':
+        return jpegData(tiff, xmp)
+    elif ext == 'png':
+        return pngData(tiff, xmp)
+    return tiff
+
+def generate(root, numFiles, seed=1, fileSize=24 * 1024, filesPerDir=200):
+    """ Generate a reproducible tree of numFiles synthetic photos under root. The files are padded (sparsely)
+        to fileSize bytes, so that they pass photofind's default '-size +20k' test. Every tenth directory also
+        has a hidden subdirectory (ignored by photodb, but not by find) with some of the files. """
+    rnd = random.Random(seed)
+    for i in xrange(numFiles):
+        year = 2005 + (i // filesPerDir) % 13
+        dirpath = os.path.join(root, str(year), 'dir%05d' % (i // filesPerDir))
+        if i % filesPerDir == 0:
+            os.makedirs(dirpath)
+            if (i // filesPerDir) % 10 == 0:
+                os.makedirs(os.path.join(dirpath, '.hidden'))
+        if (i // filesPerDir) % 10 == 0 and i % 20 == 0:
+            dirpath = os.path.join(dirpath, '.hidden')
+
+        r = rnd.random()
+        ext = 'nef' if r < 0.05 else 'png' if r < 0.1 else 'jpg'
+        fname = os.path.join(dirpath, 'IMG_%07d.%s' % (i, ext))
+        with open(fname, 'wb') as f:
+            f.write(randomImage(rnd, ext, year))
+            f.truncate(max(fileSize, f.tell()))
+    return root
+
+
+#########################################################
+# Benchmarks
+#########################################################
+
+def timeCommand(cmd, repeat=1):
+    """ Run given command 'repeat' times. Return dict with the wall times and the number of output lines. """
+    times = []
+    lines = 0
+    devnull = open(os.devnull, 'w')
+    for i in xrange(repeat):
+        t0 = time.time()
+        out = subprocess.check_output(cmd, stderr=devnull)
+        times.append(time.time() - t0)
+        lines = out.count('\n')
+    return dict(seconds=times, best=min(times), lines=lines)
+
+def run(root, repeat=3, reader='fast', jobs=1):
+    """ Time the operations on the tree under root. Return the results as dict. """
+    python = sys.executable
+    photodb = [python, os.path.join(SCRIPT_DIR, 'photodb.py')]
+    photofind = [python, os.path.join(SCRIPT_DIR, 'photofind.py')]
+
+    tmpdir = tempfile.mkdtemp(prefix='photobench')
+    dbfile = os.path.join(tmpdir, 'bench.db')
+    update = photodb + ['-dbfile', dbfile, '-update', '-reader', reader, '-jobs', str(jobs), root]
+    results = []
+    try:
+        results.append(('index (cold)', timeCommand(update)))
+        results.append(('re-index (warm)', timeCommand(update, repeat)))
+        results.append(('re-index (warm, -full)', timeCommand(update + ['-full'], repeat)))
+        results.append(('check', timeCommand(photodb + ['-dbfile', dbfile, '-check', root], repeat)))
+        results.append(('find (no filters)', timeCommand(photofind + [root, '-dbfile', dbfile], repeat)))
+        for query in QUERIES:
+            results.append(('find ' + ' '.join(query), timeCommand(photofind + [root, '-dbfile', dbfile] + query, repeat)))
+        dbsize = os.path.getsize(dbfile)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    for name, result in results:
+        sys.stderr.write('%-40s %8.3f s %8d lines\n' % (name, result['best'], result['lines']))
+
+    return dict(results=[dict(name=name, **result) for name, result in results],
+                dbsize=dbsize,
+                reader=reader,
+                jobs=jobs,
+                commit=gitCommit(),
+                python=platform.python_version(),
+                platform=platform.platform(),
+                date=time.strftime('%Y-%m-%d %H:%M:%S'))
+
+def filterBenchmark(numRecords, seed=1, repeat=3):
+    """ Time the compiled metadata filters on random in-memory records. Return the results as dict (seconds per record). """
+    sys.path.insert(0, SCRIPT_DIR)
+    import exiffilter
+    import ImageMetadata
+
+    rnd = random.Random(seed)
+    records = []
+    for i in xrange(numRecords):
+        md = ImageMetadata.ImageMetadata('IMG_%07d.jpg' % i)
+        md.fromVals(dict(iso=rnd.choice([100, 200, 400, 800, 1600, 3200, 6400]),
+                         flength=rnd.choice([12, 18, 24, 35, 50, 85, 105, 135, 200, 300, 400]),
+                         aperture=rnd.choice([1.4, 1.8, 2.8, 4.0, 5.6, 8.0, 11.0, 16.0]),
+                         exposure=1.0 / rnd.choice([4000, 1000, 250, 125, 60, 15, 1]),
+                         rating=rnd.choice([None, 0, 1, 2, 3, 4, 5]),
+                         origtime='%04d-%02d-%02d 12:00:00' % (rnd.randint(2005, 2017), rnd.randint(1, 12), rnd.randint(1, 28))))
+        records.append(md)
+
+    results = []
+    for filters in FILTER_SETS:
+        ef = exiffilter.ExifFilter()
+        for field, filterString in filters:
+            ef.add_filter(field, filterString)
+        predicate = ef.compile()
+        times = []
+        for i in xrange(repeat):
+            t0 = time.time()
+            passed = sum(1 for md in records if predicate(md))
+            times.append((time.time() - t0) / numRecords)
+        name = 'filter ' + ' '.join('%s=%s' % f for f in filters)
+        sys.stderr.write('%-50s %8.3f us/record %6.2f %% passed\n' % (name, min(times) * 1e6, 100.0 * passed / numRecords))
+        results.append(dict(name=name, seconds=times, best=min(times), passed=passed))
+
+    return dict(results=results,
+                records=numRecords,
+                commit=gitCommit(),
+                python=platform.python_version(),
+                platform=platform.platform(),
+                date=time.strftime('%Y-%m-%d %H:%M:%S'))
+
+class LatencyFS:
+    """ Emulation of a high-latency (network) file system in this process: every stat, lstat, listdir and open of
+        a path under root is delayed by given number of seconds. Like real network I/O, the delay releases the GIL,
+        so the calls of different threads overlap. Use as a context manager. """
+
+    FUNCTIONS = [(os, 'stat'), (os, 'lstat'), (os, 'listdir'), (__builtin__, 'open')]
+
+    def __init__(self, root, latency):
+        self.root = os.path.abspath(root)
+        self.latency = latency
+        self.originals = []
+
+    def _delayed(self, func):
+        def delayed(path, *args, **kwargs):
+            if isinstance(path, basestring) and os.path.abspath(path).startswith(self.root):
+                time.sleep(self.latency)
+            return func(path, *args, **kwargs)
+        return delayed
+
+    def __enter__(self):
+        import findwalk
+        self.originals = [(module, name, getattr(module, name)) for module, name in LatencyFS.FUNCTIONS]
+        self.originals.append((findwalk, 'scandir', findwalk.scandir))
+        for module, name, func in self.originals[:-1]:
+            setattr(module, name, self._delayed(func))
+        findwalk.scandir = None  # The C scandir can't be delayed, list with os.listdir and os.lstat instead
+        return self
+
+    def __exit__(self, *exc):
+        for module, name, func in self.originals:
+            setattr(module, name, func)
+
+def latencyBenchmark(root, latency, threadCounts, repeat=3, reader='fast', jobs=1):
+    """ Time photodb update and check in this process with each number of I/O threads, every file system call
+        under root delayed by 'latency' seconds (see LatencyFS). Return the results as dict. """
+    sys.path.insert(0, SCRIPT_DIR)
+    import photodb
+
+    photodb.ImageMetadata.reader = reader
+    tmpdir = tempfile.mkdtemp(prefix='photobench')
+    stdout = sys.stdout
+    results = []
+    try:
+        for threads in threadCounts:
+            db = photodb.PhotoDB(os.path.join(tmpdir, 'bench%d.db' % threads))
+            operations = [('index (cold)', 1, lambda: db.update(root, False, jobs, threads=threads)),
+                          ('re-index (warm)', repeat, lambda: db.update(root, False, jobs, threads=threads)),
+                          ('re-index (warm, -full)', repeat, lambda: db.update(root, False, jobs, True, threads=threads)),
+                          ('check', repeat, lambda: db.check([root], threads=threads))]
+            for name, times, func in operations:
+                seconds = []
+                for i in xrange(times):
+                    sys.stdout = open(os.devnull, 'w')
+                    try:
+                        with LatencyFS(root, latency):
+                            t0 = time.time()
+                            func()
+                            seconds.append(time.time() - t0)
+                    finally:
+                        sys.stdout = stdout
+                name = '%s, %d threads' % (name, threads)
+                sys.stderr.write('%-40s %8.3f s\n' % (name, min(seconds)))
+                results.append(dict(name=name, seconds=seconds, best=min(seconds)))
+            db.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return dict(results=results,
+                latency=latency,
+                reader=reader,
+                jobs=jobs,
+                commit=gitCommit(),
+                python=platform.python_version(),
+                platform=platform.platform(),
+                date=time.strftime('%Y-%m-%d %H:%M:%S'))
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', '-C', SCRIPT_DIR, 'rev-parse', '--short', 'HEAD'], stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def walkFiles(root):
+    for dirpath, dirs, files in os.walk(root):
+        for fname in files:
+            yield os.path.join(dirpath, fname)
+
+def compare(oldFile, newFile):
+    """ Print the best times of two result files side by side. """
+    old = json.load(open(oldFile))
+    new = json.load(open(newFile))
+    oldTimes = dict((r['name'], r['best']) for r in old['results'])
+    print '%-40s %10s %10s %8s' % ('', old.get('commit') or 'old', new.get('commit') or 'new', 'ratio')
+    for r in new['results']:
+        if r['name'] in oldTimes:
+            print '%-40s %10.3g %10.3g %8.2f' % (r['name'], oldTimes[r['name']], r['best'], r['best'] / max(oldTimes[r['name']], 1e-12))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='photobench - Benchmarks for photodb and photofind', epilog="Author: Juuso Räsänen")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-generate', metavar='DIR', help='Generate a synthetic photo tree to DIR (must not exist)')
+    group.add_argument('-run', metavar='DIR', help='Run the benchmarks on the photo tree in DIR')
+    group.add_argument('-filters', action='store_true', help='Microbenchmark of the metadata filters (time per record)')
+    group.add_argument('-latency', nargs=2, metavar=('MS', 'DIR'), help='Run photodb -update and -check on DIR with MS milliseconds added to each file system call')
+    group.add_argument('-compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two result files')
+
+    parser.add_argument('-n', type=int, default=10000, help='Number of files to generate (or records for -filters, default %(default)s)')
+    parser.add_argument('-seed', type=int, default=1, help='Random seed for generating (default %(default)s)')
+    parser.add_argument('-filesize', type=int, default=24 * 1024, help='Apparent size of the generated files (default %(default)s)')
+    parser.add_argument('-repeat', type=int, default=3, help='Number of times each benchmark is run (best time is reported, default %(default)s)')
+    parser.add_argument('-reader', default='fast', help='Metadata reader for photodb -update (default %(default)s)')
+    parser.add_argument('-jobs', type=int, default=1, help='Number of reader processes for photodb -update (default %(default)s)')
+    parser.add_argument('-threads', default='1,4,16', help='Comma-separated numbers of I/O threads for -latency (default %(default)s)')
+    parser.add_argument('-out', metavar='FILE', help='Write the results to FILE as JSON (default stdout)')
+
+    args = parser.parse_args()
+
+    if args.generate:
+        if os.path.exists(args.generate):
+            sys.stderr.write('Error: %s already exists!\n' % args.generate)
+            return 2
+        t0 = time.time()
+        generate(args.generate, args.n, args.seed, args.filesize)
+        sys.stderr.write('Generated %d files in %.1f s.\n' % (args.n, time.time() - t0))
+    elif args.run:
+        results = run(args.run, args.repeat, args.reader, args.jobs)
+        results['files'] = sum(1 for _ in walkFiles(args.run))
+    elif args.filters:
+        results = filterBenchmark(args.n, args.seed, args.repeat)
+    elif args.latency:
+        results = latencyBenchmark(args.latency[1], float(args.latency[0]) / 1000, [int(n) for n in args.threads.split(',')], args.repeat, args.reader, args.jobs)
+        results['files'] = sum(1 for _ in walkFiles(args.latency[1]))
+    elif args.compare:
+        compare(args.compare[0], args.compare[1])
+
+    if args.run or args.filters or args.latency:
+        out = open(args.out, 'w') if args.out else sys.stdout
+        json.dump(results, out, indent=2, sort_keys=True)
+        out.write('\n')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
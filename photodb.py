@@ -9,79 +9,640 @@
 
  Author: Juuso Räsänen (email: info@trimap.fi)
 '''
-from ImageMetadata import ImageMetadata
+from ImageMetadata import ImageMetadata, READERS, CONFIG_FILE, CONFIG_KEYS, KEYS, TYPES, MAX_RAW_STRING, tagValue
+import findwalk
+import perfstats
+import iopipeline
+import perceptualhash
+import geo
+import progress
 
 import sqlite3
 
 import os
 import sys
+import stat
+import zlib
+import errno
+import json
+import signal
 import argparse
+import time
+import hashlib
+import calendar
 import datetime
+import collections
+import multiprocessing
 
 IMAGE_EXTENSIONS = ['jpg', 'jpeg', 'png', 'tif', 'bmp', 'gif', 'xpm', 'nef', 'cr2', 'arw']
 
+# Columns of the images view (see migration 5) in their order.
+COLUMNS = ['filepath', 'filesize', 'modtime', 'origtime', 'flength', 'flength35', 'aperture', 'exposure', 'iso', 'rating', 'comment', 'origepoch', 'fingerprint']
+# Columns of the files table: the directory (id in dirs) and the name of the file instead of the filepath.
+FILE_COLUMNS = ['dir_id', 'name'] + COLUMNS[1:]
+# Indexed columns of the files table.
+INDEXED_COLUMNS = ['origtime', 'origepoch', 'flength', 'flength35', 'aperture', 'exposure', 'iso', 'rating', 'fingerprint']
+# Columns of the metadata fields declared in the configuration file (see ImageMetadata.loadConfig), added to the
+# files table when the database is loaded.
+CONFIG_COLUMNS = list(CONFIG_KEYS)
+# Columns of the GPS position (see migration 8).
+GPS_COLUMNS = ['gpslat', 'gpslon', 'gpsalt']
+# Columns written by setMetadata: the ones of the files table of migration 5, the perceptual hash, the GPS position and
+# the configured fields.
+STORED_COLUMNS = FILE_COLUMNS + ['phash'] + GPS_COLUMNS + CONFIG_COLUMNS
+# Columns holding the metadata values (see ImageMetadata.KEYS).
+METADATA_COLUMNS = ['origtime', 'flength', 'aperture', 'exposure', 'iso', 'rating', 'comment', 'flength35'] + GPS_COLUMNS + CONFIG_COLUMNS
+SQL_TYPES = {type(str()): 'text', type(float()): 'real', type(int()): 'integer'}
+
+
+def splitPath(fpath):
+    """ Split given absolute path to the path of its directory as stored in dirs ('' for the root directory) and its name. """
+    return tuple(fpath.rsplit('/', 1))
+
+def _moveToNormalizedTables(c):
+    """ Migration 5: copy the rows of the images and dirstate tables to the files and dirs tables. """
+    dirIds = dict()
+
+    def dirId(dirpath):
+        if dirpath not in dirIds:
+            parent, name = splitPath(dirpath) if dirpath else (None, '')
+            parentId = dirId(parent) if parent != None else None
+            c.execute('INSERT INTO dirs(parent, name, path) VALUES (?,?,?)', (parentId, name, dirpath))
+            dirIds[dirpath] = c.lastrowid
+        return dirIds[dirpath]
+
+    insert = 'INSERT INTO files (%s) VALUES (%s)' % (','.join(FILE_COLUMNS), ','.join('?' * len(FILE_COLUMNS)))
+    rows = c.connection.cursor()
+    rows.execute('SELECT %s FROM images ORDER BY filepath' % ','.join(COLUMNS))
+    while True:
+        batch = rows.fetchmany(10000)
+        if not batch:
+            break
+        fileRows = []
+        for row in batch:
+            dirpath, name = splitPath(row[0])
+            fileRows.append((dirId(dirpath), name) + tuple(row[1:]))
+        c.executemany(insert, fileRows)
+
+    for dirpath, mtime, nentries in c.execute('SELECT dirpath, mtime, nentries FROM dirstate').fetchall():
+        c.execute('UPDATE dirs SET mtime=?, nentries=? WHERE id=?', (mtime, nentries, dirId(dirpath.rstrip('/'))))
+
+def _createImagesView(c):
+    """ (Re)create the images view with all the columns of the files table. """
+    columns = [row[1] for row in c.execute('PRAGMA table_info(files)').fetchall() if row[1] not in ('dir_id', 'name')]
+    c.execute('DROP VIEW IF EXISTS images')
+    c.execute('CREATE VIEW images AS SELECT d.path || \'/\' || f.name AS filepath, %s FROM files f JOIN dirs d ON d.id = f.dir_id' % ', '.join('f.' + col for col in columns))
+
+
+def packRaw(raw):
+    """ Return raw tags (ImageMetadata.raw) compressed for the rawmeta table, without the strings longer than
+        MAX_RAW_STRING except in the tags of the metadata fields (KEYS), which are kept whole for -backfill. """
+    fieldTags = set(exifkey for exifkeys in KEYS.itervalues() for exifkey in exifkeys)
+
+    def isLong(val):
+        return isinstance(val, unicode) and len(val) > MAX_RAW_STRING
+
+    stored = dict()
+    for key, val in raw.iteritems():
+        if key in fieldTags:
+            stored[key] = val
+            continue
+        if isinstance(val, list):
+            val = [v for v in val if not isLong(v)]
+        if val != [] and not isLong(val):
+            stored[key] = val
+    return sqlite3.Binary(zlib.compress(json.dumps(stored, separators=(',', ':'), sort_keys=True)))
+
+def unpackRaw(data):
+    """ Return the raw tags of a rawmeta.data value (None for NULL). """
+    if data == None:
+        return None
+    return json.loads(zlib.decompress(data))
+
+_lastRaw = [None, None]  # The last (data, raw tags) unpacked by rawTag
+
+def rawTag(data, exifkey):
+    """ SQL function rawtag(data, key): the value of given tag (the first one of many) in a rawmeta.data value, NULL if
+        not found. The tags of the last row are kept, so testing many tags of a row unpacks them only once. """
+    if data == None:
+        return None
+    data = str(data)
+    if data != _lastRaw[0]:
+        _lastRaw[:] = [data, unpackRaw(data)]
+    return tagValue(_lastRaw[1], exifkey)
+
+
+# Schema migrations: MIGRATIONS[n] takes the database from schema version n to n + 1.
+MIGRATIONS = [
+    # 1: The images table
+    ["""CREATE TABLE images(
+         filepath text PRIMARY KEY,
+         filesize integer,
+         modtime real,
+         origtime char(20),
+         flength real,
+         flength35 real,
+         aperture real,
+         exposure real,
+         iso real,
+         rating integer,
+         comment text
+         )"""],
+    # 2: State of the directories at the last update (nentries = number of image files)
+    ['CREATE TABLE IF NOT EXISTS dirstate(dirpath text PRIMARY KEY, parent text, mtime real, nentries integer)',
+     'CREATE INDEX IF NOT EXISTS dirstate_parent ON dirstate(parent)'],
+    # 3: Indexes for the filterable columns and the original time as (UTC-naive) epoch seconds for sorting and ranges
+    ['ALTER TABLE images ADD COLUMN origepoch integer',
+     """UPDATE images SET origepoch = CAST(strftime('%s', substr(origtime, 1, 4) || '-' || substr(origtime, 6, 2) || '-' || substr(origtime, 9, 2) || substr(origtime, 11)) AS integer)
+        WHERE origtime GLOB '[0-9][0-9][0-9][0-9][-:][0-9][0-9][-:][0-9][0-9]*'"""] +
+    ['CREATE INDEX images_%s ON images(%s)' % (col, col) for col in ['origtime', 'origepoch', 'flength', 'flength35', 'aperture', 'exposure', 'iso', 'rating']],
+    # 4: Content fingerprint (see fileFingerprint) for recognizing moved files
+    ['ALTER TABLE images ADD COLUMN fingerprint text',
+     'CREATE INDEX images_fingerprint ON images(fingerprint)'],
+    # 5: Normalized paths: the directories in dirs (including the former dirstate, nentries is NULL for the directories
+    #    that have not been listed by update) and the files in files. The images view looks like the former table.
+    #    Versions before the migrations were atomic may have left the new tables of an interrupted migration 5.
+    ['DROP TABLE IF EXISTS dirs',
+     'DROP TABLE IF EXISTS files',
+     '''CREATE TABLE dirs(
+         id integer PRIMARY KEY,
+         parent integer,
+         name text,
+         path text UNIQUE,
+         mtime real,
+         nentries integer
+         )''',
+     'CREATE INDEX dirs_parent ON dirs(parent, name)',
+     '''CREATE TABLE files(
+         dir_id integer NOT NULL,
+         name text NOT NULL,
+         filesize integer,
+         modtime real,
+         origtime char(20),
+         flength real,
+         flength35 real,
+         aperture real,
+         exposure real,
+         iso real,
+         rating integer,
+         comment text,
+         origepoch integer,
+         fingerprint text,
+         UNIQUE(dir_id, name)
+         )''',
+     _moveToNormalizedTables,
+     'DROP TABLE images',
+     'DROP TABLE dirstate',
+     'CREATE VIEW images AS SELECT d.path || \'/\' || f.name AS filepath, %s FROM files f JOIN dirs d ON d.id = f.dir_id' % ', '.join('f.' + col for col in COLUMNS[1:])] +
+    ['CREATE INDEX files_%s ON files(%s)' % (col, col) for col in INDEXED_COLUMNS],
+    # 6: All the tags read from the files as compressed JSON (see packRaw), for backfilling new metadata fields and
+    #    filtering by any tag. The rows go with the rows of files (also when they are renamed, as the rowid stays).
+    ['CREATE TABLE rawmeta(file_id integer PRIMARY KEY, data blob)',
+     'CREATE TRIGGER files_delete_rawmeta AFTER DELETE ON files BEGIN DELETE FROM rawmeta WHERE file_id = old.rowid; END'],
+    # 7: Perceptual hash (see perceptualhash) with an index on each 16-bit chunk for the similarity queries
+    ['ALTER TABLE files ADD COLUMN phash integer', _createImagesView] +
+    ['CREATE INDEX files_phash%d ON files((phash >> %d) & %d) WHERE phash IS NOT NULL' % (i, perceptualhash.CHUNK_BITS * i, perceptualhash.CHUNK_MASK)
+     for i in xrange(perceptualhash.CHUNKS)],
+    # 8: GPS position with an R-tree of the positions (id = rowid of files) for the area queries (see geo), kept up to
+    #    date by triggers. The R-tree stores 32-bit floats (rounded outwards), the exact tests use the columns.
+    ['ALTER TABLE files ADD COLUMN gpslat real',
+     'ALTER TABLE files ADD COLUMN gpslon real',
+     'ALTER TABLE files ADD COLUMN gpsalt real',
+     _createImagesView,
+     'CREATE VIRTUAL TABLE gpsindex USING rtree(id, minlat, maxlat, minlon, maxlon)',
+     '''CREATE TRIGGER files_insert_gps AFTER INSERT ON files WHEN new.gpslat IS NOT NULL AND new.gpslon IS NOT NULL BEGIN
+          INSERT OR REPLACE INTO gpsindex VALUES (new.rowid, new.gpslat, new.gpslat, new.gpslon, new.gpslon); END''',
+     '''CREATE TRIGGER files_update_gps AFTER UPDATE OF gpslat, gpslon ON files BEGIN
+          DELETE FROM gpsindex WHERE id = old.rowid;
+          INSERT INTO gpsindex SELECT new.rowid, new.gpslat, new.gpslat, new.gpslon, new.gpslon WHERE new.gpslat IS NOT NULL AND new.gpslon IS NOT NULL; END''',
+     'CREATE TRIGGER files_delete_gps AFTER DELETE ON files BEGIN DELETE FROM gpsindex WHERE id = old.rowid; END'],
+    # 9: The updates of each root path (finished is NULL while running or if interrupted) and the directories finished
+    #    by the running update, for continuing an interrupted update (see PhotoDB.update)
+    ['CREATE TABLE updates(root text PRIMARY KEY, started real, finished real)',
+     'CREATE TABLE update_dirs(root text, dir_id integer, PRIMARY KEY(root, dir_id))'],
+]
+
+FINGERPRINT_BLOCK_SIZE = 16 * 1024
+
+# Settings of the database connections (see connect)
+BUSY_TIMEOUT = 60.0  # Seconds a writer waits for another writer to commit before failing
+CACHE_SIZE = 64 * 1024  # Page cache per connection in kB
+MMAP_SIZE = 256 * 1024 * 1024  # Bytes of the database file read through memory mapping
+
+
+def connect(dbFile, readOnly=False):
+    """ Return a new connection to given database file. A read-write connection switches the database to WAL
+        journaling (persistent), so that the readers neither block the writer nor each other and see the last
+        commit, and a writer waits for another one for at most BUSY_TIMEOUT. A read-only connection never writes
+        to the database and is in autocommit mode, so that writing the temporary tables of the queries does not
+        keep a read transaction (an old snapshot of the database) open. The sqlite3 module of Python 2 can't open
+        the file read-only (URI filenames), so a read-only connection is made query-only instead: any write fails,
+        including the temporary tables of the queries (written in the block of PhotoDB.tempWrites()). """
+    conn = sqlite3.connect(dbFile, timeout=BUSY_TIMEOUT, isolation_level=None if readOnly else '')
+    conn.text_factory = str
+    conn.execute('PRAGMA cache_size=%d' % -CACHE_SIZE)
+    conn.execute('PRAGMA mmap_size=%d' % MMAP_SIZE)
+    conn.execute('PRAGMA temp_store=MEMORY')
+    if readOnly:
+        conn.execute('PRAGMA query_only=ON')
+    else:
+        conn.execute('PRAGMA journal_mode=WAL')
+        # With WAL a power loss may lose the last commits but does not corrupt the database, and the bulk writes
+        # of the updates don't wait for a sync at every commit
+        conn.execute('PRAGMA synchronous=NORMAL')
+    conn.create_function('rawtag', 2, rawTag)
+    conn.create_function('geodistance', 4, geo.distance)
+    return conn
+
+
+def origtimeToEpoch(origtime):
+    """ Convert original time string ('YYYY-MM-DD HH:MM:SS' or EXIF 'YYYY:MM:DD HH:MM:SS') to epoch seconds, treating it as UTC. """
+    if not origtime or len(origtime) < 19:
+        return None
+    try:
+        return calendar.timegm(datetime.datetime.strptime(origtime[:4] + '-' + origtime[5:7] + '-' + origtime[8:19], '%Y-%m-%d %H:%M:%S').timetuple())
+    except ValueError:
+        return None
+
+
+def fileFingerprint(fname, size=None):
+    """ Return a fingerprint of the contents of given file: its size and a hash of its first and last blocks.
+        Returns None if the file can't be read. """
+    try:
+        with open(fname, 'rb') as f:
+            if size == None:
+                size = os.fstat(f.fileno()).st_size
+            h = hashlib.md5(f.read(FINGERPRINT_BLOCK_SIZE))
+            if size > FINGERPRINT_BLOCK_SIZE:
+                f.seek(max(FINGERPRINT_BLOCK_SIZE, size - FINGERPRINT_BLOCK_SIZE))
+                h.update(f.read(FINGERPRINT_BLOCK_SIZE))
+    except (IOError, OSError):
+        return None
+    return '%d:%s' % (size, h.hexdigest()[:16])
+
+
+def _listDir(dirpath):
+    """ Return the entries of given directory as a list, or the OSError if it can't be listed. """
+    try:
+        return list(findwalk.listdir(dirpath))
+    except OSError, msg:
+        return msg
+
+def _scanDir(dirpath, storedMtime=None):
+    """ Return (os.stat result, entries) of given directory, entries being None if its mtime is storedMtime
+        (not modified, no need to list it) or the OSError if it can't be accessed. Called in the I/O threads. """
+    try:
+        dirst = os.stat(dirpath)
+    except OSError, msg:
+        return None, msg
+    if storedMtime != None and dirst.st_mtime == storedMtime:
+        return dirst, None
+    return dirst, _listDir(dirpath)
+
+def _entryInfo(entry):
+    """ Return (entry, kind, st) for a directory entry: kind is 'dir' for a directory (not a symlink), 'image' for
+        an image file (st being its os.stat result or the OSError) or None for the ignored entries.
+        Called in the I/O threads. """
+    # Ignore hidden files and directories
+    if entry.name.startswith('.'):
+        return entry, None, None
+    try:
+        if entry.is_dir():
+            return entry, ('dir' if not entry.is_symlink() else None), None
+        if PhotoDB.isImage(entry.name):
+            return entry, 'image', entry.stat()
+    except OSError, msg:
+        return entry, 'image' if PhotoDB.isImage(entry.name) else None, msg
+    return entry, None, None
+
+# Yielded by PhotoDB._walkForUpdate in place of a file name after the files of a listed directory, with st None so that it
+# passes through the stages of the update like an up-to-date file. The directory is recorded as finished together with
+# the files before it unless dirId is None (files to prune, see PhotoDB._walkForUpdate), and its state (mtime, nentries,
+# id) written then too unless it's None (written at the end).
+_ListedDir = collections.namedtuple('_ListedDir', ['root', 'dirId', 'state'])
+
+def _isSubdir(entry):
+    """ Return true if given directory entry is a (non-hidden) subdirectory walked by the update. """
+    try:
+        return not entry.name.startswith('.') and entry.is_dir() and not entry.is_symlink()
+    except OSError:
+        return False
+
+def _withFingerprint(item):
+    """ (fname, st) -> (fname, st, fingerprint), the fingerprint being None if st is. Called in the I/O threads. """
+    fname, st = item
+    return fname, st, (fileFingerprint(fname, st.st_size) if st != None else None)
+
+
+def _initReaderProcess(reader, stats=False):
+    # Let only the parent process react to Ctrl-C.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    ImageMetadata.reader = reader
+    if stats:
+        perfstats.enable()
+        perfstats.take()  # Discard the data inherited from the parent (fork)
+
+def _readMetadataVals(fname):
+    """ Read the metadata of given file and return it as a plain dict (picklable for worker processes). """
+    try:
+        md = ImageMetadata(fname, True)
+        with perfstats.phase('read.hash'):
+            md.phash = perceptualhash.imageHash(fname)
+        return md.toVals()
+    except Exception, msg:
+        # A single broken file must not take the whole (worker) process down.
+        sys.stderr.write('Error (%s): %s\n' % (fname, msg))
+        perfstats.count('read.errors')
+        return dict()
+
+def _readMetadataValsWithStats(fname):
+    """ Like _readMetadataVals, but returns (vals, instrumentation data of the worker process). """
+    return _readMetadataVals(fname), perfstats.take()
+
+def _newReaderPool(jobs, reader):
+    return multiprocessing.Pool(jobs, _initReaderProcess, (reader, perfstats.enabled))
+
+def _readAsync(pool, fname):
+    """ Start reading the metadata of given file in the pool. Get the result with _asyncVals(). """
+    if perfstats.enabled:
+        return pool.apply_async(_readMetadataValsWithStats, (fname,))
+    return pool.apply_async(_readMetadataVals, (fname,))
+
+def _asyncVals(res):
+    ret = res.get()
+    if perfstats.enabled:
+        ret, data = ret
+        perfstats.merge(data)
+    return ret
+
+
+class _TempWrites:
+    """ Context manager allowing the writes of a query-only connection (see connect) in its block. """
+
+    def __init__(self, conn, queryOnly):
+        self.conn = conn
+        self.queryOnly = queryOnly
+
+    def __enter__(self):
+        if self.queryOnly:
+            self.conn.execute('PRAGMA query_only=OFF')
+
+    def __exit__(self, excType, excValue, tb):
+        if self.queryOnly:
+            self.conn.execute('PRAGMA query_only=ON')
+
 
 class PhotoDB:
     """ Simple Photo Database """
 
     DEFAULT_DBFILE = '~/.photodb.db'
+    WRITE_BATCH_SIZE = 1000  # Number of rows buffered before they are written to the database.
+    QUERY_BATCH_SIZE = 10000  # Max number of files looked up with a single query in queryFiles()
+    RACY_DIR_MTIME = 2.0  # Directories modified less than this many seconds before listing are always re-listed.
+    CHECKPOINT_INTERVAL = 30.0  # An update commits what it has done at least this often (seconds)...
+    CHECKPOINT_FILES = 10000  # ...and after storing this many files
 
-    def __init__(self, dbFile=DEFAULT_DBFILE):
+    def __init__(self, dbFile=DEFAULT_DBFILE, readOnly=False):
         self.dbFile = os.path.expanduser(dbFile)
+        self.readOnly = readOnly  # Only for querying: opened with a read-only connection and never saved
         self.conn = None  # SQLite db connection
         self.c = None  # SQLite cursor
         self.updateIfNotFound = False
+        self.updateJobs = 0  # Number of reader processes used by updateIfNotFound (0 = number of CPUs)
+        self.numUpdatedOnQuery = 0
         self.isModifiedButNotSaved = False
+        self.pendingRows = []  # Rows waiting for the next batched write
+        self.pendingRaw = []  # (packed raw tags, dir_id, name) waiting for the next batched write
+        self.pendingDirs = []  # _ListedDirs finished by the running update, written after the rows before them
+        self.dirIds = dict()  # Cache of directory path -> id in dirs
 
     def isLoaded(self):
         return self.conn != None
 
     def load(self):
-        """ Open the actual database connection. """
-        self.conn = sqlite3.connect(self.dbFile)
-        self.conn.text_factory = str
+        """ Open the actual database connection (see connect), creating or migrating the database first if needed. """
+        if self.readOnly and os.path.isfile(self.dbFile):
+            self._connect(True)
+            if self.schemaVersion() == len(MIGRATIONS) and not self._missingConfigColumns():
+                return
+            self.conn.close()
+
+        self._connect(False)
+        self.migrate()
+        self._addConfigColumns()
+        if self.readOnly:
+            self.conn.close()
+            self._connect(True)
+
+    def _connect(self, readOnly):
+        self.conn = connect(self.dbFile, readOnly)
         self.c = self.conn.cursor()
-        try:
-            self.c.execute('''CREATE TABLE images(
-                 filepath text PRIMARY KEY,
-                 filesize integer, 
-                 modtime real,
-                 origtime char(20), 
-                 flength real, 
-                 flength35 real,                 
-                 aperture real, 
-                 exposure real,
-                 iso real, 
-                 rating integer, 
-                 comment text
-                 )''')
 
+    def schemaVersion(self):
+        """ Return the schema version of the loaded database (0 for a new database). """
+        if self.c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='schema_version'").fetchone():
+            row = self.c.execute('SELECT version FROM schema_version').fetchone()
+            if row:
+                return row[0]
+        if self.c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='images'").fetchone():
+            return 1  # Created before the schema was versioned
+        return 0
+
+    def migrate(self):
+        """ Bring the database schema up to date by applying the missing MIGRATIONS. Each migration is applied in a
+            transaction of its own together with its schema version, so an interrupted migration leaves the database
+            at the previous version. The version is read again once the database is locked, as another process may
+            have migrated it meanwhile. """
+        if self.schemaVersion() >= len(MIGRATIONS):
+            return
+
+        version = None  # The version before the migrations applied here
+        while True:
+            self._beginImmediate()
+            try:
+                current = self.schemaVersion()
+                if version == None:
+                    version = current
+                if current >= len(MIGRATIONS):
+                    break
+                self.c.execute('CREATE TABLE IF NOT EXISTS schema_version(version integer)')
+                for statement in MIGRATIONS[current]:
+                    if callable(statement):
+                        statement(self.c)
+                    else:
+                        self.c.execute(statement)
+                self.c.execute('DELETE FROM schema_version')
+                self.c.execute('INSERT INTO schema_version VALUES (?)', (current + 1,))
+            except:
+                self._endTransaction(False)
+                raise
+            self._endTransaction(True)
+        self._endTransaction(True)
+        if version >= len(MIGRATIONS):
+            return
+
+        if version > 0:
+            # Release the space of the replaced tables and indexes
+            self.c.execute('VACUUM')
+        if 0 < version < 8 and self.c.execute('SELECT 1 FROM rawmeta LIMIT 1').fetchone():
+            sys.stderr.write('Tip: Fill in the GPS positions of the stored files by running: "photodb -backfill gpslat gpslon gpsalt"\n')
+
+    def _beginImmediate(self):
+        """ Start a transaction holding the write lock (waiting for the other writers, see connect). The sqlite3 module
+            would commit before every DDL statement, so the connection is in autocommit mode until _endTransaction. """
+        self.conn.commit()
+        self.conn.isolation_level = None
+        self.c.execute('BEGIN IMMEDIATE')
+
+    def _endTransaction(self, commit):
+        """ Commit or roll back the transaction started by _beginImmediate. """
+        try:
+            self.c.execute('COMMIT' if commit else 'ROLLBACK')
         except sqlite3.OperationalError:
-            # Most obvious reason "table already exists" --> ignore
-            pass
-            # raise
+            if commit:
+                raise
+            # SQLite has rolled back the transaction by itself (e.g. on a full disk)
+        finally:
+            self.conn.isolation_level = ''
+
+    def _missingConfigColumns(self):
+        """ Return the columns of the fields declared in the configuration file that are not in the files table yet. """
+        existing = set(row[1] for row in self.c.execute('PRAGMA table_info(files)').fetchall())
+        return [col for col in CONFIG_COLUMNS if col not in existing]
+
+    def _addConfigColumns(self):
+        """ Add the (indexed) columns of the fields declared in the configuration file that are not in the files table yet.
+            Like the migrations, the columns are added in a single transaction and looked up again under the write lock. """
+        if not self._missingConfigColumns():
+            return
+        self._beginImmediate()
+        try:
+            missing = self._missingConfigColumns()
+            for col in missing:
+                self.c.execute('ALTER TABLE files ADD COLUMN %s %s' % (col, SQL_TYPES[TYPES[col]]))
+                self.c.execute('CREATE INDEX files_%s ON files(%s)' % (col, col))
+            if missing:
+                _createImagesView(self.c)
+        except:
+            self._endTransaction(False)
+            raise
+        self._endTransaction(True)
+        if missing:
+            sys.stderr.write('Added the configured fields to the database: %s\nTip: Fill them in from the stored tags by running: "photodb -backfill"\n' % ', '.join(missing))
+
+    def tempWrites(self):
+        """ Return a context manager for writing the temporary tables of a query, only they may be written in its block. """
+        return _TempWrites(self.conn, self.readOnly)
 
     def close(self):
         if self.isLoaded():
-            self.save()
+            if not self.readOnly:
+                self.save()
             self.conn.close()
 
     def save(self):
         if not self.isLoaded():
             raise Exception("Database must be loaded before saving!")
+        if self.readOnly:
+            raise Exception("Read-only database can't be saved!")
 
+        self.flush()
         self.conn.commit()
+        self.isModifiedButNotSaved = False
 
-    def setUpdateIfNotFound(self, val):
-        # TODO
-        pass
+    def flush(self):
+        """ Write the buffered rows to the database (in a single statement per table). """
+        if self.pendingRows or self.pendingDirs:
+            with perfstats.phase('db.write'):
+                self.c.executemany(PhotoDB._upsertStatement(), self.pendingRows)
+                self.c.executemany('INSERT OR REPLACE INTO rawmeta(file_id, data) SELECT rowid, ? FROM files WHERE dir_id=? AND name=?', self.pendingRaw)
+                self.c.executemany('UPDATE dirs SET mtime=?, nentries=? WHERE id=?', [listed.state for listed in self.pendingDirs if listed.state])
+                self.c.executemany('INSERT OR IGNORE INTO update_dirs(root, dir_id) VALUES (?, ?)', [listed[:2] for listed in self.pendingDirs if listed.dirId != None])
+            self.pendingRows = []
+            self.pendingRaw = []
+            self.pendingDirs = []
+
+    @staticmethod
+    def _upsertStatement():
+        columns = STORED_COLUMNS
+        statement = 'INSERT INTO files (%s) VALUES (%s)' % (','.join(columns), ','.join('?' * len(columns)))
+        if sqlite3.sqlite_version_info >= (3, 24, 0):
+            statement += ' ON CONFLICT(dir_id, name) DO UPDATE SET ' + ', '.join('%s=excluded.%s' % (col, col) for col in columns[2:])
+        else:
+            # Older SQLite without UPSERT support: all the columns are given, so replacing the row is equivalent.
+            statement = statement.replace('INSERT', 'INSERT OR REPLACE', 1)
+        return statement
+
+    def _dirId(self, dirpath, create=True):
+        """ Return the id of given directory (path as stored in dirs), adding it and its parents to dirs if needed.
+            Without 'create' returns None for the directories not in dirs. """
+        dirId = self.dirIds.get(dirpath)
+        if dirId != None:
+            return dirId
+
+        c = self.conn.cursor()
+        row = c.execute('SELECT id FROM dirs WHERE path=?', (dirpath,)).fetchone()
+        if row:
+            dirId = row[0]
+        elif not create:
+            return None
+        else:
+            parent, name = splitPath(dirpath) if dirpath else (None, '')
+            c.execute('INSERT INTO dirs(parent, name, path) VALUES (?,?,?)', (self._dirId(parent) if parent != None else None, name, dirpath))
+            dirId = c.lastrowid
+        self.dirIds[dirpath] = dirId
+        return dirId
+
+    @staticmethod
+    def _underCondition(path):
+        """ Return SQL condition for the dirs (as d) at and under given absolute path and its parameters: (condition, params).
+            The directories of a subtree are a single index range of the paths (excluding the siblings like 'path-2'). """
+        dirpath = path.rstrip('/')
+        return 'd.path >= ? AND d.path < ? AND (d.path = ? OR d.path > ?)', (dirpath, dirpath + '0', dirpath, dirpath + '/')
+
+    def filesUnder(self, path, columns=('filesize', 'modtime'), condition='1', params=()):
+        """ Yield (filepath, column values...) for the files in the database under given path (or the file at the path)
+            that match given SQL condition on the files table (as f). The files are ordered by directory and name. """
+        self.flush()
+        path = os.path.abspath(path)
+        under, underParams = PhotoDB._underCondition(path)
+        statement = "SELECT d.path || '/' || f.name%s FROM dirs d JOIN files f ON f.dir_id = d.id WHERE (%%s) AND (%s) ORDER BY d.path, f.name" % \
+                    (''.join(', f.' + col for col in columns), condition)
+        c = self.conn.cursor()
+        # The file at the path (if it is a file), then the files of the directory tree
+        for row in c.execute(statement % 'd.path = ? AND f.name = ?', splitPath(path) + tuple(params)):
+            yield row
+        for row in c.execute(statement % under, underParams + tuple(params)):
+            yield row
+
+    def queryPath(self, path, exifFilter=None, withMetadata=True):
+        """ Yield (filepath, st, metadata) for the files in the database under given path passing given exiffilter.ExifFilter,
+            without accessing the files themselves. st is an os.stat_result of a regular file with the stored size and
+            modification time (the other fields are zero), metadata is None unless 'withMetadata'. """
+        if exifFilter:
+            where, params = exifFilter.to_sql('f')
+        else:
+            where, params = '1', ()
+        columns = ['filesize', 'modtime'] + (METADATA_COLUMNS if withMetadata else [])
+        for row in self.filesUnder(path, columns, where, params):
+            fpath, fsize, modtime = row[:3]
+            st = os.stat_result((stat.S_IFREG, 0, 0, 1, 0, 0, fsize, modtime, modtime, modtime))
+            yield fpath, st, PhotoDB._rowToMetadata(fpath, row[3:]) if withMetadata else None
+
+    def setUpdateIfNotFound(self, val, jobs=0):
+        """ Make queryFiles() read and store the metadata of files that are not in the database or
+            have been modified since. The files are read in a pool of 'jobs' processes. """
+        self.updateIfNotFound = val
+        self.updateJobs = jobs
 
     def select(self, sqlStatementAfterWhere):
+        self.flush()
         statement = 'SELECT * FROM images WHERE %s' % sqlStatementAfterWhere
         for row in self.c.execute(statement):
             yield self.dbRowToString(row)
 
     def getAll(self):
+        self.flush()
         for row in self.c.execute('SELECT * FROM images'):
             yield row
 
@@ -97,29 +658,179 @@ class PhotoDB:
         """ Return the metadata object for given file. """
         # TODO: Rename to getData
         fname = os.path.abspath(fname)
-        self.c.execute('SELECT origtime,flength,aperture,exposure,iso,rating,comment,flength35 FROM images WHERE filepath=?', (fname,))
-        row = self.c.fetchone()
+        self.flush()
+        with perfstats.phase('db.lookup'):
+            dirpath, name = splitPath(fname)
+            self.c.execute('SELECT %s FROM files WHERE dir_id=? AND name=?' % ','.join(METADATA_COLUMNS), (self._dirId(dirpath, False), name))
+            row = self.c.fetchone()
 
         if row:
-            e = ImageMetadata(fname)
-            e.fromVals(dict(origtime=row[0], flength=row[1], aperture=row[2], exposure=row[3], iso=row[4], rating=row[5], comment=row[6], flength35=row[7]))
+            perfstats.count('cache.hit')
+            e = PhotoDB._rowToMetadata(fname, row)
         else:
+            perfstats.count('cache.miss')
             e = None
         return e
 
+    @staticmethod
+    def _rowToMetadata(fname, row):
+        """ Create metadata object from a row of METADATA_COLUMNS values. """
+        e = ImageMetadata(fname)
+        e.fromVals(dict(zip(METADATA_COLUMNS, row)))
+        return e
+
+    def queryFiles(self, files, exifFilter=None):
+        """ Look up the metadata of given (fname, st) files with set-based queries, st being the os.stat (or lstat)
+            result of the file or None if not known. The batches start small and grow up to QUERY_BATCH_SIZE files,
+            so that the first results are available quickly when files is a slow stream.
+            Yields (fname, metadata) for the files passing given exiffilter.ExifFilter (in the original order) and
+            (fname, None) for the files not in the database. With updateIfNotFound the new and modified files are
+            read concurrently with the query instead, stored in the database and yielded as soon as they are ready. """
+        if exifFilter:
+            where, params = exifFilter.to_sql('i')
+        else:
+            where, params = '1', ()
+
+        if self.updateIfNotFound:
+            needsRead = 'i.name IS NULL OR i.filesize IS NOT c.filesize OR i.modtime IS NOT c.modtime'
+        else:
+            needsRead = 'i.name IS NULL'
+
+        self.flush()
+        c = self.conn.cursor()
+        with self.tempWrites():
+            c.execute('CREATE TEMP TABLE IF NOT EXISTS candidates(seq integer PRIMARY KEY, dirpath text, name text, filesize integer, modtime real)')
+        statement = 'SELECT c.seq, %s, %s FROM candidates c LEFT JOIN dirs d ON d.path = c.dirpath LEFT JOIN files i ON i.dir_id = d.id AND i.name = c.name ' \
+                    'WHERE (%s) OR (%s) ORDER BY c.seq' % \
+                    (needsRead, ','.join('i.' + col for col in METADATA_COLUMNS), needsRead, where)
+
+        if self.updateIfNotFound:
+            files = PhotoDB._followedStat(files)
+
+        pool = None
+        pending = []  # (fname, st, AsyncResult) for the files being read
+        try:
+            for batch in PhotoDB._growingBatches(files, 100, PhotoDB.QUERY_BATCH_SIZE):
+                for fname, st, md in self._queryBatch(c, statement, params, batch):
+                    if md != None or not self.updateIfNotFound:
+                        yield fname, md
+                    else:
+                        if not pool:
+                            pool = _newReaderPool(self.updateJobs or None, ImageMetadata.reader)
+                        pending.append((fname, st, _readAsync(pool, fname)))
+
+                for ret in self._storeReadFiles(pending, exifFilter, False):
+                    yield ret
+
+            for ret in self._storeReadFiles(pending, exifFilter, True):
+                yield ret
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+    @staticmethod
+    def _followedStat(files):
+        """ Yield the (fname, st) files with st replaced by the os.stat result if it is None or the lstat result of a
+            symlink (the stored size and modtime are from os.stat). The files that can't be stat'ed (e.g. removed
+            since they were found) are skipped like the walker does. """
+        for fname, st in files:
+            if st == None or stat.S_ISLNK(st.st_mode):
+                try:
+                    st = os.stat(fname)
+                except OSError, msg:
+                    sys.stderr.write('Error: %s\n' % msg)
+                    continue
+            yield fname, st
+
+    @staticmethod
+    def _growingBatches(items, firstSize, maxSize):
+        """ Split given iterable to lists, doubling the size of each list from firstSize up to maxSize. """
+        batch = []
+        batchSize = firstSize
+        for item in items:
+            batch.append(item)
+            if len(batch) >= batchSize:
+                yield batch
+                batch = []
+                batchSize = min(2 * batchSize, maxSize)
+        if batch:
+            yield batch
+
+    def _queryBatch(self, c, statement, params, files):
+        """ Yields (fname, st, metadata) for the rows of the query, metadata is None for the files needing reading. """
+        with perfstats.phase('db.query'):
+            with self.tempWrites():
+                c.execute('DELETE FROM candidates')
+                c.executemany('INSERT INTO candidates VALUES (?,?,?,?,?)', ((seq,) + splitPath(os.path.abspath(fname)) + (st.st_size if st else None, st.st_mtime if st else None)
+                                                                           for seq, (fname, st) in enumerate(files)))
+            rows = c.execute(statement, params).fetchall()
+        perfstats.count('query.files', len(files))
+
+        for row in rows:
+            fname, st = files[row[0]]
+            if row[1]:
+                perfstats.count('cache.miss')
+                yield fname, st, None
+            else:
+                perfstats.count('cache.hit')
+                yield fname, st, PhotoDB._rowToMetadata(fname, row[2:])
+
+    def _storeReadFiles(self, pending, exifFilter, wait):
+        """ Store the metadata of the read files in the database and yield (fname, metadata) for the ones passing the filter.
+            Waits for all the pending files if 'wait', otherwise handles only the ones ready. """
+        stillPending = []
+        for fname, st, res in pending:
+            if wait or res.ready():
+                vals = _asyncVals(res)
+            else:
+                stillPending.append((fname, st, res))
+                continue
+
+            md = ImageMetadata(fname)
+            md.fromVals(vals)
+            self.setMetadata(fname, md, st)
+            self.numUpdatedOnQuery += 1
+            with perfstats.phase('filter'):
+                passed = not exifFilter or exifFilter.apply(md)
+            if passed:
+                yield fname, md
+        pending[:] = stillPending
+
     def getMetadataStr(self, fname):
         """ Return a string representing metadata for given file. """
         md = self.getMetadata(fname)
         return str(md)
 
-    def setMetadata(self, fname, mdata):
+    def setMetadata(self, fname, mdata, st=None, fingerprint=None, rawData=None):
+        """ Store metadata for given file. The os.stat result and the fingerprint of the file can be given if already known.
+            The raw tags of the metadata (if read) are stored too, or given rawData (already packed, see packRaw).
+            The row is buffered and written with the next flush() or save(). """
         fname = os.path.abspath(fname)
-        try:
-            self.c.execute("INSERT INTO images VALUES (?,?,?,?,?,?,?,?,?,?,?)",
-                           (fname, os.path.getsize(fname), os.path.getmtime(fname), mdata.getOrigtime(), mdata.getFocalLength(), mdata.getFocalLength35(), mdata.getAperture(), mdata.getExposure(), mdata.getIso(), mdata.getRating(), mdata.getComment()))
-        except sqlite3.IntegrityError:
-            self.c.execute("UPDATE images SET filesize=?, modtime=?, origtime=?, flength=?, flength35=?, aperture=?, exposure=?, iso=?, rating=?, comment=? WHERE filepath=?",
-                           (os.path.getsize(fname), os.path.getmtime(fname), mdata.getOrigtime(), mdata.getFocalLength(), mdata.getFocalLength35(), mdata.getAperture(), mdata.getExposure(), mdata.getIso(), mdata.getRating(), mdata.getComment(), fname))
+        if st == None:
+            st = os.stat(fname)
+        if fingerprint == None:
+            fingerprint = fileFingerprint(fname, st.st_size)
+        dirpath, name = splitPath(fname)
+        dirId = self._dirId(dirpath)
+        vals = PhotoDB._metadataVals(mdata)
+        self.pendingRows.append((dirId, name, st.st_size, st.st_mtime) + vals[:9] + (fingerprint, mdata.phash) + vals[9:])
+        if mdata.raw != None:
+            rawData = packRaw(mdata.raw)
+        if rawData != None:
+            self.pendingRaw.append((rawData, dirId, name))
+        self.isModifiedButNotSaved = True
+
+        if len(self.pendingRows) >= PhotoDB.WRITE_BATCH_SIZE:
+            self.flush()
+
+    @staticmethod
+    def _metadataVals(mdata):
+        """ Return the values of the metadata columns of files for given metadata: origtime ... origepoch (in the order of
+            FILE_COLUMNS) followed by the GPS_COLUMNS and the CONFIG_COLUMNS. """
+        origtime = mdata.getOrigtime()
+        return (origtime, mdata.getFocalLength(), mdata.getFocalLength35(), mdata.getAperture(), mdata.getExposure(), mdata.getIso(), mdata.getRating(),
+                mdata.getComment(), origtimeToEpoch(origtime)) + tuple(mdata[col] for col in GPS_COLUMNS + CONFIG_COLUMNS)
 
     def _updateFile(self, fname):
         fname = os.path.abspath(fname)
@@ -127,7 +838,18 @@ class PhotoDB:
         if (self.isImage(fname)):
             self.setMetadata(fname, ImageMetadata(fname, True))
 
-    def update(self, paths, updateEvenIfNotModified=False):
+    def update(self, paths, updateEvenIfNotModified=False, jobs=1, full=False, prune=True, threads=1, resume=False, showProgress=False):
+        """ Update the database for given paths. With jobs > 1 the metadata is read in a pool of
+            worker processes while this process keeps writing the results to the database.
+            Directories not modified since the last update are skipped unless 'full' (or forced), and
+            with 'prune' the files that no longer exist are removed from the database.
+            With threads > 1 the directories are listed and the files stat'ed and fingerprinted in a pool of
+            threads, many requests in flight at once (for network file systems).
+            The work done is committed every CHECKPOINT_INTERVAL seconds or CHECKPOINT_FILES files (and when
+            interrupted with Ctrl-C). A directory is recorded as finished with its files, so with 'resume' the
+            directories finished by an interrupted update of the same paths are not updated again (also when forced
+            or 'full'). With 'showProgress' a progress line is drawn on stderr (a terminal), and the updated files
+            are not listed if stdout is the same terminal. """
         self.load()
 
         if type(paths) == type(str()):
@@ -135,37 +857,508 @@ class PhotoDB:
         elif type(paths) != type(list()):
             raise TypeError("Paths must be string or list of strings!")
 
+        if jobs < 1:
+            jobs = multiprocessing.cpu_count()
+
         numUpdated = 0
-        numSkipped = 0
+        numBytes = 0
+        counts = collections.Counter()
+        prunePaths = []
+        pruneDirs = []
+        deferredDirs = []  # States (mtime, nentries, id) of the listed directories written at the end
+        fingerprints = dict()  # fname -> fingerprint, computed when looking for moved files
+        movedPaths = []
 
-        for fname in PhotoDB.pathsToImageFiles(paths):
-            self.c.execute('SELECT filesize, modtime FROM images WHERE filepath=?', (os.path.abspath(fname),))
-            row = self.c.fetchone()
+        roots = [os.path.abspath(path).rstrip('/') for path in paths if os.path.isdir(path)]
+        bar = None
+        if showProgress:
+            bar = progress.Progress(sys.stderr, self._storedUnderFinished(roots))
+            if bar.total == None:
+                bar.countTotal(PhotoDB.countImageFiles, paths)
+        listFiles = not (showProgress and sys.stdout.isatty())
+        doneDirs = self._startUpdate(roots, resume)
 
-            updateNeeded = True
-            if row:
-                fsize = row[0]
-                modtime = row[1]
-                if (fsize == os.path.getsize(fname) and modtime == os.path.getmtime(fname)):
-                    updateNeeded = False
-
-            if updateNeeded or updateEvenIfNotModified:
-                self._updateFile(fname)
-                numUpdated += 1
+        def checkpoint():
+            # The rows of the moved files (they no longer exist, so pruning is not optional for them)
+            self.remove(movedPaths)
+            del movedPaths[:]
+            self.save()
+
+        pool = None
+        if jobs > 1:
+            pool = _newReaderPool(jobs, ImageMetadata.reader)
+        ioPool = iopipeline.newPool(threads)
+
+        try:
+            items = perfstats.timedIter('walk', self._walkForUpdate(paths, updateEvenIfNotModified, full or updateEvenIfNotModified, counts, prunePaths, pruneDirs,
+                                                                    ioPool, doneDirs, deferredDirs))
+            items = PhotoDB._withFingerprints(items, fingerprints, ioPool)
+            if not updateEvenIfNotModified:
+                items = self._reuseMoved(items, counts, fingerprints, movedPaths, listFiles)
+            checkpointed = time.time()
+            numCheckpointed = 0  # Files stored at the last checkpoint
+            for fname, st, vals in PhotoDB._readMetadata(items, pool, 4 * jobs):
+                if isinstance(fname, _ListedDir):
+                    self.pendingDirs.append(fname)
+                elif vals == None:
+                    counts['skipped'] += 1
+                else:
+                    mdata = ImageMetadata(fname)
+                    mdata.fromVals(vals)
+                    self.setMetadata(fname, mdata, st, fingerprints.pop(fname, None))
+                    numUpdated += 1
+                    numBytes += st.st_size
+                    if listFiles:
+                        print fname
+
+                numStored = numUpdated + counts['moved'] + counts['copied']
+                if time.time() - checkpointed >= PhotoDB.CHECKPOINT_INTERVAL or numStored - numCheckpointed >= PhotoDB.CHECKPOINT_FILES:
+                    checkpoint()
+                    checkpointed = time.time()
+                    numCheckpointed = numStored
+                if bar:
+                    bar.update(numStored + counts['skipped'], numUpdated, numBytes)
+        except KeyboardInterrupt:
+            if bar:
+                bar.clear()
+            checkpoint()
+            sys.stderr.write('Interrupted, updated %d files.\nTip: Continue by running the same update with -resume: "photodb -update -resume %s"\n' % (numUpdated, ' '.join(paths)))
+            raise
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+            iopipeline.closePool(ioPool)
+            if bar:
+                bar.clear()
+
+        self.remove(movedPaths)
+        numPruned = 0
+        if prune:
+            numPruned = self.remove(prunePaths, pruneDirs)
+        self.c.executemany('UPDATE dirs SET mtime=?, nentries=? WHERE id=?', deferredDirs)
+        self._finishUpdate(roots)
+
+        self.save()
+
+        print
+        print "Updated image database for %d files. Skipped %d files." % (numUpdated, counts['skipped'])
+        if counts['skippedDirs']:
+            print "Skipped %d unmodified directories." % counts['skippedDirs']
+        if counts['resumedDirs']:
+            print "Skipped %d directories finished by the interrupted update." % counts['resumedDirs']
+        if counts['moved'] or counts['copied']:
+            print "Reused the stored metadata of %d moved and %d copied files." % (counts['moved'], counts['copied'])
+        if numPruned:
+            print "Removed %d files that no longer exist." % numPruned
+
+    def _startUpdate(self, roots, resume=False):
+        """ Record the start of an update of given root directories. Returns the ids of the directories finished by the
+            interrupted update of each root (dict root -> set) if resuming, otherwise they are forgotten. """
+        doneDirs = dict()
+        for root in roots:
+            row = self.c.execute('SELECT started, finished FROM updates WHERE root=?', (root,)).fetchone()
+            if resume and row and row[1] == None:
+                doneDirs[root] = set(dirId for (dirId,) in self.c.execute('SELECT dir_id FROM update_dirs WHERE root=?', (root,)))
+                print "Resuming the update of %s started at %s." % (root or '/', datetime.datetime.fromtimestamp(row[0]).strftime('%Y-%m-%d %H:%M:%S'))
+                continue
+            if resume:
+                sys.stderr.write('Warning: No interrupted update of %s to resume, updating all of it.\n' % (root or '/'))
+            self.c.execute('DELETE FROM update_dirs WHERE root=?', (root,))
+            self.c.execute('INSERT OR REPLACE INTO updates(root, started, finished) VALUES (?, ?, NULL)', (root, time.time()))
+            doneDirs[root] = set()
+        return doneDirs
+
+    def _finishUpdate(self, roots):
+        for root in roots:
+            self.c.execute('UPDATE updates SET finished=? WHERE root=?', (time.time(), root))
+            self.c.execute('DELETE FROM update_dirs WHERE root=?', (root,))
+
+    def _storedUnderFinished(self, roots):
+        """ Return the number of files stored under given root directories if the previous update of each was finished
+            (the number of files the next update is expected to check), otherwise None. """
+        numFiles = 0
+        for root in roots:
+            row = self.c.execute('SELECT finished FROM updates WHERE root=?', (root,)).fetchone()
+            if not row or row[0] == None:
+                return None
+            under, params = PhotoDB._underCondition(root)
+            numFiles += self.c.execute('SELECT COUNT(*) FROM files f JOIN dirs d ON d.id = f.dir_id WHERE %s' % under, params).fetchone()[0]
+        return numFiles or None
+
+    def _walkForUpdate(self, paths, force, full, counts, prunePaths, pruneDirs, ioPool=None, doneDirs=None, deferredDirs=None):
+        """ Yield (fname, st) for the image files under given paths, st being None for the files that are up-to-date.
+            The directories that have not been modified since the last update are not listed (unless 'full'), their
+            files are only counted to counts['skipped']. The files and directories that no longer exist are
+            collected to prunePaths and pruneDirs. With ioPool (see iopipeline) the next directories of the walk are
+            listed and the files stat'ed in its threads; the database is only accessed in this thread.
+            After the files of each listed directory a _ListedDir is yielded (with st None). Its state is written
+            then only if the directory has no subdirectories and nothing to prune, the others are collected to
+            deferredDirs and written at the end: if the update is interrupted, they are listed again by the next one
+            (a new subdirectory that was not finished must not be skipped). The directories in doneDirs (root ->
+            set of ids, see _startUpdate) are only listed for their subdirectories, so a directory with files to prune
+            is not recorded as finished (its dirId is None): the prunes are only done at the end of the update. """
+        doneDirs = doneDirs or dict()
+        deferredDirs = deferredDirs if deferredDirs != None else []
+        c = self.conn.cursor()
+        scanner = iopipeline.Prefetcher(_scanDir, ioPool)
+        dirRows = dict()  # dirpath -> (id, mtime, nentries) in dirs or None, for the directories being prefetched
+
+        def dirRow(dirpath):
+            if dirpath in dirRows:
+                return dirRows.pop(dirpath)
+            return c.execute('SELECT id, mtime, nentries FROM dirs WHERE path=?', (os.path.abspath(dirpath).rstrip('/'),)).fetchone()
+
+        def storedMtime(row):
+            return row[1] if row and not full else None
+
+        for path in paths:
+            if os.path.isfile(path):
+                if PhotoDB.isImage(path):
+                    yield path, self._statIfModified(path, force)
+                continue
+            elif not os.path.isdir(path):
+                sys.stderr.write('Warning: Neither a file nor directory: %s \n' % path)
+                continue
+
+            root = os.path.abspath(path).rstrip('/')
+            done = doneDirs.get(root, set())
+            stack = [path]
+            while stack:
+                # Start listing the directories next in turn
+                for dirpath in stack[:-scanner.maxPending - 1:-1]:
+                    if dirpath not in dirRows:
+                        dirRows[dirpath] = dirRow(dirpath)
+                    scanner.prefetch(dirpath, storedMtime(dirRows[dirpath]))
+
+                dirpath = stack.pop()
+                absdir = os.path.abspath(dirpath)
+                row = dirRow(dirpath)
+                dirst, entries = scanner.get(dirpath, storedMtime(row))
+
+                if entries == None:
+                    # No files added, removed or renamed --> only descend to the known subdirectories
+                    counts['skipped'] += row[2]
+                    counts['skippedDirs'] += 1
+                    subdirs = [os.path.join(dirpath, name) for (name,) in c.execute('SELECT name FROM dirs WHERE parent=? AND nentries IS NOT NULL ORDER BY name', (row[0],))]
+                    stack.extend(reversed(subdirs))
+                    continue
+                elif isinstance(entries, OSError):
+                    if entries.errno in (errno.ENOENT, errno.ENOTDIR):
+                        # Removed after its parent was listed
+                        if row:
+                            pruneDirs.append(absdir.rstrip('/'))
+                    else:
+                        sys.stderr.write('Error: %s\n' % entries)
+                    continue
+
+                dirId = self._dirId(absdir.rstrip('/'))
+                if dirId in done:
+                    # Finished by the interrupted update being resumed
+                    subdirs = [entry.path for entry in entries if _isSubdir(entry)]
+                    counts['skipped'] += sum(1 for entry in entries if not entry.name.startswith('.') and PhotoDB.isImage(entry.name))
+                    counts['resumedDirs'] += 1
+                    stack.extend(reversed(subdirs))
+                    continue
+
+                files = []
+                subdirs = []
+                for entry, kind, st in iopipeline.orderedMap(_entryInfo, entries, ioPool):
+                    if kind == 'dir':
+                        subdirs.append(entry.path)
+                    elif kind == 'image':
+                        files.append((entry, st))
+
+                for entry, st in files:
+                    if isinstance(st, OSError):
+                        sys.stderr.write('Error: %s\n' % st)
+                        continue
+                    yield entry.path, self._statIfModified(entry.path, force, st)
+
+                # Rows of this directory's files (but not of its subdirectories) that no longer exist
+                numPrunes = len(prunePaths) + len(pruneDirs)
+                names = set(entry.name for entry in entries)
+                for (name,) in c.execute('SELECT name FROM files WHERE dir_id=?', (dirId,)).fetchall():
+                    if name not in names:
+                        prunePaths.append(os.path.join(absdir, name))
+                knownDirs = set(d for (d,) in c.execute('SELECT path FROM dirs WHERE parent=? AND nentries IS NOT NULL', (dirId,)))
+                pruneDirs.extend(knownDirs.difference(os.path.abspath(d) for d in subdirs))
+
+                # A directory modified just before it was listed might change again within its mtime resolution
+                mtime = dirst.st_mtime
+                if time.time() - mtime < PhotoDB.RACY_DIR_MTIME:
+                    mtime = None
+                state = (mtime, len(files), dirId)
+                hasPrunes = len(prunePaths) + len(pruneDirs) > numPrunes
+                if subdirs or hasPrunes:
+                    deferredDirs.append(state)
+                    state = None
+                yield _ListedDir(root, dirId if not hasPrunes else None, state), None
+
+                stack.extend(reversed(subdirs))
+
+    @staticmethod
+    def _withFingerprints(items, fingerprints, ioPool=None):
+        """ Compute the fingerprints of the (fname, st) items that are not up-to-date (in the threads of ioPool if any)
+            to 'fingerprints' (fname -> fingerprint). Yields the items. """
+        for fname, st, fingerprint in iopipeline.orderedMap(_withFingerprint, items, ioPool):
+            if st != None:
+                fingerprints[fname] = fingerprint
+            yield fname, st
+
+    def _reuseMoved(self, items, counts, fingerprints, movedPaths, listFiles=True):
+        """ Store the metadata of the (fname, st) items that have the same fingerprint as a file already in the database
+            by copying its row instead of reading the file. Yields the other items. The fingerprints are taken from
+            'fingerprints' (fname -> fingerprint, see _withFingerprints) and the paths of the moved files (that no longer
+            exist) are collected to 'movedPaths'. The stored files are printed if 'listFiles'. """
+        c = self.conn.cursor()
+        statement = "SELECT d.path || '/' || f.name AS filepath, (SELECT data FROM rawmeta WHERE file_id = f.rowid), f.phash, %s FROM files f JOIN dirs d ON d.id = f.dir_id " \
+                    "WHERE f.fingerprint=? AND filepath!=?" % ','.join('f.' + col for col in METADATA_COLUMNS)
+        for fname, st in items:
+            if st == None:
+                yield fname, st
+                continue
+
+            fingerprint = fingerprints.get(fname)
+            match = None
+            if fingerprint:
+                for row in c.execute(statement, (fingerprint, os.path.abspath(fname))).fetchall():
+                    if not os.path.exists(row[0]):
+                        match = row
+                        break
+                    match = match or row
+            if match == None:
+                yield fname, st
+                continue
+
+            del fingerprints[fname]
+            mdata = PhotoDB._rowToMetadata(fname, match[3:])
+            mdata.phash = match[2]
+            self.setMetadata(fname, mdata, st, fingerprint, match[1])
+            if os.path.exists(match[0]):
+                counts['copied'] += 1
+            else:
+                counts['moved'] += 1
+                movedPaths.append(match[0])
+            if listFiles:
                 print fname
+
+    def fileHash(self, fname):
+        """ Return the stored perceptual hash of given file, or None. """
+        self.flush()
+        dirpath, name = splitPath(os.path.abspath(fname))
+        row = self.c.execute('SELECT phash FROM files WHERE dir_id=? AND name=?', (self._dirId(dirpath, False), name)).fetchone()
+        return row[0] if row else None
+
+    def similarFiles(self, phash, maxdist):
+        """ Return the files whose perceptual hash is within maxdist of given hash as dict of filepath -> distance.
+            Only the rows having a chunk of the hash within maxdist // 4 bits (see perceptualhash) are compared. """
+        self.flush()
+        statement = "SELECT d.path || '/' || f.name, f.phash FROM files f JOIN dirs d ON d.id = f.dir_id WHERE f.phash IS NOT NULL"
+        maxBits = maxdist // perceptualhash.CHUNKS
+        if perceptualhash.numVariants(maxBits) > perceptualhash.MAX_LOOKUPS:
+            statements = [statement]
+        else:
+            # The chunk expressions of the indexes (see migration 7)
+            statements = [statement + ' AND ((f.phash >> %d) & %d) IN (%s)' % (perceptualhash.CHUNK_BITS * i, perceptualhash.CHUNK_MASK,
+                                                                              ','.join(map(str, perceptualhash.chunkVariants(perceptualhash.chunk(phash, i), maxBits))))
+                          for i in xrange(perceptualhash.CHUNKS)]
+
+        similar = dict()
+        with perfstats.phase('db.query'):
+            for statement in statements:
+                for fpath, h in self.c.execute(statement):
+                    dist = perceptualhash.distance(phash, h)
+                    if dist <= maxdist:
+                        similar[fpath] = dist
+        return similar
+
+    def duplicates(self, paths, maxdist):
+        """ Return the clusters of near-duplicate files (perceptual hashes within maxdist) under given paths as lists
+            of file paths, the biggest cluster first. """
+        self.load()
+        hashes = dict()
+        with perfstats.phase('db.query'):
+            for path in paths:
+                hashes.update(self.filesUnder(path, ('phash',), 'f.phash IS NOT NULL'))
+        with perfstats.phase('cluster'):
+            return perceptualhash.clusters(hashes.iteritems(), maxdist)
+
+    def remove(self, paths, dirs=()):
+        """ Remove given files and everything under given directories from the database. Return the number of removed files. """
+        self.flush()
+        numRemoved = 0
+        if paths:
+            self.c.executemany('DELETE FROM files WHERE dir_id=(SELECT id FROM dirs WHERE path=?) AND name=?', (splitPath(os.path.abspath(fpath)) for fpath in paths))
+            numRemoved += self.c.rowcount
+        for dirpath in dirs:
+            under, params = PhotoDB._underCondition(os.path.abspath(dirpath))
+            self.c.execute('DELETE FROM files WHERE dir_id IN (SELECT id FROM dirs d WHERE %s)' % under, params)
+            numRemoved += self.c.rowcount
+            self.c.execute('DELETE FROM dirs WHERE id IN (SELECT id FROM dirs d WHERE %s)' % under, params)
+            self.dirIds.clear()
+        self.isModifiedButNotSaved = True
+        return numRemoved
+
+    def rename(self, oldpath, newpath, isDir=False):
+        """ Move the rows of a renamed file (or of everything under a renamed directory) to the new path
+            without reading the files again. Return the number of renamed files. """
+        self.flush()
+        oldpath = os.path.abspath(oldpath)
+        newpath = os.path.abspath(newpath)
+        if not isDir:
+            newdir, newname = splitPath(newpath)
+            self.c.execute('DELETE FROM files WHERE dir_id=(SELECT id FROM dirs WHERE path=?) AND name=?', (newdir, newname))
+            self.c.execute('UPDATE files SET dir_id=?, name=? WHERE dir_id=(SELECT id FROM dirs WHERE path=?) AND name=?', (self._dirId(newdir), newname) + splitPath(oldpath))
+            self.isModifiedButNotSaved = True
+            return self.c.rowcount
+
+        # Only the rows of the directories are changed, the files keep their dir_id
+        self.remove((), [newpath])
+        olddir = oldpath.rstrip('/')
+        newdir = newpath.rstrip('/')
+        row = self.c.execute('SELECT id FROM dirs WHERE path=?', (olddir,)).fetchone()
+        if not row:
+            return 0
+        under, params = PhotoDB._underCondition(olddir)
+        numRenamed = self.c.execute('SELECT COUNT(*) FROM files WHERE dir_id IN (SELECT id FROM dirs d WHERE %s)' % under, params).fetchone()[0]
+
+        parent, name = splitPath(newdir)
+        self.c.execute('UPDATE dirs SET parent=?, name=?, path=? WHERE id=?', (self._dirId(parent), name, newdir, row[0]))
+        self.c.execute('UPDATE dirs SET path = ? || substr(path, ?) WHERE path > ? AND path < ?', (newdir, len(olddir) + 1, olddir + '/', olddir + '0'))
+        self.dirIds.clear()
+        self.isModifiedButNotSaved = True
+        return numRenamed
+
+    def _statIfModified(self, fname, force=False, st=None):
+        """ Return the os.stat result of given file if it is not in the database or has been
+            modified since (or if forced), otherwise None. The stat result can be given if already known. """
+        if st == None:
+            st = os.stat(fname)
+        if force:
+            return st
+
+        self.c.execute('SELECT filesize, modtime, fingerprint FROM files WHERE dir_id=(SELECT id FROM dirs WHERE path=?) AND name=?', splitPath(os.path.abspath(fname)))
+        row = self.c.fetchone()
+
+        if row:
+            fsize = row[0]
+            modtime = row[1]
+            if (fsize == st.st_size and modtime == st.st_mtime):
+                if row[2] == None:
+                    # Stored before the fingerprints were added
+                    self.c.execute('UPDATE files SET fingerprint=? WHERE dir_id=(SELECT id FROM dirs WHERE path=?) AND name=?',
+                                   (fileFingerprint(fname, fsize),) + splitPath(os.path.abspath(fname)))
+                    self.isModifiedButNotSaved = True
+                return None
+        return st
+
+    @staticmethod
+    def _readMetadata(items, pool=None, maxPending=1):
+        """ Read the metadata for (fname, st) items, in given process pool if any. Files with st None are not read.
+            Yields (fname, st, vals) in the same order as the items; vals is None if not read. """
+        if not pool:
+            for fname, st in items:
+                yield fname, st, (_readMetadataVals(fname) if st != None else None)
+            return
+
+        # Keep a bounded number of files in flight so that the results can be yielded in order.
+        pending = collections.deque()
+        for fname, st in items:
+            if st != None:
+                pending.append((fname, st, _readAsync(pool, fname)))
             else:
-                numSkipped += 1
-                #print fname + " - Skipped!"
+                pending.append((fname, st, None))
+
+            while pending and (len(pending) > maxPending or pending[0][2] == None):
+                fname, st, res = pending.popleft()
+                yield fname, st, (_asyncVals(res) if res else None)
+
+        while pending:
+            fname, st, res = pending.popleft()
+            yield fname, st, (_asyncVals(res) if res else None)
 
+    def backfill(self, fields=None):
+        """ Set the columns of given metadata fields (default the ones declared in the configuration file) from the stored
+            raw tags, without reading the files. Return (number of files updated, number of files without raw tags). """
+        self.load()
+        self.flush()
+        fields = list(fields or CONFIG_COLUMNS)
+        columns = FILE_COLUMNS[4:-1] + GPS_COLUMNS + CONFIG_COLUMNS  # The columns of PhotoDB._metadataVals
+        updated = fields + (['origepoch'] if 'origtime' in fields else [])
+        positions = [columns.index(col) for col in updated]
+        statement = 'UPDATE files SET %s WHERE rowid=?' % ', '.join('%s=?' % col for col in updated)
+
+        numUpdated = 0
+        md = ImageMetadata('')
+        rows = self.conn.cursor()
+        rows.execute('SELECT file_id, data FROM rawmeta')
+        while True:
+            batch = rows.fetchmany(10000)
+            if not batch:
+                break
+            updates = []
+            for fileId, data in batch:
+                md.clear()
+                md.fromRaw(unpackRaw(data), fields)
+                vals = PhotoDB._metadataVals(md)
+                updates.append(tuple(vals[i] for i in positions) + (fileId,))
+            with perfstats.phase('db.write'):
+                self.c.executemany(statement, updates)
+            numUpdated += len(updates)
 
+        numWithoutRaw = self.c.execute('SELECT COUNT(*) FROM files WHERE rowid NOT IN (SELECT file_id FROM rawmeta)').fetchone()[0]
+        self.isModifiedButNotSaved = True
         self.save()
+        return numUpdated, numWithoutRaw
 
-        print
-        print "Updated image database for %d files. Skipped %d files." % (numUpdated, numSkipped)
+    def check(self, paths, listFiles=False, threads=1):
+        """ Compare the database with the file system (sizes and modification times only) under given paths.
+            Print the number of new, modified, deleted and up-to-date files (and the files with 'listFiles').
+            The file system is accessed in given number of threads. Return true if the database is up-to-date. """
+        self.load()
 
+        # All the rows under the paths at once
+        stored = dict()
+        with perfstats.phase('db.query'):
+            for path in paths:
+                for fpath, fsize, modtime in self.filesUnder(path):
+                    stored[fpath] = (fsize, modtime)
+
+        counts = collections.Counter()
+        seen = set()  # In case of overlapping paths
+        ioPool = iopipeline.newPool(threads)
+        try:
+            for fname, st in perfstats.timedIter('walk', PhotoDB.imageFilesWithStat(paths, ioPool)):
+                fpath = os.path.abspath(fname)
+                if fpath in seen:
+                    continue
+                seen.add(fpath)
+
+                row = stored.pop(fpath, None)
+                if row == None:
+                    state = 'new'
+                elif row != (st.st_size, st.st_mtime):
+                    state = 'modified'
+                else:
+                    state = 'up-to-date'
+                counts[state] += 1
+                if listFiles and state != 'up-to-date':
+                    print '%-9s %s' % (state + ':', fname)
+        finally:
+            iopipeline.closePool(ioPool)
+
+        counts['deleted'] = len(stored)
+        if listFiles:
+            for fpath in sorted(stored):
+                print '%-9s %s' % ('deleted:', fpath)
+            print
+
+        print "New: %d, modified: %d, deleted: %d, up-to-date: %d files." % (counts['new'], counts['modified'], counts['deleted'], counts['up-to-date'])
+        return counts['new'] + counts['modified'] + counts['deleted'] == 0
 
     def size(self):
-        self.c.execute("SELECT COUNT(*) FROM images")
+        self.c.execute("SELECT COUNT(*) FROM files")
         return self.c.fetchone()
 
     def getInfo(self):
@@ -213,6 +1406,60 @@ class PhotoDB:
             else:
                 sys.stderr.write('Warning: Neither a file nor directory: %s \n' % path)
 
+    @staticmethod
+    def imageFilesWithStat(paths, ioPool=None):
+        """ Like pathsToImageFiles(), but yields (fname, st) with the os.stat result of each file. With ioPool (see
+            iopipeline) the next directories are listed and the files stat'ed in its threads. """
+        lister = iopipeline.Prefetcher(_listDir, ioPool)
+        for path in paths:
+            if os.path.isfile(path):
+                if PhotoDB.isImage(path):
+                    yield path, os.stat(path)
+                continue
+            elif not os.path.isdir(path):
+                sys.stderr.write('Warning: Neither a file nor directory: %s \n' % path)
+                continue
+
+            stack = [path]
+            while stack:
+                for dirpath in stack[:-lister.maxPending - 1:-1]:
+                    lister.prefetch(dirpath)
+                entries = lister.get(stack.pop())
+                if isinstance(entries, OSError):
+                    sys.stderr.write('Error: %s\n' % entries)
+                    continue
+
+                subdirs = []
+                for entry, kind, st in iopipeline.orderedMap(_entryInfo, entries, ioPool):
+                    if kind == 'dir':
+                        subdirs.append(entry.path)
+                    elif isinstance(st, OSError):
+                        sys.stderr.write('Error: %s\n' % st)
+                    elif kind == 'image':
+                        yield entry.path, st
+                stack.extend(reversed(subdirs))
+
+    @staticmethod
+    def countImageFiles(paths):
+        """ Return the number of image files under given paths (walked like update does), without stat'ing the files. """
+        numFiles = 0
+        stack = []
+        for path in paths:
+            if os.path.isfile(path):
+                numFiles += PhotoDB.isImage(path)
+            elif os.path.isdir(path):
+                stack.append(path)
+        while stack:
+            entries = _listDir(stack.pop())
+            if isinstance(entries, OSError):
+                continue
+            for entry in entries:
+                if _isSubdir(entry):
+                    stack.append(entry.path)
+                elif not entry.name.startswith('.') and PhotoDB.isImage(entry.name):
+                    numFiles += 1
+        return numFiles
+
     @staticmethod    
     def pathsToImageFiles(paths):
         for f in PhotoDB.pathsToFiles(paths):
@@ -229,39 +1476,143 @@ def main():
     modeGroup = parser.add_argument_group('Mode')
     group = modeGroup.add_mutually_exclusive_group()
     group.add_argument('-update', action='store_true', help='Update database for given path(s)')
-    group.add_argument('-check', action='store_true', help='Check if database is up-to-date for given path(s)')
+    group.add_argument('-check', action='store_true', help='Check if database is up-to-date for given path(s). Exit status is 0 if up-to-date, 1 if not.')
+    group.add_argument('-watch', action='store_true', help='Keep database up-to-date for given directories by watching them for changes (Linux only)')
     group.add_argument('-info', action='store_true', help='Print database info and exit. (default if no paths)')
     group.add_argument('-show', action='store_true', help='Show contents for given path(s) (default if paths given)')
     group.add_argument('-select', help='SQL select statement. E.g. "flength>100 AND rating>2"')
+    group.add_argument('-snapshot', action='store_true', help='Write a memory-mapped snapshot of the database for fast filtering in photofind (requires NumPy)')
+    group.add_argument('-dupes', action='store_true', help='List the groups of near-duplicate photos (by perceptual hash) under given path(s) (default all)')
+    group.add_argument('-backfill', nargs='*', metavar='FIELD', help='Set the given metadata fields (default the ones declared in %s) from the tags '
+                                                                      'stored in the database, without reading the files' % CONFIG_FILE)
+    group.add_argument('-serve', action='store_true', help='Answer the photofind queries on a Unix socket next to the database file (DBFILE.sock), '
+                                                          'keeping the database open and its cache warm between them')
+    group.add_argument('-report', nargs='*', metavar='FIELD', help='Print the number of photos and the count, min, max, mean and percentiles of given '
+                                                                    'metadata fields (e.g. flength iso) under given path(s) (default all)')
 
     parser.add_argument('-force', action='store_true', help='Update even if not modified')
+    parser.add_argument('-list', action='store_true', help='With -check, list the new, modified and deleted files')
+    parser.add_argument('-full', action='store_true', help='Check every file when updating, also in the directories that have not been modified')
+    parser.add_argument('-noprune', action='store_true', help='Do not remove the files that no longer exist from the database when updating')
+    parser.add_argument('-resume', action='store_true', help='With -update, continue an interrupted update of the same paths: the directories it '
+                                                            'finished are not updated again (also with -force and -full)')
+    parser.add_argument('-jobs', '-j', type=int, default=1, metavar='N', help='Read metadata in N parallel processes when updating (0 = number of CPUs, default 1)')
+    parser.add_argument('-threads', type=int, default=1, metavar='N', help='List directories, stat and fingerprint files in N threads when updating or checking, '
+                                                                       'to have many requests in flight on network file systems (default 1)')
+    parser.add_argument('-reader', choices=READERS, default=ImageMetadata.reader, help="Metadata reader: 'exiv2' (pyexiv2) or 'fast' (header-only, falls back to pyexiv2) (default %(default)s)")
+    parser.add_argument('-maxdist', type=int, default=perceptualhash.DUPES_MAXDIST, metavar='N',
+                        help='With -dupes, max Hamming distance (0-64) of the perceptual hashes of near-duplicates (default %(default)s)')
+    parser.add_argument('-by', metavar='GROUP[,GROUP]', help='With -report, report per group: year, month, day, hour, weekday, dir or a metadata '
+                                                              'field (e.g. -by month,flength)')
+    parser.add_argument('-percentiles', default='50,90', metavar='P[,P]', help='With -report, the percentiles (default %(default)s)')
+    parser.add_argument('-format', choices=['table', 'csv', 'json'], default='table', help='Output format of -report (default %(default)s)')
+    parser.add_argument('-debounce', type=float, default=2.0, metavar='SECONDS', help='With -watch, wait until a file has not changed for this long before reading it (default 2.0)')
     parser.add_argument('-dbfile', default=PhotoDB.DEFAULT_DBFILE, help='Database file to use (default %s)' % PhotoDB.DEFAULT_DBFILE)
+    parser.add_argument('-stats', action='store_true', help='Print the time spent in each phase and some counters to stderr when done')
+    parser.add_argument('-statsjson', metavar='FILE', help='Write the -stats data to FILE as JSON')
+    parser.add_argument('-profile', metavar='FILE', help='Profile the run with cProfile and write the data to FILE (view with: python -m pstats FILE)')
 
     args = parser.parse_args()
 
     # Set the default working mode (manually, perhaps could be set by argparse somehow?)
-    if (args.update + args.check + args.info + args.show + int(args.select != None)) == 0:
+    if (args.update + args.check + args.watch + args.info + args.show + args.snapshot + args.dupes + args.serve + int(args.select != None) + int(args.backfill != None) + int(args.report != None)) == 0:
         if len(args.paths) == 0:
             args.info = True
         else:
             args.show = True
     
-    if (args.update or args.check or args.show) and len(args.paths) == 0:
+    if (args.update or args.check or args.watch or args.show) and len(args.paths) == 0:
         parser.print_usage()
         sys.stderr.write('Error: No paths given!\n')
-        return 1
+        return 2
 
     if args.debug:
         pass
 
-    db = PhotoDB(args.dbfile)
+    ImageMetadata.reader = args.reader
+
+    if args.stats or args.statsjson:
+        perfstats.enable()
+    profiler = perfstats.startProfile() if args.profile else None
+
+    # Only the updates open the database for writing, the other modes don't block them (or each other)
+    db = PhotoDB(args.dbfile, readOnly=not (args.update or args.watch or args.backfill != None))
+    ret = 0
 
     if args.info:
         print db.getInfo()
     elif args.update:
-        db.update(args.paths, args.force)
+        try:
+            db.update(args.paths, args.force, args.jobs, args.full, not args.noprune, args.threads, args.resume, sys.stderr.isatty())
+        except KeyboardInterrupt:
+            ret = 130
     elif args.check:
-        print "Check behavior is TODO!"
+        if not db.check(args.paths, args.list, args.threads):
+            ret = 1
+    elif args.watch:
+        import photowatch
+        photowatch.Watcher(db, args.paths, args.debounce).run()
+    elif args.serve:
+        import photoserver
+        try:
+            photoserver.Server(args.dbfile).run()
+        except photoserver.AlreadyRunning, msg:
+            sys.stderr.write('Error: %s\n' % msg)
+            return 2
+    elif args.snapshot:
+        import photosnapshot
+        if photosnapshot.importNumpy() == None:
+            sys.stderr.write('Error: -snapshot requires NumPy.\n')
+            return 2
+        db.load()
+        t0 = time.time()
+        numFiles = photosnapshot.build(db)
+        print "Wrote snapshot of %d files to %s in %.1f s." % (numFiles, photosnapshot.snapshotPath(db.dbFile), time.time() - t0)
+    elif args.dupes:
+        numFiles = 0
+        clusters = db.duplicates(args.paths or ['/'], args.maxdist)
+        for cluster in clusters:
+            for fpath in cluster:
+                print fpath
+            print
+            numFiles += len(cluster)
+        print "Found %d groups of near-duplicates (%d files)." % (len(clusters), numFiles)
+    elif args.backfill != None:
+        unknown = [field for field in args.backfill if field not in KEYS]
+        if unknown:
+            sys.stderr.write('Error: Unknown metadata field: %s (declare new fields in %s)\n' % (', '.join(unknown), CONFIG_FILE))
+            return 2
+        if not args.backfill and not CONFIG_KEYS:
+            sys.stderr.write('Error: No fields given and none declared in %s\n' % CONFIG_FILE)
+            return 2
+        t0 = time.time()
+        numUpdated, numWithoutRaw = db.backfill(args.backfill)
+        print "Backfilled %d files in %.1f s." % (numUpdated, time.time() - t0)
+        if numWithoutRaw:
+            print
+            sys.stderr.write('Warning: %d files have no stored tags (stored before the tags were kept).\nTip: Read them again by running: "photodb -update -force PATH"\n' % numWithoutRaw)
+    elif args.report != None:
+        import photoreport
+        groupBy = args.by.split(',') if args.by else []
+        unknown = [field for field in args.report if field not in photoreport.numericFields()] + [group for group in groupBy if group not in photoreport.groups()]
+        if unknown:
+            sys.stderr.write('Error: Unknown or non-numeric field or group: %s (fields: %s; groups: %s)\n' %
+                             (', '.join(unknown), ' '.join(photoreport.numericFields()), ' '.join(photoreport.groups())))
+            return 2
+        try:
+            percentiles = [float(p) for p in args.percentiles.split(',')]
+        except ValueError:
+            percentiles = None
+        if not percentiles or not all(0 < p <= 100 for p in percentiles):
+            sys.stderr.write('Error: -percentiles must be numbers within 0...100 separated by commas\n')
+            return 2
+        if sqlite3.sqlite_version_info < photoreport.MIN_SQLITE_VERSION:
+            sys.stderr.write('Error: -report requires SQLite %s or newer (this is %s)\n' % ('.'.join(map(str, photoreport.MIN_SQLITE_VERSION)), sqlite3.sqlite_version))
+            return 2
+        db.load()
+        with perfstats.phase('db.query'):
+            columns, rows = photoreport.report(db, args.report, groupBy, args.paths, percentiles)
+        photoreport.write(columns, rows, args.format, sys.stdout, len(groupBy))
     elif args.select:
         db.load()
         for row in db.select(args.select):
@@ -275,6 +1626,14 @@ def main():
 
     db.close()
 
+    if profiler:
+        perfstats.stopProfile(profiler, args.profile)
+    if args.stats:
+        perfstats.report()
+    if args.statsjson:
+        perfstats.writeJson(args.statsjson)
+    return ret
+
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
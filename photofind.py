@@ -12,12 +12,26 @@ photofind Command-line tool for finding photos based on EXIF-information.
  
 """
 
+import os
 import sys
 import argparse
 from subprocess import Popen, PIPE
 
+import photoserver
+
+# Let the query server (photodb -serve) answer if one is running, before importing the rest
+if __name__ == "__main__":
+    status = photoserver.forward(sys.argv[1:])
+    if status != None:
+        sys.exit(status)
+
 import photodb
 import exiffilter
+import findwalk
+import perfstats
+import photosnapshot
+import perceptualhash
+import geo
 
 
 def debug(msg):
@@ -26,7 +40,55 @@ def debug(msg):
 def warn(msg):
     sys.stderr.write('Warning: ' + str(msg) + '\n')
     
-def main():
+def findFiles(find_cmd):
+    """ Run given find command and yield (path, None) for each found file as soon as it is printed. """
+    p = Popen(find_cmd, shell=True, stdout=PIPE)
+    for line in iter(p.stdout.readline, ''):
+        yield line.rstrip('\n'), None
+    p.wait()
+
+def similarTo(db, fname, maxdist):
+    """ Return the files in the database similar to given image file (see PhotoDB.similarFiles) as dict of
+        absolute path -> distance. Uses the stored perceptual hash of the file if it is in the database. """
+    phash = db.fileHash(fname)
+    if phash == None:
+        phash = perceptualhash.imageHash(fname)
+    if phash == None:
+        sys.stderr.write('Error: Cannot compute the perceptual hash of %s%s\n' % (fname, ' (requires PIL)' if perceptualhash.importImage() == None else ''))
+        sys.exit(2)
+    return db.similarFiles(phash, maxdist)
+
+def findFromDatabase(db, path, walker, exifFilter, printdb=False, verify=False, onlyPaths=None):
+    """ Print the files under given path found from the database only, without walking the directory tree. The find
+        tests of the walker are applied to the stored size and modification time. With 'verify' the files found are
+        checked to still exist, with 'onlyPaths' (a set of absolute paths) only those files are printed. Returns the
+        number of files skipped because they did not exist. """
+    abspath = os.path.abspath(path).rstrip('/')
+    prefix = path.rstrip('/')
+    nMissing = 0
+    for fpath, st, md in perfstats.timedIter('db.query', db.queryPath(path, exifFilter, printdb)):
+        # Print the paths like find would for the given path
+        if onlyPaths != None and fpath not in onlyPaths:
+            continue
+        relpath = fpath[len(abspath):]
+        depth = relpath.count('/')
+        if walker.maxdepth != None and depth > walker.maxdepth:
+            continue
+        if not walker.matches(os.path.basename(fpath), st, depth):
+            continue
+        fname = prefix + relpath if relpath else path
+        if verify and not os.path.lexists(fname):
+            nMissing += 1
+            continue
+        if printdb:
+            print fname + '\t' + str(md)
+        else:
+            print fname
+    return nMissing
+
+def main(argv=None, sharedDB=None):
+    """ Run photofind with given arguments (default sys.argv). The query server (see photoserver) passes its loaded
+        read-only PhotoDB as sharedDB, used for the queries of the same database. """
 
     #########################################################
     # Parse command line arguments
@@ -39,19 +101,39 @@ def main():
     parser.add_argument('-videos', action='store_true', help='TODO! (Include video files also)')
     parser.add_argument('-debug', '-d', action='store_true', help='Print some additional debug info')
     parser.add_argument('-printdb', action='store_true', help='Print output in DB-format')
-    parser.add_argument('-update', action='store_true', help='TODO! (Update image database for files that are not there yet.)')
+    parser.add_argument('-update', action='store_true', help='Update image database for files that are not there yet (or have been modified).')
+    parser.add_argument('-jobs', '-j', type=int, default=0, metavar='N', help='Number of parallel processes reading metadata with -update (default: number of CPUs)')
+    parser.add_argument('-reader', choices=photodb.READERS, default=photodb.ImageMetadata.reader, help='Metadata reader used with -update (default %(default)s)')
+    parser.add_argument('-nosnapshot', action='store_true', help='Do not use the database snapshot (written by photodb -snapshot) even if there is one')
+    parser.add_argument('-noserver', action='store_true', help='Run the query in this process even if the query server (photodb -serve) is running')
+    parser.add_argument('-dbonly', action='store_true', help='Find the files from the database only, without walking the directory tree. '
+                                                              'The -size and time tests use the stored size and modification time')
+    parser.add_argument('-verify', action='store_true', help='With -dbonly, leave out the found files that no longer exist')
+    parser.add_argument('-similar', metavar='IMAGE', help='Find the photos that look like IMAGE (near-duplicates, bursts) by their perceptual hashes '
+                                                          '(stored by photodb -update if PIL is installed)')
+    parser.add_argument('-maxdist', type=int, default=perceptualhash.SIMILAR_MAXDIST, metavar='N',
+                        help='With -similar, max Hamming distance (0-64) of the perceptual hashes (default %(default)s)')
     parser.add_argument('-dbfile', default=photodb.PhotoDB.DEFAULT_DBFILE, help='SimplePhotoDatabase file to use (default %s)' % photodb.PhotoDB.DEFAULT_DBFILE)
+    parser.add_argument('-stats', action='store_true', help='Print the time spent in each phase and some counters to stderr when done')
+    parser.add_argument('-statsjson', metavar='FILE', help='Write the -stats data to FILE as JSON')
+    parser.add_argument('-profile', metavar='FILE', help='Profile the run with cProfile and write the data to FILE (view with: python -m pstats FILE)')
    
-    exifgroup = parser.add_argument_group('Metadata filters')
+    exifgroup = parser.add_argument_group('Metadata filters', "Values: +x (greater), +=x, -x (less), -=x, x (equal), a..b (range), "
+                                                               "x,y (any of), !... (not), ! (no value). E.g. -iso 400..1600 -fl !50")
     exifgroup.add_argument('-rating', help='Rating filter')
     exifgroup.add_argument('-ot', help='OrigTime filter')
     exifgroup.add_argument('-fl', help='FocalLength filter')
     exifgroup.add_argument('-f', help='F-Number filter')
     exifgroup.add_argument('-iso', help='ISO speedrating filter')
     exifgroup.add_argument('-et', help='Expossure Time filter')
+    exifgroup.add_argument('-tag', action='append', default=[], metavar='KEY=FILTER', help='Filter by any tag stored in the database (Exiv2 key, e.g. '
+                           '-tag Exif.Photo.LensModel="EF50mm f/1.8 STM") or by a field declared in %s. Can be given many times.' % photodb.CONFIG_FILE)
+    exifgroup.add_argument('-near', metavar='LAT,LON,RADIUS', help='GPS position within RADIUS km (or e.g. 500m) of the point at LAT,LON (decimal degrees, '
+                           'negative for S and W: -near=-33.86,151.21,5)')
+    exifgroup.add_argument('-bbox', metavar='SOUTH,WEST,NORTH,EAST', help='GPS position within the latitudes SOUTH...NORTH and longitudes WEST...EAST')
 
     #args = parser.parse_args()
-    [args, unkown_args] = parser.parse_known_args()
+    [args, unkown_args] = parser.parse_known_args(argv)
 
     extensions_filter = ' \( -iname "*.' + '" -or -iname "*.'.join(photodb.IMAGE_EXTENSIONS) + '" \) '
     size_filter = '-size +20k '
@@ -63,17 +145,43 @@ def main():
 
     if (args.debug):
         debug(args)
-        debug(find_cmd)
+
+    if args.dbonly and args.update:
+        parser.error('argument -dbonly: not allowed with argument -update')
+
+    def loadDB(readOnly=True):
+        """ Return the shared database for the read-only queries, a newly loaded one otherwise. """
+        if sharedDB != None and readOnly and sharedDB.dbFile == os.path.abspath(os.path.expanduser(args.dbfile)):
+            return sharedDB
+        db = photodb.PhotoDB(args.dbfile, readOnly)
+        db.load()
+        return db
+
+    def closeDB(db):
+        if db is not sharedDB:
+            db.close()
+
+    if args.stats or args.statsjson:
+        perfstats.enable()
+    profiler = perfstats.startProfile() if args.profile else None
 
 
     #########################################################
-    # Perform the basic finding with standard find-utility
+    # Perform the basic finding, in-process if the find-options
+    # are supported, otherwise with the standard find-utility
     #########################################################
-    p = Popen(find_cmd, shell=True, stdout=PIPE, stderr=PIPE)
-    stdout, _ = p.communicate()
-
-    files = stdout.split('\n')
-    files.pop() # Remove the last - it's usually just empty line
+    try:
+        walker = findwalk.Walker(['-size', '+20k'] + unkown_args, photodb.IMAGE_EXTENSIONS)
+        files = walker.walk(args.path)
+    except findwalk.UnsupportedOption, msg:
+        if args.dbonly:
+            sys.stderr.write('Error: Unsupported find option with -dbonly: %s\n' % msg)
+            sys.exit(2)
+        if (args.debug):
+            debug('Using find-utility (unsupported option: %s)' % msg)
+            debug(find_cmd)
+        files = findFiles(find_cmd)
+    files = perfstats.timedIter('walk', files)
 
 
     #########################################################
@@ -89,38 +197,76 @@ def main():
     ef.add_filter('aperture', args.f)
     ef.add_filter('iso', args.iso)
     ef.add_filter('exposure', args.et)
+    for tagFilter in args.tag:
+        key, _, filterString = tagFilter.partition('=')
+        if not exiffilter.is_raw_key(key) and key not in photodb.KEYS:
+            parser.error('argument -tag: unknown field: %s' % key)
+        ef.add_filter(key, filterString)
+    for option, parse in (('near', geo.parseNear), ('bbox', geo.parseBbox)):
+        if getattr(args, option) != None:
+            try:
+                ef.add_area(parse(getattr(args, option)))
+            except ValueError, msg:
+                parser.error('argument -%s: %s' % (option, msg))
 
     metadataNeeded = ef.numFilters() > 0 or args.printdb
 
-    if not metadataNeeded:
-        for fname in files:
+    similar = None
+    if args.similar:
+        db = loadDB()
+        similar = similarTo(db, args.similar, args.maxdist)
+        closeDB(db)
+        if not args.dbonly:
+            files = ((fname, st) for fname, st in files if os.path.abspath(fname) in similar)
+
+    if args.dbonly:
+        db = loadDB()
+        nMissing = findFromDatabase(db, args.path, walker, ef, args.printdb, args.verify, similar)
+        closeDB(db)
+        if nMissing > 0:
+            print
+            warn('Skipped %d files that no longer exist.\nTip: Update the database first by running: "photodb -update %s"' % (nMissing, args.path))
+    elif not metadataNeeded:
+        for fname, _ in files:
             print fname
     else:
-        db = photodb.PhotoDB(args.dbfile)
-        db.load()
-
-        if args.update:
-            db.setUpdateIfNotFound(True)
+        db = None
 
+        # With a snapshot (see photodb -snapshot) the filters are evaluated as NumPy masks over all the files at once,
+        # otherwise by SQLite for whole batches of files at once
+        snapshot = None
+        if not (args.update or args.printdb or args.nosnapshot) and photosnapshot.hasColumns(ef.fields()):
+            snapshot = photosnapshot.load(args.dbfile)
+        if snapshot:
+            if (args.debug):
+                debug('Using snapshot %s' % snapshot.path)
+            results = snapshot.queryFiles(files, ef)
+        else:
+            db = loadDB(readOnly=not args.update)
+            if args.update:
+                photodb.ImageMetadata.reader = args.reader
+                db.setUpdateIfNotFound(True, args.jobs)
+            results = db.queryFiles(files, ef)
 
         nSkipped = 0
-        for fname in files:
-            md = db.getMetadata(fname)
+        for fname, md in results:
             if (md == None):
                 if (args.debug):
                     warn('No metadata available for %s.' % fname)
                 nSkipped += 1
                 continue
             else:
-                ret = ef.apply(md)
-                if ret:
-                    if (args.printdb):
-                        print fname + '\t' + str(md)
-                    else:
-                        print fname
-
-        db.close()
-        
+                if (args.printdb):
+                    print fname + '\t' + str(md)
+                else:
+                    print fname
+
+        if db:
+            closeDB(db)
+
+        if (args.debug and db and db.numUpdatedOnQuery > 0):
+            debug('Updated image database for %d files.' % db.numUpdatedOnQuery)
+
         if (nSkipped > 0):
             msg = 'Skipped %d image files because they were not found in database.' % nSkipped
             if (not args.debug):
@@ -130,6 +276,13 @@ def main():
             print
             warn(msg)
 
+    if profiler:
+        perfstats.stopProfile(profiler, args.profile)
+    if args.stats:
+        perfstats.report()
+    if args.statsjson:
+        perfstats.writeJson(args.statsjson)
+
 if __name__ == "__main__":
     main()
 
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2017 Juuso Räsänen <info@trimap.fi>
+
+"""
+ Aggregate reports of the photo database (photodb -report): the number of photos and the
+ count, min, max, mean and percentiles of metadata fields per group (e.g. month, focal
+ length or directory), as a text table, CSV or JSON.
+
+ The aggregation is done by SQLite. The files are scanned once, counting the files of
+ each combination of the groups and the field values to a temporary table. The statistics
+ of each field are computed from those counts, the percentiles (nearest rank) with running
+ sums of the counts over the values in order (window functions, SQLite 3.25 or newer), so
+ only the result rows are read to Python.
+
+"""
+
+import os
+import sys
+import csv
+import json
+import collections
+
+import photodb
+
+# Time buckets of the original time (origtime is 'YYYY-MM-DD HH:MM:SS')
+TIME_GROUPS = {'year': "substr(f.origtime, 1, 4)",
+               'month': "replace(substr(f.origtime, 1, 7), ':', '-')",
+               'day': "replace(substr(f.origtime, 1, 10), ':', '-')",
+               'hour': "substr(f.origtime, 12, 2)",
+               'weekday': "substr('0 Sun1 Mon2 Tue3 Wed4 Thu5 Fri6 Sat', 1 + 5 * strftime('%w', f.origepoch, 'unixepoch'), 5)"}
+FORMATS = ['table', 'csv', 'json']
+DEFAULT_PERCENTILES = [50, 90]
+MIN_SQLITE_VERSION = (3, 25, 0)  # Window functions
+BAR_WIDTH = 30  # Width of the histogram bars of the table
+
+
+def numericFields():
+    """ Return the metadata fields that can be aggregated. """
+    return sorted(key for key, datatype in photodb.TYPES.iteritems() if datatype in (float, int))
+
+def groups():
+    """ Return the names of the groups: the time buckets, 'dir' and the metadata fields. """
+    return sorted(TIME_GROUPS) + ['dir'] + sorted(photodb.KEYS)
+
+def _groupExpression(group):
+    """ Return SQL expression of given group on the files (f) and dirs (d) tables. """
+    if group in TIME_GROUPS:
+        return TIME_GROUPS[group]
+    if group == 'dir':
+        return 'd.path'
+    return 'f.' + group
+
+
+def report(db, fields, groupBy=(), paths=(), percentiles=DEFAULT_PERCENTILES):
+    """ Aggregate given metadata fields per given groups for the files under given paths (default all) in the loaded
+        PhotoDB. Returns (column names, rows), the rows ordered by the groups. The columns are the groups, the number
+        of files and for each field the number of files having a value and the min, max, mean and percentiles. """
+    db.flush()
+    c = db.conn.cursor()
+    groupExprs = [_groupExpression(group) for group in groupBy] or ['0']  # A single group if none
+    groupColumns = ', '.join('g%d' % i for i in xrange(len(groupExprs)))
+
+    conditions = []
+    params = []
+    for path in paths:
+        path = os.path.abspath(path)
+        under, underParams = photodb.PhotoDB._underCondition(path)
+        conditions.append('(d.path = ? AND f.name = ?) OR (%s)' % under)
+        params.extend(photodb.splitPath(path) + underParams)
+    join = ' JOIN dirs d ON d.id = f.dir_id' if paths or 'dir' in groupBy else ''
+
+    # The number of files of each combination of the groups and the values
+    columns = ['%s AS g%d' % (expr, i) for i, expr in enumerate(groupExprs)] + ['f.%s AS v%d' % (field, i) for i, field in enumerate(fields)]
+    with db.tempWrites():
+        c.execute('DROP TABLE IF EXISTS temp.report_counts')
+        c.execute('CREATE TEMP TABLE report_counts AS SELECT %s, count(*) AS cnt FROM files f%s WHERE %s GROUP BY %s' %
+                  (', '.join(columns), join, ' OR '.join('(%s)' % cond for cond in conditions) or '1', ', '.join(map(str, xrange(1, len(columns) + 1)))), params)
+
+    statsPerField = 4 + len(percentiles)
+    rows = collections.OrderedDict()
+    for row in c.execute('SELECT %s, sum(cnt) FROM report_counts GROUP BY %s ORDER BY %s' % (groupColumns, groupColumns, groupColumns)):
+        rows[row[:-1]] = [row[-1]] + [None] * (statsPerField * len(fields))
+
+    for i in xrange(len(fields)):
+        statement = '''SELECT %(g)s, max(n), min(val), max(val), sum(val * cnt) * 1.0 / max(n), %(percentiles)s FROM
+                         (SELECT %(g)s, val, cnt, sum(cnt) OVER (PARTITION BY %(g)s ORDER BY val ROWS UNBOUNDED PRECEDING) AS cum,
+                                 sum(cnt) OVER (PARTITION BY %(g)s) AS n FROM
+                            (SELECT %(g)s, v%(i)d AS val, sum(cnt) AS cnt FROM report_counts WHERE v%(i)d IS NOT NULL GROUP BY %(g)s, v%(i)d))
+                       GROUP BY %(g)s''' % \
+                    dict(g=groupColumns, i=i, percentiles=', '.join('min(CASE WHEN cum >= %r * n THEN val END)' % (p / 100.0) for p in percentiles))
+        start = 1 + i * statsPerField
+        for row in c.execute(statement):
+            rows[row[:len(groupExprs)]][start:start + statsPerField] = row[len(groupExprs):]
+    with db.tempWrites():
+        c.execute('DROP TABLE temp.report_counts')
+
+    names = list(groupBy) + ['files']
+    for field in fields:
+        names += ['%s_%s' % (field, stat) for stat in ['n', 'min', 'max', 'mean'] + ['p%g' % p for p in percentiles]]
+    return names, [(list(key) if groupBy else []) + stats for key, stats in rows.iteritems()]
+
+
+def _formatValue(val):
+    if val is None:
+        return ''
+    if isinstance(val, float):
+        if val == int(val) and abs(val) < 1e15:
+            return '%d' % val
+        return '%.4g' % val
+    return str(val)
+
+def write(columns, rows, fmt='table', out=sys.stdout, numGroups=0):
+    """ Write a report (see report()) in given format. The table has a histogram bar of the number of files of each
+        row if there are groups (numGroups = number of group columns). """
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        writer.writerows(['' if val is None else val for val in row] for row in rows)
+    elif fmt == 'json':
+        json.dump([collections.OrderedDict(zip(columns, row)) for row in rows], out, indent=2)
+        out.write('\n')
+    else:
+        cells = [columns] + [[_formatValue(val) for val in row] for row in rows]
+        widths = [max(len(cell[i]) for cell in cells) for i in xrange(len(columns))]
+        maxFiles = max([row[numGroups] for row in rows] or [0])
+        for n, cell in enumerate(cells):
+            line = '  '.join(val.ljust(width) if i < numGroups else val.rjust(width) for i, (val, width) in enumerate(zip(cell, widths)))
+            if numGroups and n > 0 and maxFiles:
+                line += '  ' + '#' * int(round(BAR_WIDTH * rows[n - 1][numGroups] / float(maxFiles)))
+            out.write(line.rstrip() + '\n')
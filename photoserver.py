@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2017 Juuso Räsänen <info@trimap.fi>
+
+"""
+ Query server of the photo database (photodb -serve) and its client used by photofind.
+
+ The server keeps the modules of photofind imported and the snapshot loaded between the
+ queries, and answers the photofind queries on a Unix socket next to the database file
+ (<dbfile>.sock, accessible only to the user running the server). photofind sends its
+ arguments and working directory, and the server runs the query like photofind would and
+ streams the output back while the query is running. Each query is answered in a forked
+ process (at most MAX_QUERIES at a time, the rest wait for their turn), as the queries
+ redirect stdout and change the working directory of their process. The forked process opens
+ its own connection to the database (an SQLite connection can't be used across fork), which
+ reads the database through the memory mapping, i.e. the page cache of the OS stays warm.
+
+ The messages are frames of a channel ('r' request, 'o' stdout, 'e' stderr, 'x' exit status)
+ and the length of the data. The request is the protocol version, the working directory and
+ the arguments separated by NUL bytes (they can't contain one).
+
+ Only the standard library is imported here (photodb and photofind are imported by the
+ server), and photofind forwards the query before importing the rest of photofind, so
+ that a query answered by the server doesn't load the modules for reading the files.
+
+"""
+
+import os
+import sys
+import time
+import errno
+import signal
+import socket
+import struct
+import traceback
+
+PROTOCOL_VERSION = 1
+FRAME_HEADER = struct.Struct('>cI')  # Channel, length of the data
+FLUSH_SIZE = 64 * 1024  # The output is sent when this many bytes are buffered...
+FLUSH_INTERVAL = 0.1  # ...or this many seconds have passed since the previous send
+BACKLOG = 32  # Max number of queries waiting for the server
+MAX_QUERIES = 8  # Max number of queries answered at the same time
+DEFAULT_DBFILE = '~/.photodb.db'  # Same as photodb.PhotoDB.DEFAULT_DBFILE (not imported, see above)
+IN_PROCESS_OPTIONS = ['-noserver', '-update', '-stats', '-statsjson', '-profile', '-h', '--help']  # photofind options not forwarded
+
+
+class AlreadyRunning(Exception):
+    pass
+
+
+def socketPath(dbFile):
+    """ Return the path of the socket of the server of given database file. """
+    return os.path.abspath(os.path.expanduser(dbFile)) + '.sock'
+
+def _sendFrame(sock, channel, data):
+    sock.sendall(FRAME_HEADER.pack(channel, len(data)) + data)
+
+def _readFrame(f):
+    """ Read a frame from given file object of a socket. Returns (channel, data), or None if the connection was closed. """
+    header = f.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        return None
+    channel, length = FRAME_HEADER.unpack(header)
+    data = f.read(length)
+    if len(data) < length:
+        return None
+    return channel, data
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+def _isOption(arg, options):
+    """ Return whether given argument is one of given options, or an abbreviation of one like argparse accepts
+        (e.g. -upd for -update). An ambiguous abbreviation matches too, the query fails the same either way. """
+    name = arg.partition('=')[0]
+    return len(name) > 1 and name != '--' and any(option.startswith(name) for option in options)
+
+
+def forward(argv):
+    """ Send the photofind query of given arguments to the server of its database (-dbfile) if one is running.
+        Returns the exit status, or None if the query should be run in-process: there is no server or the query has
+        one of IN_PROCESS_OPTIONS. The arguments are only scanned here, photofind parses them on the server. """
+    dbFile = DEFAULT_DBFILE
+    for i, arg in enumerate(argv):
+        if _isOption(arg, IN_PROCESS_OPTIONS):
+            return None
+        if arg == '-dbfile' and i + 1 < len(argv):
+            dbFile = argv[i + 1]
+        elif arg.startswith('-dbfile='):
+            dbFile = arg[len('-dbfile='):]
+    return query(dbFile, argv)
+
+def query(dbFile, argv, out=None, err=None):
+    """ Run photofind with given arguments on the server of given database file, writing its output to out and err
+        (default sys.stdout and sys.stderr). Returns the exit status of the query, or None if there is no server
+        running (or it closed the connection before answering), in which case the query should be run in-process. """
+    if out == None:
+        out = sys.stdout
+    if err == None:
+        err = sys.stderr
+    path = socketPath(dbFile)
+    if not os.path.exists(path):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    answered = False
+    try:
+        sock.connect(path)
+        _sendFrame(sock, 'r', '\0'.join([str(PROTOCOL_VERSION), os.getcwd()] + list(argv)))
+        f = sock.makefile('rb', FLUSH_SIZE)
+        while True:
+            frame = _readFrame(f)
+            if frame == None:
+                break
+            channel, data = frame
+            answered = True
+            if channel == 'x':
+                return int(data)
+            (out if channel == 'o' else err).write(data)
+    except socket.error, msg:
+        if not answered:
+            return None  # E.g. a stale socket of a server that did not exit cleanly
+    finally:
+        sock.close()
+
+    if not answered:
+        return None
+    err.write('Error: The query server (photodb -serve) closed the connection before the query was finished.\n')
+    return 1
+
+
+class _Output:
+    """ File-like object sending what is written to it as frames of given channel, buffered up to bufferSize bytes
+        or FLUSH_INTERVAL seconds. 'before' (the stdout of the stderr) is flushed first, to keep the order of the output. """
+
+    def __init__(self, sock, channel, bufferSize=FLUSH_SIZE, before=None):
+        self.sock = sock
+        self.channel = channel
+        self.bufferSize = bufferSize
+        self.before = before
+        self.buffer = []
+        self.size = 0
+        self.sent = time.time()
+
+    def write(self, data):
+        if self.before:
+            self.before.flush()
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.bufferSize or time.time() - self.sent >= FLUSH_INTERVAL:
+            self.flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if self.buffer:
+            _sendFrame(self.sock, self.channel, ''.join(self.buffer))
+            self.buffer = []
+            self.size = 0
+        self.sent = time.time()
+
+    def isatty(self):
+        return False
+
+
+class Server:
+    """ Answers the photofind queries of a database on its socket until interrupted (Ctrl-C or SIGTERM). """
+
+    def __init__(self, dbFile):
+        self.dbFile = os.path.abspath(os.path.expanduser(dbFile))
+        self.path = socketPath(dbFile)
+        self.db = None  # The read-only PhotoDB of the query (in the forked process)
+        self.children = set()  # Pids of the processes answering the queries
+        self.numQueries = 0
+
+    def run(self):
+        sock = self.listen()
+        signal.signal(signal.SIGTERM, _interrupt)
+        try:
+            self.prepare()
+            print "Serving the queries of %s on %s." % (self.dbFile, self.path)
+            sys.stdout.flush()
+            while True:
+                self.reap(len(self.children) >= MAX_QUERIES)
+                conn, _ = sock.accept()
+                try:
+                    self.loadSnapshot()
+                    self.fork(sock, conn)
+                finally:
+                    conn.close()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sock.close()
+            os.remove(self.path)
+            while self.children:
+                self.reap(True)
+        print "Answered %d queries." % self.numQueries
+
+    def prepare(self):
+        """ Import the modules of the queries and create or migrate the database if needed. """
+        import photofind
+        import photodb
+        db = photodb.PhotoDB(self.dbFile, readOnly=True)
+        db.load()
+        db.close()
+        self.loadSnapshot()
+
+    def loadSnapshot(self):
+        """ Load the current snapshot (if there is one), to be inherited by the forked processes. Rebuilding an
+            outdated one is left to the queries using it. """
+        import photosnapshot
+        photosnapshot.load(self.dbFile, rebuild=False)
+
+    def fork(self, sock, conn):
+        """ Answer the query of given connection in a forked process. """
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return
+
+        status = 1
+        try:
+            sock.close()
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            if self.handle(conn):
+                status = 0
+        except socket.error, msg:
+            # The client is gone (e.g. photofind ... | head)
+            if msg.errno not in (errno.EPIPE, errno.ECONNRESET):
+                sys.stderr.write('Warning: Query aborted: %s\n' % msg)
+        except KeyboardInterrupt:
+            pass
+        except:
+            traceback.print_exc()
+        finally:
+            sys.stderr.flush()
+            os._exit(status)  # Without the cleanup of the server process
+
+    def reap(self, wait):
+        """ Collect the exited query processes, waiting for one to exit if 'wait'. """
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, 0 if wait else os.WNOHANG)
+            except OSError, msg:
+                if msg.errno == errno.EINTR:
+                    continue
+                raise
+            if pid == 0:
+                return
+            self.children.discard(pid)
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                self.numQueries += 1
+            wait = False
+
+    def listen(self):
+        """ Return the listening socket. A socket file left by a server that did not exit cleanly is replaced.
+            Raises AlreadyRunning if another server is answering on the socket. """
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                raise AlreadyRunning('Another server is already running on %s' % self.path)
+            except socket.error:
+                os.remove(self.path)
+            finally:
+                probe.close()
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0177)  # Only the user can connect
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        sock.listen(BACKLOG)
+        return sock
+
+    def handle(self, conn):
+        """ Answer the query sent on given connection. Returns False if it was not a query. """
+        frame = _readFrame(conn.makefile('rb'))
+        if frame == None or frame[0] != 'r':
+            return False  # Not a query (e.g. listen() of another server checking whether this one is running)
+        fields = frame[1].split('\0')
+        version, cwd, argv = fields[0], fields[1], fields[2:]
+
+        out = _Output(conn, 'o')
+        err = _Output(conn, 'e', 0, out)
+        if version != str(PROTOCOL_VERSION):
+            err.write('Error: photofind and the query server (photodb -serve) are different versions, restart the server.\n')
+            status = 2
+        else:
+            status = self.query(cwd, argv, out, err)
+        out.flush()
+        _sendFrame(conn, 'x', str(status))
+        return True
+
+    def query(self, cwd, argv, out, err):
+        """ Run photofind with given arguments in given directory, its stdout and stderr redirected to out and err.
+            Returns the exit status. """
+        import photofind
+        import photodb
+        stdout, stderr = sys.stdout, sys.stderr
+        oldCwd = os.getcwd()
+        sys.stdout, sys.stderr = out, err
+        try:
+            os.chdir(cwd)
+            if self.db == None:
+                self.db = photodb.PhotoDB(self.dbFile, readOnly=True)
+                self.db.load()
+            photofind.main(argv, self.db)
+            return 0
+        except SystemExit, e:
+            if e.code == None or isinstance(e.code, int):
+                return e.code or 0
+            err.write(str(e.code) + '\n')
+            return 1
+        except OSError, msg:
+            err.write('Error: %s\n' % msg)
+            return 1
+        except socket.error:
+            raise
+        except Exception:
+            traceback.print_exc()
+            return 1
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            os.chdir(oldCwd)
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2017 Juuso Räsänen <info@trimap.fi>
+
+"""
+ Memory-mapped columnar snapshot of the photo database for vectorised filtering with NumPy.
+
+ The snapshot is a directory next to the database file with one .npy array per column
+ (NaN for missing numbers), the file paths as a single blob with an offset table, and the
+ 64-bit hashes of the paths in sorted order for finding the rows of given files. The
+ metadata filters are evaluated as boolean masks over the whole arrays. load() rebuilds
+ the snapshot if the database has been modified since it was written.
+
+ <dbfile>.snapshot is a symlink to the current snapshot directory (<dbfile>.snapshot.XXXXXX),
+ so that a rebuild is swapped in atomically while other processes are using the old one. The
+ rebuilds are done one at a time (locking <dbfile>.snapshot.lock), a process waiting for
+ another one to finish its rebuild uses that snapshot.
+
+ Requires NumPy (optional for the rest of photofind).
+
+"""
+
+import os
+import json
+import mmap
+import time
+import fcntl
+import errno
+import shutil
+import struct
+import hashlib
+import tempfile
+
+from ImageMetadata import ImageMetadata
+import photodb
+
+FORMAT_VERSION = 1
+INT_COLUMNS = ['filesize']
+FLOAT_COLUMNS = ['modtime', 'flength', 'flength35', 'aperture', 'exposure', 'iso', 'rating', 'origepoch']
+STRING_COLUMNS = ['origtime']
+FETCH_SIZE = 10000
+_loaded = dict()  # Snapshot path -> (creation time, Snapshot) of the snapshots loaded by this process
+
+# Imported on the first use (see importNumpy), the queries without a snapshot don't need it
+numpy = None
+_numpyTried = False
+
+
+def importNumpy():
+    """ Import NumPy on the first call and return it, or None if it is not installed. """
+    global numpy, _numpyTried
+    if not _numpyTried:
+        _numpyTried = True
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy
+
+
+def snapshotPath(dbFile):
+    return os.path.expanduser(dbFile) + '.snapshot'
+
+def dbSignature(dbFile):
+    """ Return the sizes and modification times of the database file (and its WAL file) for detecting changes. An empty
+        WAL file is the same as none, as SQLite removes it when the last connection is closed. """
+    signature = []
+    for fname in (dbFile, dbFile + '-wal'):
+        try:
+            st = os.stat(fname)
+        except OSError:
+            st = None
+        if st and (st.st_size or fname == dbFile):
+            signature.extend([st.st_size, st.st_mtime])
+        else:
+            signature.extend([None, None])
+    return signature
+
+def hasColumns(fields):
+    """ Return true if the snapshot has the columns of given metadata fields (not the raw tags or the configured fields). """
+    return all(field in INT_COLUMNS + FLOAT_COLUMNS + STRING_COLUMNS for field in fields)
+
+def pathHash(fpath):
+    return struct.unpack('<q', hashlib.md5(fpath).digest()[:8])[0]
+
+
+def _lock(path):
+    """ Return the lock file of given snapshot, opened and locked (exclusively) for a build. Closing it releases the lock. """
+    lock = open(path + '.lock', 'a')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    return lock
+
+def _readMeta(path):
+    """ Return the meta.json of given snapshot directory, or None if there is no snapshot. """
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            return json.load(f)
+    except IOError, msg:
+        if msg.errno != errno.ENOENT:
+            raise
+        return None
+
+def _isCurrent(meta, dbFile):
+    return meta != None and meta.get('version') == FORMAT_VERSION and meta.get('signature') == dbSignature(dbFile)
+
+def build(db):
+    """ Write the snapshot of given (loaded) PhotoDB, replacing the old one. Return the number of files. """
+    importNumpy()
+    path = snapshotPath(db.dbFile)
+    lock = _lock(path)
+    try:
+        return _build(db, path)
+    finally:
+        lock.close()
+
+def _build(db, path):
+    """ Build the snapshot (with the lock held). """
+    db.flush()
+    # Copy the committed changes from the WAL to the database file and empty the WAL, so that the signature does not
+    # change when the WAL is checkpointed and removed as the connections are closed (busy if other processes are using it)
+    db.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    signature = dbSignature(db.dbFile)  # Before reading, so that changes made during the export cause a rebuild later
+    _removeLeftovers(path)
+    tmpPath = tempfile.mkdtemp(prefix=os.path.basename(path) + '.', dir=os.path.dirname(path))
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmpPath, 0777 & ~umask)  # Like a directory made with os.makedirs, mkdtemp makes it private
+    try:
+        numRows = _write(db, tmpPath, signature)
+        _swap(path, tmpPath)
+    except:
+        shutil.rmtree(tmpPath, True)
+        raise
+    return numRows
+
+def _swap(path, newPath):
+    """ Make the snapshot symlink point to given directory (atomically, by renaming a new symlink over it) and remove
+        the directory it pointed to. """
+    oldPath = None
+    if os.path.islink(path):
+        oldPath = os.path.join(os.path.dirname(path), os.readlink(path))
+    elif os.path.isdir(path):
+        # Written by a version without the symlink
+        oldPath = newPath + '.old'
+        os.rename(path, oldPath)
+    link = newPath + '.link'
+    os.symlink(os.path.basename(newPath), link)
+    os.rename(link, path)
+    if oldPath:
+        shutil.rmtree(oldPath, True)
+
+def _removeLeftovers(path):
+    """ Remove the snapshot directories and symlinks of the builds that were interrupted (all but the current one). """
+    dirname = os.path.dirname(path) or '.'
+    current = os.path.realpath(path)
+    for name in os.listdir(dirname):
+        if not name.startswith(os.path.basename(path) + '.') or name.endswith('.lock'):
+            continue
+        leftover = os.path.join(dirname, name)
+        if os.path.islink(leftover):
+            os.remove(leftover)
+        elif os.path.isdir(leftover) and os.path.realpath(leftover) != current:
+            shutil.rmtree(leftover, True)
+
+def _write(db, tmpPath, signature):
+    """ Write the snapshot files of given PhotoDB to given directory. Return the number of files. """
+    chunks = dict((col, []) for col in INT_COLUMNS + FLOAT_COLUMNS + STRING_COLUMNS)
+    offsets = [numpy.zeros(1, numpy.int64)]
+    hashes = []
+    pos = 0
+
+    c = db.conn.cursor()
+    c.execute('SELECT filepath, %s FROM images' % ','.join(INT_COLUMNS + FLOAT_COLUMNS + STRING_COLUMNS))
+    with open(os.path.join(tmpPath, 'filepath.bin'), 'wb') as blob:
+        while True:
+            rows = c.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            columns = zip(*rows)
+            fpaths = columns[0]
+            for i, col in enumerate(INT_COLUMNS + FLOAT_COLUMNS, 1):
+                # None -> NaN for the floats
+                chunks[col].append(numpy.array(columns[i], numpy.int64 if col in INT_COLUMNS else numpy.float64))
+            for i, col in enumerate(STRING_COLUMNS, 1 + len(INT_COLUMNS) + len(FLOAT_COLUMNS)):
+                chunks[col].append(numpy.array([val or '' for val in columns[i]], 'S'))
+
+            blob.write(''.join(fpaths))
+            lengths = numpy.fromiter((len(fpath) for fpath in fpaths), numpy.int64, len(fpaths))
+            offsets.append(pos + numpy.cumsum(lengths))
+            pos += lengths.sum()
+            hashes.append(numpy.fromiter((pathHash(fpath) for fpath in fpaths), numpy.int64, len(fpaths)))
+
+    numRows = sum(len(chunk) for chunk in hashes)
+    for col, colChunks in chunks.iteritems():
+        if col in STRING_COLUMNS:
+            array = numpy.concatenate(colChunks) if colChunks else numpy.zeros(0, 'S1')
+        else:
+            array = numpy.concatenate(colChunks) if colChunks else numpy.zeros(0, numpy.int64 if col in INT_COLUMNS else numpy.float64)
+        numpy.save(os.path.join(tmpPath, col + '.npy'), array)
+    numpy.save(os.path.join(tmpPath, 'offsets.npy'), numpy.concatenate(offsets))
+
+    hashes = numpy.concatenate(hashes) if hashes else numpy.zeros(0, numpy.int64)
+    order = numpy.argsort(hashes, kind='mergesort')
+    numpy.save(os.path.join(tmpPath, 'pathhash.npy'), hashes[order])
+    numpy.save(os.path.join(tmpPath, 'pathorder.npy'), order)
+
+    with open(os.path.join(tmpPath, 'meta.json'), 'w') as f:
+        json.dump(dict(version=FORMAT_VERSION, rows=numRows, signature=signature, created=time.time()), f)
+    return numRows
+
+
+def load(dbFile, rebuild=True):
+    """ Return the Snapshot of given database or None if there is no snapshot (or NumPy is not installed).
+        The snapshot is rebuilt first if the database has been modified since (unless not 'rebuild'). A snapshot
+        already loaded by this process (the query server) is returned again if it has not been rebuilt since. """
+    dbFile = os.path.expanduser(dbFile)
+    path = snapshotPath(dbFile)
+    if not os.path.isfile(os.path.join(path, 'meta.json')) or importNumpy() is None:
+        return None
+    try:
+        return _load(dbFile, path, rebuild)
+    except EnvironmentError:
+        # Replaced (and removed) by the rebuild of another process while it was being opened, open the new one
+        return _load(dbFile, path, rebuild)
+
+def _load(dbFile, path, rebuild):
+    realPath = os.path.realpath(path)  # The current snapshot, the symlink may be swapped meanwhile
+    meta = _readMeta(realPath)
+    if not _isCurrent(meta, dbFile):
+        if not rebuild:
+            return None
+        lock = _lock(path)
+        try:
+            # Unless another process rebuilt it while this one was waiting for the lock
+            realPath = os.path.realpath(path)
+            meta = _readMeta(realPath)
+            if not _isCurrent(meta, dbFile):
+                db = photodb.PhotoDB(dbFile, readOnly=True)
+                db.load()
+                _build(db, path)
+                db.close()
+                realPath = os.path.realpath(path)
+                meta = _readMeta(realPath)
+        finally:
+            lock.close()
+
+    if path not in _loaded or _loaded[path][0] != meta['created']:
+        _loaded[path] = (meta['created'], Snapshot(realPath))
+    return _loaded[path][1]
+
+
+class Snapshot:
+    """ A loaded (memory mapped) snapshot. """
+
+    def __init__(self, path):
+        self.path = path
+        self.columns = dict()
+        for col in INT_COLUMNS + FLOAT_COLUMNS + STRING_COLUMNS:
+            self.columns[col] = numpy.load(os.path.join(path, col + '.npy'), mmap_mode='r')
+        self.offsets = numpy.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        self.hashes = numpy.load(os.path.join(path, 'pathhash.npy'), mmap_mode='r')
+        self.order = numpy.load(os.path.join(path, 'pathorder.npy'), mmap_mode='r')
+        self.size = len(self.hashes)
+
+        with open(os.path.join(path, 'filepath.bin'), 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.blob = ''
+
+    def filepath(self, row):
+        return self.blob[self.offsets[row]:self.offsets[row + 1]]
+
+    def lookup(self, fpaths):
+        """ Return the rows of given absolute paths as a list (-1 for the paths not in the snapshot). """
+        if not self.size:
+            return [-1] * len(fpaths)
+        hashes = numpy.fromiter((pathHash(fpath) for fpath in fpaths), numpy.int64, len(fpaths))
+        idx = numpy.searchsorted(self.hashes, hashes)
+        idx = numpy.minimum(idx, self.size - 1)
+        found = self.hashes[idx] == hashes
+        rows = numpy.where(found, self.order[idx], -1).tolist()
+
+        # Check the paths (a hash collision is very unlikely, but possible)
+        for i in numpy.flatnonzero(found).tolist():
+            if self.filepath(rows[i]) == fpaths[i]:
+                continue
+            rows[i] = -1
+            j = idx[i] + 1
+            while j < self.size and self.hashes[j] == hashes[i]:
+                if self.filepath(self.order[j]) == fpaths[i]:
+                    rows[i] = int(self.order[j])
+                    break
+                j += 1
+        return rows
+
+    def metadata(self, fname, row):
+        md = ImageMetadata(fname)
+        vals = dict()
+        for col in photodb.METADATA_COLUMNS:
+            if col in self.columns:
+                val = self.columns[col][row]
+                if col in STRING_COLUMNS:
+                    vals[col] = val or None
+                elif val == val:  # Not NaN
+                    vals[col] = val
+        md.fromVals(vals)
+        return md
+
+    def queryFiles(self, files, exifFilter=None):
+        """ Like PhotoDB.queryFiles (without updating): yields (fname, metadata) for the given (fname, st) files passing
+            the filter and (fname, None) for the files not in the snapshot. """
+        mask = None
+        if exifFilter:
+            with numpy.errstate(invalid='ignore'):
+                mask = exifFilter.to_mask(self.columns)
+
+        for batch in photodb.PhotoDB._growingBatches(files, 100, photodb.PhotoDB.QUERY_BATCH_SIZE):
+            rows = self.lookup([os.path.abspath(fname) for fname, st in batch])
+            for (fname, st), row in zip(batch, rows):
+                if row < 0:
+                    yield fname, None
+                elif mask is None or mask[row]:
+                    yield fname, self.metadata(fname, row)
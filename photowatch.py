@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2017 Juuso Räsänen <info@trimap.fi>
+
+"""
+ Keeps the photo database up-to-date by watching the file system with Linux inotify.
+
+ Usage: photodb -watch PATH [PATH ...]
+
+"""
+
+import os
+import sys
+import time
+import errno
+import signal
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from ImageMetadata import ImageMetadata
+import findwalk
+import photodb
+
+
+# Event masks from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+
+_EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+
+class Inotify:
+    """ Minimal ctypes wrapper for the inotify API. """
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed: ' + os.strerror(ctypes.get_errno()))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            msg = os.strerror(err)
+            if err == errno.ENOSPC:
+                msg += ' (increase fs.inotify.max_user_watches)'
+            raise OSError(err, '%s: %s' % (path, msg))
+        return wd
+
+    def rm_watch(self, wd):
+        """ Stop watching given watch descriptor. Errors are ignored: the kernel removes the watch of a deleted directory by itself. """
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout=None):
+        """ Return the available events as (wd, mask, cookie, name) tuples, waiting for at most 'timeout' seconds. """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        buf = os.read(self.fd, 64 * 1024)
+        events = []
+        pos = 0
+        while pos < len(buf):
+            wd, mask, cookie, namelen = _EVENT_HEADER.unpack_from(buf, pos)
+            pos += _EVENT_HEADER.size
+            name = buf[pos:pos + namelen].rstrip('\0')
+            pos += namelen
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    """ Applies the file system changes under given paths to the database.
+
+        Changes are debounced: a file is read only after it has not changed for 'debounce' seconds,
+        so files being written are not read over and over. The changes are committed in batches.
+        Renamed files and directories keep their rows (no re-reading). """
+
+    def __init__(self, db, paths, debounce=2.0):
+        self.db = db
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.debounce = debounce
+        self.inotify = None
+        self.watches = dict()  # wd -> directory path
+        self.pending = dict()  # path -> (action, time of the last event); action is 'update' or 'remove'
+        self.moves = dict()  # cookie -> (path, isDir, time) for IN_MOVED_FROM waiting for their IN_MOVED_TO
+
+    def run(self):
+        """ Watch until interrupted (Ctrl-C or SIGTERM). """
+        signal.signal(signal.SIGTERM, _interrupt)
+        try:
+            self.start()
+            print "Watching %d directories." % len(self.watches)
+            sys.stdout.flush()
+            while True:
+                self.poll()
+        except KeyboardInterrupt:
+            self.applyPending(force=True)
+        finally:
+            self.stop()
+
+    def start(self):
+        """ Set the watches and bring the database up-to-date with the changes made before them. """
+        self.db.load()
+        self.inotify = Inotify()
+        for path in self.paths:
+            if os.path.isdir(path):
+                self.addWatches(path)
+            else:
+                sys.stderr.write('Warning: Not a directory: %s \n' % path)
+        self.db.update(self.paths)
+
+    def poll(self):
+        """ Process the events arriving within half of the debounce time and apply the changes that are ready. """
+        self.processEvents(self.inotify.read_events(self.debounce / 2))
+        self.applyPending()
+
+    def stop(self):
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
+        self.db.save()
+
+    def addWatches(self, dirpath, scan=False):
+        """ Watch given directory and its (non-hidden) subdirectories. With 'scan' the image files found are scheduled for update. """
+        stack = [dirpath]
+        while stack:
+            path = stack.pop()
+            try:
+                self.watches[self.inotify.add_watch(path)] = path
+                entries = list(findwalk.listdir(path))
+            except OSError, msg:
+                sys.stderr.write('Error: %s\n' % msg)
+                continue
+
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        stack.append(entry.path)
+                elif scan and photodb.PhotoDB.isImage(entry.name):
+                    self.pending[entry.path] = ('update', time.time())
+
+    def removeWatches(self, dirpath):
+        """ Stop watching given directory and its subdirectories (moved out of the watched directories or deleted),
+            so that the later events of their watches are not taken for events of the old paths. """
+        prefix = dirpath + '/'
+        for wd, path in self.watches.items():
+            if path == dirpath or path.startswith(prefix):
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
+
+    def processEvents(self, events):
+        now = time.time()
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost --> fall back to the (incremental) update
+                sys.stderr.write('Warning: inotify event queue overflow, updating all.\n')
+                self.applyPending(force=True)
+                self.db.update(self.paths)
+                continue
+
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+
+            dirpath = self.watches.get(wd)
+            if dirpath == None or not name or name.startswith('.'):
+                continue
+            path = os.path.join(dirpath, name)
+            isDir = bool(mask & IN_ISDIR)
+
+            if mask & IN_MOVED_FROM:
+                self.moves[cookie] = (path, isDir, now)
+            elif mask & IN_MOVED_TO:
+                if cookie in self.moves:
+                    oldpath, _, _ = self.moves.pop(cookie)
+                    self.renamed(oldpath, path, isDir)
+                elif isDir:
+                    self.addWatches(path, scan=True)
+                elif photodb.PhotoDB.isImage(name):
+                    self.pending[path] = ('update', now)
+            elif isDir:
+                if mask & IN_CREATE:
+                    self.addWatches(path, scan=True)
+                elif mask & IN_DELETE:
+                    self.removeWatches(path)
+                    self.db.remove((), [path])
+            elif photodb.PhotoDB.isImage(name):
+                if mask & IN_CLOSE_WRITE:
+                    self.pending[path] = ('update', now)
+                elif mask & IN_DELETE:
+                    self.pending[path] = ('remove', now)
+
+    def renamed(self, oldpath, newpath, isDir):
+        if not isDir:
+            if oldpath in self.pending:
+                self.pending[newpath] = self.pending.pop(oldpath)
+            if photodb.PhotoDB.isImage(newpath):
+                if self.db.rename(oldpath, newpath) == 0 and newpath not in self.pending:
+                    self.pending[newpath] = ('update', time.time())
+            else:
+                self.db.remove([oldpath])
+            print oldpath + ' -> ' + newpath
+            return
+
+        oldprefix = oldpath + '/'
+        for wd, path in self.watches.items():
+            if path == oldpath or path.startswith(oldprefix):
+                self.watches[wd] = newpath + path[len(oldpath):]
+        for path in self.pending.keys():
+            if path.startswith(oldprefix):
+                self.pending[newpath + path[len(oldpath):]] = self.pending.pop(path)
+        self.db.rename(oldpath, newpath, isDir=True)
+        print oldpath + ' -> ' + newpath
+
+    def applyPending(self, force=False):
+        """ Apply the changes that have been quiet for the debounce time (or all if 'force') and commit them. """
+        now = time.time()
+        limit = now - self.debounce
+
+        for cookie, (path, isDir, t) in self.moves.items():
+            # Moved out of the watched directories
+            if force or t < limit:
+                del self.moves[cookie]
+                if isDir:
+                    self.removeWatches(path)
+                    self.db.remove((), [path])
+                else:
+                    self.pending[path] = ('remove', t)
+
+        ready = sorted(path for path, (action, t) in self.pending.iteritems() if force or t < limit)
+        for path in ready:
+            action, t = self.pending.pop(path)
+            if action == 'remove':
+                if self.db.remove([path]):
+                    print path + ' - Removed'
+                continue
+
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue  # Removed again, the event is on its way
+            if not force and st.st_mtime > limit:
+                # Still being written
+                self.pending[path] = (action, st.st_mtime)
+                continue
+
+            mdata = ImageMetadata(path)
+            mdata.fromVals(photodb._readMetadataVals(path))
+            self.db.setMetadata(path, mdata, st)
+            print path
+
+        if self.db.isModifiedButNotSaved:
+            self.db.save()
+            sys.stdout.flush()
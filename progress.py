@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2017 Juuso Räsänen <info@trimap.fi>
+
+"""
+ Progress line of the long runs of photodb (-update), redrawn in place on a terminal.
+
+ Shows the number of files checked out of the expected total, the rate of reading the
+ files (files/s and MB/s) and the estimated time left. The total is e.g. the number of
+ files stored by the previous run, or counted in a background thread while the run starts.
+
+"""
+
+import sys
+import time
+import threading
+
+REFRESH_INTERVAL = 0.5  # Seconds between the redraws
+
+
+def formatDuration(seconds):
+    seconds = int(round(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class Progress:
+    """ Progress line written to given terminal. The total number of files can be None (not known, no estimate). """
+
+    def __init__(self, out=sys.stderr, total=None):
+        self.out = out
+        self.total = total
+        self.started = time.time()
+        self.refreshed = 0
+        self.shown = False
+
+    def countTotal(self, count, *args):
+        """ Set the total to count(*args), computed in a background thread. """
+        def run():
+            self.total = count(*args)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def update(self, numChecked, numRead, numBytes):
+        """ Redraw the line (at most every REFRESH_INTERVAL): numChecked files of the total checked so far, numRead
+            files of numBytes read. """
+        now = time.time()
+        if now - self.refreshed < REFRESH_INTERVAL:
+            return
+        self.refreshed = now
+        elapsed = max(now - self.started, 1e-9)
+        total = self.total
+
+        if total and numChecked <= total:
+            line = '%d/%d files (%d%%)' % (numChecked, total, 100 * numChecked // total)
+        else:
+            line = '%d files' % numChecked
+        line += ', read %.1f files/s, %.1f MB/s' % (numRead / elapsed, numBytes / elapsed / 1e6)
+        if total and 0 < numChecked < total:
+            line += ', ETA %s' % formatDuration(elapsed * (total - numChecked) / numChecked)
+        self.out.write('\r' + line + '\033[K')
+        self.out.flush()
+        self.shown = True
+
+    def clear(self):
+        if self.shown:
+            self.out.write('\r\033[K')
+            self.out.flush()
+            self.shown = False
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2017 Juuso Räsänen <info@trimap.fi>
+
+"""
+ Tests that the three implementations of the metadata filters (ExifFilter.apply, to_sql and
+ to_mask) select the same files.
+
+ Usage: python -m unittest discover tests  (to_mask is left out without NumPy)
+
+"""
+
+import os
+import sys
+import sqlite3
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import photosnapshot
+import exiffilter
+
+FIELDS = ['origtime', 'flength', 'iso', 'rating']
+# name, origtime, flength, iso, rating
+FILES = [('a', '2015:01:01 12:00:00', 50.0, 100.0, 3),
+         ('b', '2015:06:30 08:15:00', 200.0, 400.0, None),
+         ('c', '2016:02:29 23:59:59', 24.0, 1600.0, 5),
+         ('d', None, None, None, None),
+         ('e', '2016:12:31 00:00:00', 85.0, 400.0, 0),
+         ('f', '2017', 50.0, None, 1)]
+
+# Lists of (field, filter) of the ExifFilters and the files they select
+CASES = [([('iso', '400')], 'be'),
+         ([('iso', '!400')], 'ac'),  # Not equal, no value does not pass
+         ([('iso', '!')], 'df'),
+         ([('iso', '')], 'abce'),
+         ([('rating', '!')], 'bd'),
+         ([('rating', '+0')], 'acf'),
+         ([('rating', '-=1')], 'ef'),
+         ([('flength', '!50')], 'bce'),
+         ([('flength', '!24..85')], 'b'),
+         ([('iso', '100,1600')], 'ac'),
+         ([('iso', '!100,1600')], 'be'),
+         ([('iso', '+=400'), ('rating', '!')], 'b'),
+         ([('iso', '-1600'), ('flength', '+=50')], 'abe'),
+         ([('iso', '..400'), ('flength', '50..')], 'abe'),
+         ([('origtime', '2015')], ''),  # Equal to the whole string
+         ([('origtime', '2017')], 'f'),
+         ([('origtime', '2015..2015')], 'ab'),
+         ([('origtime', '2016..')], 'cef'),
+         ([('origtime', '!2016..')], 'ab'),
+         ([('origtime', '-2016:02')], 'ab'),
+         ([('origtime', '+2016:02:29 23:59:59')], 'ef'),
+         ([('origtime', '!2015:06:30 08:15:00')], 'acef'),
+         ([('origtime', '!')], 'd'),
+         ([('origtime', '2015..2016'), ('rating', '!0'), ('flength', '!200')], 'ac')]
+
+
+class FilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.text_factory = str
+        self.conn.execute('CREATE TABLE files(name text, %s)' % ', '.join(FIELDS))
+        self.conn.executemany('INSERT INTO files VALUES (?,?,?,?,?)', FILES)
+
+        self.columns = None
+        self.numpy = numpy = photosnapshot.importNumpy()
+        if numpy is not None:
+            # Like in the snapshot: NaN and '' for no value
+            values = zip(*FILES)[1:]
+            self.columns = dict(origtime=numpy.array([val or '' for val in values[0]], 'S'))
+            for field, vals in zip(FIELDS[1:], values[1:]):
+                self.columns[field] = numpy.array(vals, numpy.float64)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def exifFilter(self, filters):
+        ef = exiffilter.ExifFilter()
+        for field, filterString in filters:
+            ef.add_filter(field, filterString)
+        return ef
+
+    def test_same_files(self):
+        for filters, expected in CASES:
+            ef = self.exifFilter(filters)
+            applied = ''.join(row[0] for row in FILES if ef.apply(dict(zip(FIELDS, row[1:]))))
+            self.assertEqual(applied, expected, 'apply %s' % filters)
+
+            where, params = ef.to_sql('f')
+            selected = ''.join(name for name, in self.conn.execute('SELECT name FROM files f WHERE %s ORDER BY name' % where, params))
+            self.assertEqual(selected, expected, 'to_sql %s: %s %s' % (filters, where, params))
+
+            if self.columns is not None:
+                with self.numpy.errstate(invalid='ignore'):  # Like photosnapshot, NaN is not comparable
+                    mask = ef.to_mask(self.columns)
+                self.assertEqual(''.join(row[0] for row, passed in zip(FILES, mask) if passed), expected, 'to_mask %s' % filters)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2017 Juuso Räsänen <info@trimap.fi>
+
+"""
+ Tests of the geo areas of -near and -bbox at the 180th meridian and at the poles.
+
+ Usage: python -m unittest discover tests
+
+"""
+
+import os
+import sys
+import math
+import random
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import exiffilter
+import photodb
+import geo
+
+# Circles (lat, lon, radius in km) crossing the 180th meridian, around a pole and near one
+CIRCLES = [(-17.8, 179.9, 50.0),
+           (65.5, -179.5, 120.0),
+           (0.0, 180.0, 10.0),
+           (89.9, 45.0, 30.0),
+           (-89.99, -120.0, 5.0),
+           (85.0, 179.0, 500.0),
+           (-80.0, -175.0, 1000.0)]
+
+
+def wrapLon(lon):
+    return (lon + 180.0) % 360.0 - 180.0
+
+def points(circle, count, rnd):
+    """ Return random points (lat, lon) around given circle, about half of them inside it. """
+    angle = math.degrees(circle.radius / geo.EARTH_RADIUS)
+    ret = []
+    for i in xrange(count):
+        lat = max(-90.0, min(90.0, circle.lat + rnd.uniform(-2, 2) * angle))
+        # The longitude of a degree of latitude grows towards the poles
+        dlon = min(180.0, 2 * angle / max(math.cos(math.radians(lat)), 1e-6))
+        ret.append((lat, wrapLon(circle.lon + rnd.uniform(-dlon, dlon))))
+    return ret
+
+
+class CircleTest(unittest.TestCase):
+
+    def test_boxes_contain_circle(self):
+        rnd = random.Random(1)
+        for lat, lon, radius in CIRCLES:
+            circle = geo.Circle(lat, lon, radius)
+            boxes = circle.boxes()
+            for south, north, west, east in boxes:
+                self.assertTrue(-90 <= south <= north <= 90 and -180 <= west <= east <= 180, (lat, lon, radius, boxes))
+            inside = 0
+            for plat, plon in points(circle, 2000, rnd):
+                if circle.contains(plat, plon):
+                    inside += 1
+                    self.assertTrue(any(south <= plat <= north and west <= plon <= east for south, north, west, east in boxes),
+                                    '%s, %s not in the boxes of %s: %s' % (plat, plon, (lat, lon, radius), boxes))
+            self.assertTrue(inside > 100, (lat, lon, radius))
+
+    def test_antimeridian(self):
+        circle = geo.Circle(-17.8, 179.9, 50.0)
+        boxes = circle.boxes()
+        self.assertEqual(len(boxes), 2)
+        self.assertEqual([box[2:] for box in boxes], [(boxes[0][2], 180.0), (-180.0, boxes[1][3])])
+        self.assertTrue(circle.contains(-17.8, -179.8))
+        self.assertTrue(circle.contains(-17.8, 179.6))
+        self.assertFalse(circle.contains(-17.8, 179.0))
+        self.assertFalse(circle.contains(-17.8, -179.0))
+
+    def test_pole(self):
+        circle = geo.Circle(89.9, 45.0, 30.0)
+        self.assertEqual([box[1:] for box in circle.boxes()], [(90.0, -180.0, 180.0)])
+        # Across the pole
+        self.assertTrue(circle.contains(89.9, -135.0))
+        self.assertTrue(circle.contains(90.0, 0.0))
+        self.assertFalse(circle.contains(89.5, -135.0))
+
+    def test_splitLongitudes(self):
+        self.assertEqual(geo.splitLongitudes(10.0, 20.0), [(10.0, 20.0)])
+        self.assertEqual(geo.splitLongitudes(170.0, 190.0), [(170.0, 180.0), (-180.0, -170.0)])
+        self.assertEqual(geo.splitLongitudes(-185.0, -175.0), [(175.0, 180.0), (-180.0, -175.0)])
+        self.assertEqual(geo.splitLongitudes(-200.0, 200.0), [(-180.0, 180.0)])
+
+
+class DatabaseTest(unittest.TestCase):
+    """ The areas queried with the gpsindex R-tree select the same points as the exact test. """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db = photodb.PhotoDB(os.path.join(self.tmp, 'geo.db'))
+        self.db.load()
+        rnd = random.Random(2)
+        self.points = []
+        for lat, lon, radius in CIRCLES:
+            self.points.extend(points(geo.Circle(lat, lon, radius), 300, rnd))
+        self.db.c.executemany('INSERT INTO files(dir_id, name, gpslat, gpslon) VALUES (1, ?, ?, ?)',
+                              [(str(i), lat, lon) for i, (lat, lon) in enumerate(self.points)])
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmp)
+
+    def query(self, area):
+        condition, params = exiffilter.area_sql(area)
+        return sorted(int(name) for name, in self.db.c.execute('SELECT name FROM files WHERE %s' % condition, params))
+
+    def test_same_as_contains(self):
+        areas = [geo.Circle(lat, lon, radius) for lat, lon, radius in CIRCLES] + \
+                [geo.Box(-20.0, 179.0, -15.0, -179.0), geo.Box(85.0, -180.0, 90.0, 180.0), geo.Box(-90.0, 170.0, -80.0, -170.0)]
+        for area in areas:
+            expected = [i for i, (lat, lon) in enumerate(self.points) if area.contains(lat, lon)]
+            self.assertTrue(expected)
+            self.assertEqual(self.query(area), expected, area.boxes())
+
+
+if __name__ == '__main__':
+    unittest.main()
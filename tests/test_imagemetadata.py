@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2017 Juuso Räsänen <info@trimap.fi>
+
+"""
+ Tests of mapping the tags read by the readers (fastexif and pyexiv2) to the metadata fields.
+
+ Usage: python -m unittest discover tests
+
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ImageMetadata import ImageMetadata, MAX_RAW_STRING
+import photobench
+import photodb
+
+
+class Exiv2Tag:
+    def __init__(self, value):
+        self.value = value
+
+class Exiv2Metadata(dict):
+    """ The tags as pyexiv2.ImageMetadata gives them (without reading a file). """
+
+    @property
+    def exif_keys(self):
+        return sorted(key for key in self if key.startswith('Exif.'))
+
+    @property
+    def xmp_keys(self):
+        return sorted(key for key in self if key.startswith('Xmp.'))
+
+    def __getitem__(self, key):
+        return Exiv2Tag(dict.__getitem__(self, key))
+
+
+class ReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def readFast(self, fname):
+        md = ImageMetadata(fname)
+        self.assertTrue(md.readFast())
+        md.fromRaw(md.readRawTags())
+        return md
+
+    def readExiv2(self, fname, tags):
+        """ Return the metadata of given tags as read by pyexiv2. """
+        md = ImageMetadata(fname)
+        md.fastfields = None
+        md.exiv2md = Exiv2Metadata(tags)
+        md.fromRaw(md.readRawTags())
+        return md
+
+    def nef(self, isoSpeedRatings, nikonIso):
+        """ Write a NEF file with given ISO tags (None for none) and return its path. """
+        exif = [(0x8827, 3, [isoSpeedRatings])] if isoSpeedRatings != None else []
+        fname = os.path.join(self.tmp, 'DSC_%s_%s.nef' % (isoSpeedRatings, nikonIso))
+        with open(fname, 'wb') as f:
+            f.write(photobench.tiffData('<', [(0x010F, 2, 'NIKON CORPORATION')], exif, photobench.nikonMakernote(nikonIso)))
+        return fname
+
+    def test_nikon_iso(self):
+        # (Exif.Photo.ISOSpeedRatings, ISO of the Nikon makernote, expected iso)
+        for isoSpeedRatings, nikonIso, iso in [(400, 400, 400), (None, 800, 800), (200, 0, 200), (6400, 3200, 3200)]:
+            fname = self.nef(isoSpeedRatings, nikonIso)
+            tags = {'Exif.Image.Make': 'NIKON CORPORATION', 'Exif.Nikon3.ISOSpeed': [0, nikonIso]}
+            if isoSpeedRatings != None:
+                tags['Exif.Photo.ISOSpeedRatings'] = isoSpeedRatings
+            self.assertEqual(self.readFast(fname)['iso'], iso)
+            self.assertEqual(self.readExiv2(fname, tags)['iso'], iso)
+
+    def test_long_comment(self):
+        # The long strings are left out of the stored raw tags only, not of the fields
+        comment = ' '.join(['Long description.'] * 100)
+        fname = os.path.join(self.tmp, 'long.jpg')
+        with open(fname, 'wb') as f:
+            f.write(photobench.jpegData(photobench.tiffData('<', [(0x010E, 2, comment), (0x0131, 2, comment)], [(0x8827, 3, [100])])))
+        self.assertGreater(len(comment), MAX_RAW_STRING)
+        tags = {'Exif.Image.ImageDescription': comment, 'Exif.Image.Software': comment, 'Exif.Photo.ISOSpeedRatings': 100}
+        for md in [self.readFast(fname), self.readExiv2(fname, tags)]:
+            self.assertEqual(md['comment'], comment)
+            # Kept whole in the stored tags for -backfill, unlike the tags not read to the fields
+            self.assertEqual(photodb.unpackRaw(photodb.packRaw(md.raw)), {'Exif.Image.ImageDescription': comment, 'Exif.Photo.ISOSpeedRatings': 100})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2017 Juuso Räsänen <info@trimap.fi>
+
+"""
+ Tests of updating and querying the photo database of a temporary directory tree.
+
+ Usage: python -m unittest discover tests
+
+"""
+
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ImageMetadata import ImageMetadata
+import photobench
+import photodb
+
+MTIME = 1500000000  # Modification time of the files (os.utime of Python 2 can't restore a time with nanoseconds)
+
+
+def jpeg(iso):
+    """ Return the contents of a JPEG file with given ISO speed. """
+    return photobench.jpegData(photobench.tiffData('<', [(0x010F, 2, 'Test')], [(0x8827, 3, [iso])]))
+
+
+class PhotoDBTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reader = ImageMetadata.reader
+        ImageMetadata.reader = 'fast'
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, 'photos')
+        os.makedirs(self.root)
+        for iso in [100, 400, 1600]:
+            self.write('%d.jpg' % iso, iso)
+            self.setModtime('%d.jpg' % iso, MTIME)
+        self.dbFile = os.path.join(self.tmp, 'p.db')
+        self.update()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        ImageMetadata.reader = self.reader
+        shutil.rmtree(self.tmp)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def write(self, name, iso):
+        with open(self.path(name), 'wb') as f:
+            f.write(jpeg(iso))
+
+    def update(self):
+        """ Update the database. Returns the names of the files read. """
+        reads = []
+        readMetadataVals = photodb._readMetadataVals
+        def recordRead(fname):
+            reads.append(os.path.basename(fname))
+            return readMetadataVals(fname)
+        photodb._readMetadataVals = recordRead
+        try:
+            db = photodb.PhotoDB(self.dbFile)
+            db.update(self.root)
+            db.close()
+        finally:
+            photodb._readMetadataVals = readMetadataVals
+        return sorted(reads)
+
+    def setModtime(self, name, mtime):
+        os.utime(self.path(name), (mtime, mtime))
+
+    def rows(self):
+        """ Return the files in the database as dict of name -> ISO speed. """
+        db = photodb.PhotoDB(self.dbFile, readOnly=True)
+        db.load()
+        try:
+            return dict((os.path.basename(fpath), iso) for fpath, iso in db.c.execute('SELECT filepath, iso FROM images'))
+        finally:
+            db.close()
+
+    def query(self, db, names):
+        """ Return dict of name -> ISO speed (None if not in the database) of given files queried from given PhotoDB. """
+        return dict((os.path.basename(fname), md['iso'] if md else None) for fname, md in db.queryFiles((self.path(name), None) for name in names))
+
+    def test_read_only(self):
+        db = photodb.PhotoDB(self.dbFile, readOnly=True)
+        db.load()
+        try:
+            self.assertRaises(sqlite3.OperationalError, db.c.execute, 'DELETE FROM files')
+            # The temporary tables of the queries are written regardless
+            self.assertEqual(self.query(db, ['100.jpg', '400.jpg', 'none.jpg']), {'100.jpg': 100, '400.jpg': 400, 'none.jpg': None})
+            self.assertRaises(sqlite3.OperationalError, db.c.execute, 'DELETE FROM files')
+            self.assertEqual(self.query(db, ['1600.jpg']), {'1600.jpg': 1600})
+        finally:
+            db.close()
+
+    def test_query_reads_changed_files(self):
+        # Same size and modification time: the stored metadata is used although the contents have changed
+        self.write('100.jpg', 200)
+        self.setModtime('100.jpg', MTIME)
+        # Modification time changed
+        self.write('400.jpg', 800)
+        self.setModtime('400.jpg', MTIME + 10)
+        # Size changed
+        self.write('1600.jpg', 3200)
+        with open(self.path('1600.jpg'), 'ab') as f:
+            f.write('\0')
+        self.setModtime('1600.jpg', MTIME)
+
+        db = photodb.PhotoDB(self.dbFile)
+        db.load()
+        db.setUpdateIfNotFound(True, 1)
+        try:
+            self.assertEqual(self.query(db, ['100.jpg', '400.jpg', '1600.jpg']), {'100.jpg': 100, '400.jpg': 800, '1600.jpg': 3200})
+        finally:
+            db.close()
+        self.assertEqual(self.rows(), {'100.jpg': 100, '400.jpg': 800, '1600.jpg': 3200})
+
+    def test_update_reuses_moved_and_copied(self):
+        os.rename(self.path('100.jpg'), self.path('renamed.jpg'))
+        shutil.copy(self.path('400.jpg'), self.path('copy.jpg'))
+        self.write('new.jpg', 3200)
+        self.assertEqual(self.update(), ['new.jpg'])
+        self.assertEqual(self.rows(), {'renamed.jpg': 100, '400.jpg': 400, 'copy.jpg': 400, '1600.jpg': 1600, 'new.jpg': 3200})
+
+        # The rows are the files' own, e.g. the copy is updated separately
+        self.write('copy.jpg', 6400)
+        self.assertEqual(self.update(), ['copy.jpg'])
+        self.assertEqual(self.rows(), {'renamed.jpg': 100, '400.jpg': 400, 'copy.jpg': 6400, '1600.jpg': 1600, 'new.jpg': 3200})
+        self.assertEqual(self.update(), [])
+
+
+class MigrationTest(unittest.TestCase):
+
+    # Rows of the images table of version 1 (filepath, filesize, modtime, origtime, flength, flength35, aperture, exposure, iso, rating, comment)
+    ROWS = [('/photos/2015/a.jpg', 30000, 1420070400.0, '2015:01:01 12:00:00', 50.0, 80.0, 1.8, 0.01, 400.0, 3, u'First'),
+            ('/photos/2015/b.jpg', 40000, 1420070401.5, '2015:06:30 08:15:00', 200.0, 320.0, 5.6, 0.002, 1600.0, None, None),
+            ('/photos/2016/sub/c.nef', 50000, 1451606400.0, None, None, None, None, None, None, None, u'Ääkköset'),
+            ('/top.png', 25000, 1451606401.0, '2016:02:29 23:59:59', 24.0, 38.0, 8.0, 0.5, 100.0, 5, None)]
+    QUERY = 'SELECT filepath, iso, rating FROM images WHERE iso >= 100 AND (flength < 100 OR rating IS NULL) ORDER BY filepath'
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.dbFile = os.path.join(self.tmp, 'v1.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_migrate_from_v1(self):
+        conn = sqlite3.connect(self.dbFile)
+        conn.text_factory = str
+        for statement in photodb.MIGRATIONS[0]:
+            conn.execute(statement)
+        conn.executemany('INSERT INTO images VALUES (?,?,?,?,?,?,?,?,?,?,?)', self.ROWS)
+        conn.commit()
+        expected = conn.execute(self.QUERY).fetchall()
+        conn.close()
+        self.assertEqual(len(expected), 3)
+
+        db = photodb.PhotoDB(self.dbFile)
+        db.load()
+        try:
+            self.assertEqual(db.schemaVersion(), len(photodb.MIGRATIONS))
+            self.assertEqual(len(photodb.MIGRATIONS), 9)
+            rows = db.c.execute('SELECT %s FROM images ORDER BY filepath' % ','.join(photodb.COLUMNS[:11])).fetchall()
+            self.assertEqual(rows, [row[:10] + (row[10].encode('utf-8') if row[10] else None,) for row in self.ROWS])
+            self.assertEqual(db.c.execute(self.QUERY).fetchall(), expected)
+            self.assertEqual(db.c.execute('SELECT origepoch FROM images ORDER BY filepath').fetchall(),
+                             [(1420113600,), (1435652100,), (None,), (1456790399,)])
+            self.assertEqual(db.getMetadata('/photos/2016/sub/c.nef')['comment'], u'Ääkköset'.encode('utf-8'))
+            self.assertEqual(sorted(db.c.execute('SELECT path FROM dirs')), [('',), ('/photos',), ('/photos/2015',), ('/photos/2016',), ('/photos/2016/sub',)])
+        finally:
+            db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
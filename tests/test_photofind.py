@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2017 Juuso Räsänen <info@trimap.fi>
+
+"""
+ Tests that photofind -dbonly finds the same files from the database as the directory walk does.
+
+ Usage: python -m unittest discover tests
+
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ImageMetadata import ImageMetadata
+import photobench
+import photofind
+import photodb
+
+MTIME = 1500000000
+
+# Relative path, ISO speed, size in kB and modification time (seconds after MTIME) of the files
+FILES = [('a.jpg', 100, 30, 0),
+         ('small.jpg', 200, 10, 10),
+         ('B.JPG', 400, 50, 20),
+         ('sub/c.jpg', 800, 45, 30),
+         ('sub/d.png', 1600, 25, 40),
+         ('sub/deeper/e.nef', 3200, 60, 50),
+         ('sub/deeper/f.jpg', 6400, 21, 60)]
+
+
+def tiff(iso):
+    return photobench.tiffData('<', [(0x010F, 2, 'Test')], [(0x8827, 3, [iso])])
+
+
+class DbOnlyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reader = ImageMetadata.reader
+        ImageMetadata.reader = 'fast'
+        self.stdout, self.stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, 'photos')
+        os.makedirs(os.path.join(self.root, 'sub', 'deeper'))
+        for relpath, iso, size, mtime in FILES:
+            fname = os.path.join(self.root, relpath)
+            with open(fname, 'wb') as f:
+                ext = os.path.splitext(relpath)[1].lower()
+                f.write(photobench.pngData(tiff(iso)) if ext == '.png' else tiff(iso) if ext == '.nef' else photobench.jpegData(tiff(iso)))
+                f.truncate(size * 1024)
+            os.utime(fname, (MTIME + mtime, MTIME + mtime))
+        self.reference = os.path.join(self.tmp, 'reference')
+        open(self.reference, 'w').close()
+        os.utime(self.reference, (MTIME + 25, MTIME + 25))
+
+        self.dbFile = os.path.join(self.tmp, 'p.db')
+        db = photodb.PhotoDB(self.dbFile)
+        db.update(self.root)
+        db.close()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        ImageMetadata.reader = self.reader
+        shutil.rmtree(self.tmp)
+
+    def photofind(self, argv):
+        """ Return the sorted output lines of photofind with given arguments. """
+        sys.stdout = StringIO.StringIO()
+        photofind.main(argv + ['-dbfile', self.dbFile])
+        return sorted(sys.stdout.getvalue().splitlines())
+
+    def test_same_as_walk(self):
+        os.chdir(self.tmp)
+        for path in [self.root, 'photos', 'photos/', './photos/sub', 'photos/B.JPG']:
+            for options in [[],
+                            ['-name', '*.jpg'],
+                            ['-iname', 'b*'],
+                            ['-size', '+40k'],
+                            ['-size', '-40k'],
+                            ['-maxdepth', '0'],
+                            ['-maxdepth', '1'],
+                            ['-mindepth', '2', '-maxdepth', '2'],
+                            ['-newer', self.reference],
+                            ['-newer', self.reference, '-name', '*.jpg', '-maxdepth', '2'],
+                            ['-iso', '+500', '-size', '-50k']]:
+                walked = self.photofind([path] + options)
+                self.assertEqual(self.photofind([path, '-dbonly'] + options), walked, '%s %s' % (path, options))
+
+        # A few of them to see that the walk found the files
+        self.assertEqual(self.photofind(['photos', '-maxdepth', '1']), ['photos/B.JPG', 'photos/a.jpg'])
+        self.assertEqual(self.photofind(['photos/', '-newer', self.reference]), ['photos/sub/c.jpg', 'photos/sub/d.png', 'photos/sub/deeper/e.nef', 'photos/sub/deeper/f.jpg'])
+        self.assertEqual(self.photofind([self.root, '-size', '+40k', '-name', '*.jpg']), [os.path.join(self.root, 'sub/c.jpg')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2017 Juuso Räsänen <info@trimap.fi>
+
+"""
+ Runs the query server (photodb -serve) of a temporary database and sends it photofind queries.
+
+ Usage: python -m unittest discover tests
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import socket
+import signal
+import tempfile
+import unittest
+import StringIO
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ImageMetadata import ImageMetadata
+import photoserver
+import photobench
+import photodb
+
+TOOLS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TIMEOUT = 10.0  # Seconds to wait for the server
+
+
+def jpeg(iso):
+    """ Return the contents of a JPEG file with given ISO speed. """
+    return photobench.jpegData(photobench.tiffData('<', [(0x010F, 2, 'Test')], [(0x8827, 3, [iso])]))
+
+
+class ServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reader = ImageMetadata.reader
+        ImageMetadata.reader = 'fast'
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, 'photos')
+        os.makedirs(self.root)
+        for iso in [100, 400, 1600]:
+            with open(os.path.join(self.root, '%d.jpg' % iso), 'wb') as f:
+                f.write(jpeg(iso))
+                f.truncate(24 * 1024)  # Past photofind's default '-size +20k'
+        self.dbFile = os.path.join(self.tmp, 'p.db')
+        db = photodb.PhotoDB(self.dbFile)
+        db.update(self.root)
+        db.close()
+
+        self.log = open(os.path.join(self.tmp, 'server.log'), 'w')
+        self.server = subprocess.Popen([sys.executable, os.path.join(TOOLS, 'photodb.py'), '-serve', '-dbfile', self.dbFile],
+                                       stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.time() + TIMEOUT
+        while not os.path.exists(photoserver.socketPath(self.dbFile)) and time.time() < deadline:
+            time.sleep(0.05)
+
+    def tearDown(self):
+        self.server.send_signal(signal.SIGTERM)
+        self.server.wait()
+        self.log.close()
+        sys.stdout = self.stdout
+        ImageMetadata.reader = self.reader
+        shutil.rmtree(self.tmp)
+
+    def query(self, argv):
+        """ Return (exit status, stdout) of a photofind query answered by the server, None if not answered in time. """
+        out, err = StringIO.StringIO(), StringIO.StringIO()
+        result = []
+        thread = threading.Thread(target=lambda: result.append(photoserver.query(self.dbFile, argv, out, err)))
+        thread.daemon = True
+        thread.start()
+        thread.join(TIMEOUT)
+        if not result:
+            return None
+        return result[0], out.getvalue()
+
+    def test_query(self):
+        self.assertEqual(self.query([self.root, '-iso', '+200', '-dbfile', self.dbFile]),
+                         (0, '%s/1600.jpg\n%s/400.jpg\n' % (self.root, self.root)))
+
+    def test_concurrent_queries(self):
+        # A client that has connected but not sent its query does not keep the others waiting
+        stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stalled.connect(photoserver.socketPath(self.dbFile))
+        try:
+            self.assertEqual(self.query([self.root, '-iso', '100', '-dbfile', self.dbFile]), (0, '%s/100.jpg\n' % self.root))
+        finally:
+            stalled.close()
+
+    def test_abbreviated_options(self):
+        # Abbreviations of the options run in-process like the options themselves
+        sys.stdout = StringIO.StringIO()
+        for arg in ['-upd', '-update', '-nos', '-noserver', '-statsj=stats.json', '--he']:
+            self.assertEqual(photoserver.forward([self.root, '-dbfile', self.dbFile, arg]), None)
+        self.assertEqual(photoserver.forward([self.root, '-dbfile', self.dbFile, '-iso', '400']), 0)
+        self.assertEqual(sys.stdout.getvalue(), '%s/400.jpg\n' % self.root)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2017 Juuso Räsänen <info@trimap.fi>
+
+"""
+ Tests of the database snapshot: reusing it while the database is unchanged and rebuilding it after changes.
+
+ Usage: python -m unittest discover tests  (the tests are skipped without NumPy)
+
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ImageMetadata import ImageMetadata
+import photosnapshot
+import photobench
+import photodb
+
+
+def jpeg(iso):
+    """ Return the contents of a JPEG file with given ISO speed. """
+    return photobench.jpegData(photobench.tiffData('<', [(0x010F, 2, 'Test')], [(0x8827, 3, [iso])]))
+
+
+@unittest.skipIf(photosnapshot.importNumpy() == None, 'NumPy is not installed')
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reader = ImageMetadata.reader
+        ImageMetadata.reader = 'fast'
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, 'photos')
+        os.makedirs(self.root)
+        for i, iso in enumerate([100, 400, 1600]):
+            self.write('%d.jpg' % i, iso)
+        self.dbFile = os.path.join(self.tmp, 'p.db')
+        self.update()
+        db = photodb.PhotoDB(self.dbFile)
+        db.load()
+        photosnapshot.build(db)
+        db.close()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        ImageMetadata.reader = self.reader
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, iso):
+        with open(os.path.join(self.root, name), 'wb') as f:
+            f.write(jpeg(iso))
+
+    def update(self):
+        db = photodb.PhotoDB(self.dbFile)
+        db.update(self.root)
+        db.close()
+
+    def current(self):
+        """ Return (directory, creation time) of the current snapshot. """
+        path = os.path.realpath(photosnapshot.snapshotPath(self.dbFile))
+        with open(os.path.join(path, 'meta.json')) as f:
+            return path, json.load(f)['created']
+
+    def load(self):
+        photosnapshot._loaded.clear()  # Like a new photofind process
+        return photosnapshot.load(self.dbFile)
+
+    def isos(self, snapshot):
+        return sorted(snapshot.columns['iso'].tolist())
+
+    def test_reused_while_unchanged(self):
+        built = self.current()
+        self.assertEqual(self.isos(self.load()), [100, 400, 1600])
+        self.assertEqual(self.current(), built)
+        self.assertEqual(self.isos(self.load()), [100, 400, 1600])
+        self.assertEqual(self.current(), built)
+
+    def test_rebuilt_after_update(self):
+        self.load()
+        built = self.current()
+        self.write('3.jpg', 3200)
+        self.update()
+        self.assertEqual(self.isos(self.load()), [100, 400, 1600, 3200])
+        rebuilt = self.current()
+        self.assertNotEqual(rebuilt, built)
+        self.load()
+        self.assertEqual(self.current(), rebuilt)
+        self.assertEqual(sorted(name for name in os.listdir(self.tmp) if name.startswith('p.db.snapshot.')),
+                         sorted([os.path.basename(rebuilt[0]), 'p.db.snapshot.lock']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2017 Juuso Räsänen <info@trimap.fi>
+
+"""
+ Drives photowatch.Watcher against a temporary directory tree and checks the database rows.
+
+ Usage: python -m unittest discover tests  (Linux only, uses inotify)
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ImageMetadata import ImageMetadata
+import photobench
+import photowatch
+import photodb
+
+TIMEOUT = 10.0  # Seconds to wait for the watcher to apply a change
+
+
+def jpeg(iso):
+    """ Return the contents of a JPEG file with given ISO speed. """
+    return photobench.jpegData(photobench.tiffData('<', [(0x010F, 2, 'Test')], [(0x8827, 3, [iso])]))
+
+
+class WatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reader = ImageMetadata.reader
+        ImageMetadata.reader = 'fast'
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, 'photos')
+        self.outside = os.path.join(self.tmp, 'outside')
+        os.makedirs(os.path.join(self.root, 'a'))
+        os.makedirs(os.path.join(self.root, 'b'))
+        os.makedirs(self.outside)
+        self.write('a/one.jpg', 100)
+        self.write('a/two.jpg', 200)
+        self.write('b/three.jpg', 400)
+
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        self.db = photodb.PhotoDB(os.path.join(self.tmp, 'photo.db'))
+        self.watcher = photowatch.Watcher(self.db, [self.root], debounce=0.2)
+        self.watcher.start()
+
+    def tearDown(self):
+        self.watcher.stop()
+        self.db.close()
+        sys.stdout = self.stdout
+        ImageMetadata.reader = self.reader
+        shutil.rmtree(self.tmp)
+
+    def path(self, relpath):
+        return os.path.join(self.root, relpath)
+
+    def write(self, relpath, iso):
+        with open(self.path(relpath), 'wb') as f:
+            f.write(jpeg(iso))
+
+    def rows(self):
+        """ Return the files in the database as dict of path relative to the root -> ISO speed. """
+        return dict((os.path.relpath(fpath, self.root), iso) for fpath, iso in self.db.c.execute('SELECT filepath, iso FROM images'))
+
+    def waitFor(self, expected):
+        """ Let the watcher process the events until the database has the expected rows (or the timeout). """
+        deadline = time.time() + TIMEOUT
+        while self.rows() != expected and time.time() < deadline:
+            self.watcher.poll()
+        self.assertEqual(self.rows(), expected)
+
+    def test_changes(self):
+        self.assertEqual(self.rows(), {'a/one.jpg': 100, 'a/two.jpg': 200, 'b/three.jpg': 400})
+
+        # A new file is read once it has been written
+        data = jpeg(800)
+        with open(self.path('b/new.jpg'), 'wb') as f:
+            f.write(data[:len(data) // 2])
+            f.flush()
+            self.watcher.poll()
+            self.assertNotIn('b/new.jpg', self.rows())
+            f.write(data[len(data) // 2:])
+        self.waitFor({'a/one.jpg': 100, 'a/two.jpg': 200, 'b/three.jpg': 400, 'b/new.jpg': 800})
+
+        # Renamed file and directory keep their rows
+        os.rename(self.path('a/one.jpg'), self.path('a/uno.jpg'))
+        self.waitFor({'a/uno.jpg': 100, 'a/two.jpg': 200, 'b/three.jpg': 400, 'b/new.jpg': 800})
+        os.rename(self.path('a'), self.path('c'))
+        self.waitFor({'c/uno.jpg': 100, 'c/two.jpg': 200, 'b/three.jpg': 400, 'b/new.jpg': 800})
+
+        # Files in the renamed directory are reported by their new paths
+        self.write('c/four.jpg', 1600)
+        self.waitFor({'c/uno.jpg': 100, 'c/two.jpg': 200, 'c/four.jpg': 1600, 'b/three.jpg': 400, 'b/new.jpg': 800})
+
+        # Removed file
+        os.remove(self.path('b/three.jpg'))
+        self.waitFor({'c/uno.jpg': 100, 'c/two.jpg': 200, 'c/four.jpg': 1600, 'b/new.jpg': 800})
+
+    def test_directory_moved_out(self):
+        os.makedirs(self.path('a/sub'))
+        self.write('a/sub/five.jpg', 3200)
+        self.waitFor({'a/one.jpg': 100, 'a/two.jpg': 200, 'a/sub/five.jpg': 3200, 'b/three.jpg': 400})
+
+        os.rename(self.path('a'), os.path.join(self.outside, 'a'))
+        self.waitFor({'b/three.jpg': 400})
+        self.assertEqual(sorted(self.watcher.watches.values()), [self.root, self.path('b')])
+
+        # Changes outside of the watched directories are not taken for changes of the old paths
+        with open(os.path.join(self.outside, 'a/six.jpg'), 'wb') as f:
+            f.write(jpeg(6400))
+        for i in xrange(4):
+            self.watcher.poll()
+        self.assertEqual(self.rows(), {'b/three.jpg': 400})
+
+    def test_directory_deleted(self):
+        shutil.rmtree(self.path('a'))
+        self.waitFor({'b/three.jpg': 400})
+        self.assertEqual(sorted(self.watcher.watches.values()), [self.root, self.path('b')])
+
+
+if __name__ == '__main__':
+    unittest.main()